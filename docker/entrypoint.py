@@ -26,11 +26,19 @@ from sensor_harm.sentinel2 import sentinel_harmonize
 from sensor_harm.landsat import landsat_harmonize
 
 
+if sys.argv[1:2] == ['--worker']:
+    # Resident worker, e.g. --worker --spool /mnt/spool-dir, see sensor-harm batch
+    from sensor_harm.cli import cli
+    cli(['--verbose', 'batch'] + sys.argv[2:], prog_name='sensor-harm')
+
 start = time.time()
 
 try:
     sceneid = sys.argv[1]
     entry = os.path.join('/mnt/input-dir/', sceneid)
+    if '://' in sceneid or sceneid.startswith('/vsi'):
+        # Scene read directly from object storage, e.g. s3://bucket/prefix/sceneid
+        entry, sceneid = sceneid, sceneid.rstrip('/').rsplit('/', 1)[-1]
     target_dir = '/mnt/output-dir/'
 
     if sceneid.startswith('S2'):
@@ -39,7 +47,10 @@ try:
         sentinel_harmonize(entry, target_dir, apply_bandpass=True)
     elif sceneid.startswith(('LT04', 'LT05', 'LE07', 'LC08')):
         # Landsat
+        # Without precomputed angle bands, angles are computed from the scene ANG.txt
         angle_dir = os.path.join('/mnt/angles-dir/', sceneid)
+        if not os.path.isdir(angle_dir):
+            angle_dir = None
 
         landsat_harmonize(sceneid, entry, target_dir, angle_dir=angle_dir)
     else:
@@ -49,9 +60,11 @@ except:
     Usage:
     docker run --rm
     -v /path/to/input/:/mnt/input-dir:ro
-    -v /path/to/angles:/mnt/angles-dir:ro
+    -v /path/to/angles:/mnt/angles-dir:ro (optional for Landsat scenes with ANG.txt)
     -v /path/to/output:/mnt/output-dir:rw
-    -t brazildatacube/sensor-harm '<LANDSAT Sceneid or SENTINEL-2.SAFE>""")
+    -t brazildatacube/sensor-harm '<LANDSAT Sceneid or SENTINEL-2.SAFE>'
+    or, as a resident worker consuming JSON jobs:
+    docker run --rm -v /path/to/spool:/mnt/spool-dir:rw ... -t brazildatacube/sensor-harm --worker --spool /mnt/spool-dir""")
     sys.exit()
 
 end = time.time()
@@ -19,6 +19,7 @@
 
 pydocstyle sensor_harm examples setup.py && \
 isort sensor_harm examples setup.py --check-only --diff && \
+python -m sensor_harm.cli bench startup && \
 check-manifest --ignore ".travis-*" --ignore ".readthedocs.*" && \
-sphinx-build -qnW --color -b doctest docs/sphinx/ docs/sphinx/_build/doctest #&& \
-#pytest
+sphinx-build -qnW --color -b doctest docs/sphinx/ docs/sphinx/_build/doctest && \
+pytest
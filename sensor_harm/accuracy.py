@@ -0,0 +1,346 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the accuracy regression harness of alternative (faster) configurations.
+
+The reference is pinned: a frozen masked array implementation of the original
+NBAR path (``reference_brf``, ``reference_landsat``) that does not share code
+with the harmonizers, so that a change of the kernels, windows or output
+conversion shows up as an error. The default path is checked as the ``default``
+configuration. A configuration is a name and the keyword arguments of the
+harmonizer (``memory`` and ``workers`` create a scheduler), e.g.
+``{'scheduler': {'memory': '2G', 'workers': 2}}``. Each configuration output is
+compared per band with the reference output (maximum and mean absolute DN error,
+share of changed pixels) and checked against thresholds, together with its throughput.
+"""
+
+# Python Native
+import logging
+import shutil
+import time
+from functools import partial
+from pathlib import Path
+
+# 3rdparty
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+
+# sensor-harm
+from .benchmark import synthetic_band
+from .harmonization_model import DE2RA, calc_brf, calc_cfactor
+from .registry import brdf_coefficients, get_sensor
+
+SYNTHETIC_SCENE = 'LC08_L2SP_222081_20200101_20200110_02_T1'
+
+DEFAULT_CONFIGURATIONS = {
+    'scheduler': {'memory': '2G', 'workers': 2},
+    'int16': {'output_dtype': 'int16'},
+}
+
+
+def synthetic_landsat_scene(root, scene_id: str = SYNTHETIC_SCENE, size: int = 512, block: int = 256,
+                            seed: int = 0) -> Path:
+    """Create a small Landsat Collection 2 shaped scene (SR bands, angle bands and QA band).
+
+    The reflectance is scaled as Collection 2 DN, the scene footprint leaves a
+    nodata corner and the angles are smooth fields in hundredths of degree.
+
+    Args:
+        root (str): directory where the scene directory is created.
+        scene_id (str): Landsat scene identifier.
+        size (int): band width and height in pixels.
+        block (int): block size.
+        seed (int): random seed.
+
+    Returns:
+        Path: path to the scene directory.
+    """
+    scene_dir = Path(root) / scene_id
+    scene_dir.mkdir(parents=True, exist_ok=True)
+    profile = dict(driver='GTiff', width=size, height=size, count=1, crs='EPSG:32622', tiled=True,
+                   transform=from_origin(500000, 7000000, 30, 30), blockxsize=block, blockysize=block)
+    rows, cols = numpy.mgrid[0:size, 0:size]
+    outside = rows + cols < size // 4
+
+    for i, band in enumerate(['SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'SR_B7']):
+        reflectance = synthetic_band(size, seed=seed + i, dtype='float64') / 10000
+        dn = ((reflectance + 0.2) / 0.0000275).clip(1, 65535).astype('uint16')
+        dn[outside] = 0
+        with rasterio.open(str(scene_dir / f'{scene_id}_{band}.TIF'), 'w', dtype='uint16', nodata=0, **profile) as dst:
+            dst.write(dn, 1)
+
+    angles = dict(
+        SZA=3000 + 800 * rows / size,
+        SAA=11000 + 1500 * cols / size,
+        VZA=750 * numpy.abs(cols - size / 2) / (size / 2),
+        VAA=numpy.where(cols < size / 2, 10200, -7800),
+    )
+    for name, angle in angles.items():
+        with rasterio.open(str(scene_dir / f'{scene_id}_{name}.tif'), 'w', dtype='int16', **profile) as dst:
+            dst.write(angle.astype('int16'), 1)
+
+    qa = numpy.random.default_rng(seed).choice([21824, 21952, 22280, 55052], size=(size, size)).astype('uint16')
+    qa[outside] = 1
+    with rasterio.open(str(scene_dir / f'{scene_id}_QA_PIXEL.TIF'), 'w', dtype='uint16', nodata=1, **profile) as dst:
+        dst.write(qa, 1)
+
+    return scene_dir
+
+
+def reference_brf(view_zenith, solar_zenith, relative_azimuth, band_coef):
+    """Calculate the brf with the frozen Ross-Thick Li-Sparse kernels of the original calc_brf.
+
+    It is kept apart from the kernels of the harmonizers on purpose, as the reference they are checked against.
+    """
+    br_ratio, hb_ratio = 1.0, 2.0
+    theta_s_i = numpy.arctan(br_ratio * numpy.tan(solar_zenith))
+    theta_v_i = numpy.arctan(br_ratio * numpy.tan(view_zenith))
+    sec_s, sec_v = 1. / numpy.cos(theta_s_i), 1. / numpy.cos(theta_v_i)
+    d = numpy.sqrt(numpy.tan(theta_s_i) * numpy.tan(theta_s_i) + numpy.tan(theta_v_i) * numpy.tan(theta_v_i)
+                   - 2 * numpy.tan(theta_s_i) * numpy.tan(theta_v_i) * numpy.cos(relative_azimuth))
+    cos_t = hb_ratio * numpy.sqrt(
+        d * d + numpy.power(numpy.tan(theta_s_i) * numpy.tan(theta_v_i) * numpy.sin(relative_azimuth), 2)
+    ) / (sec_s + sec_v)
+    t = numpy.arccos(numpy.maximum(-1., numpy.minimum(1., cos_t)))
+    big_o = (1. / numpy.pi) * (t - numpy.sin(t) * cos_t) * (sec_v * sec_s)
+    cos_e_i = numpy.cos(theta_s_i) * numpy.cos(theta_v_i) + \
+        numpy.sin(theta_s_i) * numpy.sin(theta_v_i) * numpy.cos(relative_azimuth)
+    li = big_o - sec_s - sec_v + 0.5 * (1. + cos_e_i) * sec_v * sec_s
+
+    cos_e = numpy.cos(solar_zenith) * numpy.cos(view_zenith) + \
+        numpy.sin(solar_zenith) * numpy.sin(view_zenith) * numpy.cos(relative_azimuth)
+    e = numpy.arccos(cos_e)
+    ross = ((((numpy.pi / 2.) - e) * cos_e + numpy.sin(e)) / (numpy.cos(solar_zenith) + numpy.cos(view_zenith))) \
+        - (numpy.pi / 4)
+
+    return band_coef['fiso'] + band_coef['fvol'] * ross + band_coef['fgeo'] * li
+
+
+def reference_cfactor(view_zenith, solar_zenith, relative_azimuth, band_coef):
+    """Calculate the c-factor as the ratio of the frozen nadir and sensor brf."""
+    zeros = numpy.zeros(numpy.shape(view_zenith))
+    return reference_brf(zeros, solar_zenith, zeros, band_coef) / \
+        reference_brf(view_zenith, solar_zenith, relative_azimuth, band_coef)
+
+
+def reference_landsat(scene_id: str, product_dir, target_dir) -> Path:
+    """Harmonize a Landsat Collection 2 scene with the frozen masked array reference.
+
+    The bands (``SR_B*``) with BRDF coefficients and the angle bands (``SZA``, ``SAA``,
+    ``VZA``, ``VAA``) are read whole as masked arrays and the NBAR is written as
+    ``{scene_id}_NBAR_{band}.tif``, int32 truncated towards zero as the original path.
+
+    Args:
+        scene_id (str): Landsat Collection 2 scene identifier.
+        product_dir (str): directory of the scene bands and angle bands.
+        target_dir (str): output directory, the bands are written in its ``{scene_id}_NBAR`` directory.
+
+    Returns:
+        Path: directory of the reference bands.
+    """
+    product_dir = Path(product_dir)
+    target_dir = Path(target_dir) / f'{scene_id}_NBAR'
+    target_dir.mkdir(parents=True, exist_ok=True)
+    sensor = get_sensor(scene_id[:4])
+    nodata = 0
+
+    def read(path):
+        with rasterio.open(str(path)) as src:
+            return src.read(1, masked=True), src.profile
+
+    angles = {name: read(product_dir / f'{scene_id}_{name}.tif')[0] for name in ('SZA', 'SAA', 'VZA', 'VAA')}
+    relative_azimuth = numpy.divide(numpy.subtract(angles['VAA'], angles['SAA']), 100) * DE2RA
+    solar_zenith = numpy.divide(angles['SZA'], 100) * DE2RA
+    view_zenith = numpy.divide(angles['VZA'], 100) * DE2RA
+
+    for band_file in sorted(product_dir.glob(f'{scene_id}_SR_B*.TIF')):
+        band = band_file.stem[len(scene_id) + 1:]
+        band_coef = brdf_coefficients.get(sensor.common_name(band))
+        if band_coef is None:
+            continue
+        reflectance, profile = read(band_file)
+        # Rescale data to 0-10000 -> ((raster1_arr * 0.0000275)-0.2)
+        reflectance = (reflectance * 0.275) - 2000
+        nbar = reflectance * reference_cfactor(view_zenith, solar_zenith, relative_azimuth, band_coef)
+        nbar = numpy.ma.masked_invalid(nbar).filled(nodata).astype('int32')
+        output_file = target_dir / band_file.name.replace('_SR_', '_NBAR_').replace('.TIF', '.tif')
+        with rasterio.open(str(output_file), 'w', driver='GTiff', height=profile['height'], width=profile['width'],
+                           count=1, dtype='int32', crs=profile['crs'], transform=profile['transform'],
+                           nodata=nodata, compress='deflate') as dst:
+            dst.write(nbar, 1)
+    return target_dir
+
+
+def brf_errors(candidate=calc_brf, cfactor=calc_cfactor, samples: int = 100000, seed: int = 0) -> list:
+    """Compare a BRF and a c-factor function with the frozen reference on random Landsat and Sentinel-2 geometries.
+
+    Args:
+        candidate (function): function with the signature of calc_brf, compared with reference_brf.
+        cfactor (function): function with the signature of calc_cfactor (the kernel terms path),
+            compared with reference_cfactor.
+        samples (int): number of random geometries.
+        seed (int): random seed.
+
+    Returns:
+        list: one row (dict) per band common name with maximum absolute and relative errors of the brf
+            and of the c-factor.
+    """
+    rng = numpy.random.default_rng(seed)
+    view_zenith = rng.uniform(0, 15, samples) * DE2RA
+    solar_zenith = rng.uniform(0, 75, samples) * DE2RA
+    relative_azimuth = rng.uniform(-180, 180, samples) * DE2RA
+
+    def errors(values, reference):
+        error = numpy.abs(numpy.asarray(values, dtype='float64') - reference)
+        return float(error.max()), float((error / numpy.abs(reference)).max())
+
+    rows = []
+    for common_name, band_coef in brdf_coefficients.items():
+        max_abs, max_rel = errors(candidate(view_zenith, solar_zenith, relative_azimuth, band_coef),
+                                  reference_brf(view_zenith, solar_zenith, relative_azimuth, band_coef))
+        cfactor_abs, cfactor_rel = errors(cfactor(view_zenith, solar_zenith, relative_azimuth, band_coef),
+                                          reference_cfactor(view_zenith, solar_zenith, relative_azimuth, band_coef))
+        rows.append(dict(band=common_name, max_abs=max_abs, max_rel=max_rel, cfactor_max_abs=cfactor_abs,
+                         cfactor_max_rel=cfactor_rel))
+    return rows
+
+
+def band_errors(reference: numpy.ndarray, candidate: numpy.ndarray, nodata=0) -> dict:
+    """Compute the DN errors of a candidate band against the reference band.
+
+    Returns:
+        dict: max_abs and mean_abs DN errors over the valid reference pixels, share of changed pixels
+            and number of pixels whose nodata state differs.
+    """
+    if reference.shape != candidate.shape:
+        raise RuntimeError(f'Band shapes differ: {reference.shape} and {candidate.shape}')
+    valid = reference != nodata
+    error = numpy.abs(candidate.astype('float64') - reference)[valid]
+    return dict(
+        max_abs=float(error.max()) if error.size else 0.,
+        mean_abs=float(error.mean()) if error.size else 0.,
+        changed=float((reference != candidate).mean()),
+        nodata_mismatch=int((valid != (candidate != nodata)).sum()),
+    )
+
+
+def compare_outputs(reference_dir, candidate_dir) -> list:
+    """Compare the NBAR bands (*_NBAR_*.tif) of two output directories.
+
+    Returns:
+        list: one row (dict) per band with the band_errors.
+    """
+    reference_dir, candidate_dir = Path(reference_dir), Path(candidate_dir)
+    rows = []
+    for reference_file in sorted(reference_dir.glob('*_NBAR_*.tif')):
+        candidate_file = candidate_dir / reference_file.name
+        if not candidate_file.exists():
+            raise RuntimeError(f'Missing band {reference_file.name} in {candidate_dir}')
+        with rasterio.open(str(reference_file)) as ref, rasterio.open(str(candidate_file)) as cand:
+            errors = band_errors(ref.read(1), cand.read(1), ref.nodata if ref.nodata is not None else 0)
+        rows.append(dict(band=reference_file.stem.rsplit('_', 1)[-1], **errors))
+    return rows
+
+
+def run_configuration(harmonizer, target_dir, options: dict):
+    """Run a harmonizer configuration.
+
+    Args:
+        harmonizer (function): harmonizer accepting the target directory and the configuration keywords,
+            returning the output directory (or a tuple starting with it).
+        target_dir (str): output directory.
+        options (dict): configuration keywords, ``memory`` and ``workers`` create a scheduler.
+
+    Returns:
+        Path, float: output directory and elapsed seconds.
+    """
+    options = dict(options)
+    memory, workers = options.pop('memory', None), options.pop('workers', 1)
+    scheduler = None
+    if memory is not None:
+        from .scheduler import Scheduler
+        scheduler = Scheduler(memory, workers=workers)
+        options['scheduler'] = scheduler
+
+    start = time.perf_counter()
+    try:
+        output = harmonizer(target_dir, **options)
+    finally:
+        if scheduler is not None:
+            scheduler.shutdown()
+    elapsed = time.perf_counter() - start
+    return Path(output[0] if isinstance(output, tuple) else output), elapsed
+
+
+def accuracy_report(work_dir, configurations=None, harmonizer=None, reference=None, max_abs: float = 1,
+                    mean_abs: float = 0.1, changed: float = 0.01) -> list:
+    """Run the reference, the default and the alternative configurations and compare their outputs.
+
+    Args:
+        work_dir (str): directory of the outputs (and of the synthetic scene).
+        configurations (dict): keyword arguments by configuration name, run after the ``default``
+            configuration (no keywords). Defaults to DEFAULT_CONFIGURATIONS.
+        harmonizer (function): harmonizer of the target directory, e.g.
+            ``functools.partial(landsat_harmonize, scene_id, product_dir)``. Defaults to a synthetic Landsat scene.
+        reference (function): function of the target directory writing the pinned reference outputs and
+            returning their directory, e.g. ``functools.partial(reference_landsat, scene_id, product_dir)``.
+            Defaults to the reference of the synthetic scene, required with a harmonizer.
+        max_abs (float): maximum absolute DN error threshold.
+        mean_abs (float): mean absolute DN error threshold.
+        changed (float): share of changed pixels threshold.
+
+    Returns:
+        list: one row (dict) per configuration and band with the errors, the throughput and ``passed``.
+    """
+    work_dir = Path(work_dir)
+    configurations = DEFAULT_CONFIGURATIONS if configurations is None else configurations
+    configurations = {'default': {}, **configurations}
+    if harmonizer is None:
+        from .landsat import landsat_harmonize
+        scene_dir = synthetic_landsat_scene(work_dir / 'input')
+        harmonizer = partial(landsat_harmonize, scene_dir.name, scene_dir, cp_quality_band=False)
+        reference = reference or partial(reference_landsat, scene_dir.name, scene_dir)
+    if reference is None:
+        raise RuntimeError('The reference of the harmonizer is required, e.g. reference_landsat')
+
+    reference_dir, reference_time = run_configuration(reference, work_dir / 'reference', {})
+    megapixels = 0
+    for band_file in reference_dir.glob('*_NBAR_*.tif'):
+        with rasterio.open(str(band_file)) as src:
+            megapixels += src.width * src.height / 1e6
+
+    rows = [dict(configuration='reference', band='all', max_abs=0., mean_abs=0., changed=0., nodata_mismatch=0,
+                 seconds=reference_time, Mpx_per_s=megapixels / reference_time, speedup=1., passed=True)]
+    for name, options in configurations.items():
+        logging.info(f'Running configuration {name} {options}')
+        output_dir, elapsed = run_configuration(harmonizer, work_dir / name, options)
+        for errors in compare_outputs(reference_dir, output_dir):
+            passed = (errors['max_abs'] <= max_abs and errors['mean_abs'] <= mean_abs
+                      and errors['changed'] <= changed and errors['nodata_mismatch'] == 0)
+            rows.append(dict(configuration=name, **errors, seconds=elapsed, Mpx_per_s=megapixels / elapsed,
+                             speedup=reference_time / elapsed, passed=passed))
+        shutil.rmtree(str(work_dir / name), ignore_errors=True)
+    return rows
+
+
+def check_accuracy(rows: list):
+    """Raise a RuntimeError listing the configuration bands over the accuracy thresholds."""
+    failed = [f'{row["configuration"]}/{row["band"]}' for row in rows if not row['passed']]
+    if failed:
+        raise RuntimeError(f'Accuracy thresholds exceeded by {", ".join(failed)}')
@@ -0,0 +1,254 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the asyncio API of the harmonizers.
+
+An AsyncHarmonizer runs the harmonizers from an event loop without blocking
+it. The scenes run in a thread pool (at most ``scenes`` at once) and their
+bands in a shared memory-budgeted Scheduler, with threads or processes. The
+events of a scene (windows and bands done, then its result) are streamed to
+the loop, and cancelling the consumer stops the bands between two windows::
+
+    async with AsyncHarmonizer('8G', workers=4, scenes=2) as harmonizer:
+        async for event in harmonizer.events(landsat_harmonize, scene_id, product_dir, target_dir):
+            print(event)
+
+Events are dicts::
+
+    {"event": "window", "band": "sr_band4", "done": 3, "windows": 16}
+        before each window of a band and once it is done (thread workers only).
+    {"event": "band", "result": {"sr_band4": "/data/nbar/..._NBAR.tif"}}
+        when a band task is done, with its result (a shard part file for row shards).
+    {"event": "done", "result": ...}
+        last event, with the result of the harmonizer.
+
+With process workers, a cancelled scene stops submitting its bands and
+cancels those waiting, the running bands are completed.
+"""
+
+# Python Native
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# sensor-harm
+from .harmonization_model import window_progress
+from .landsat import landsat_harmonize
+from .scheduler import Scheduler
+from .sentinel2 import sentinel_harmonize
+
+
+class SceneScheduler:
+    """Scheduler stand-in of a scene, running its band tasks in a shared Scheduler and reporting their events.
+
+    The harmonizers hand their band tasks to ``run``, as to a Scheduler.
+    """
+
+    def __init__(self, scheduler: Scheduler, emit, cancelled: threading.Event):
+        """Create the scheduler of a scene.
+
+        Args:
+            scheduler (Scheduler): scheduler running the band tasks.
+            emit (callable): function receiving the events (dict), called from the worker threads.
+            cancelled (threading.Event): set to stop the scene.
+        """
+        self.scheduler = scheduler
+        self.processes = scheduler.processes
+        self.emit = emit
+        self.cancelled = cancelled
+
+    def _check(self):
+        if self.cancelled.is_set():
+            raise RuntimeError('Harmonization cancelled')
+
+    def _progress(self, band, done, windows):
+        self._check()
+        self.emit(dict(event='window', band=band, done=done, windows=windows))
+
+    def _run(self, fn, args, kwargs):
+        with window_progress(self._progress):
+            return fn(*args, **kwargs)
+
+    def _done(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.emit(dict(event='band', result=future.result()))
+
+    def run(self, tasks) -> list:
+        """Run tasks (footprint, function, args, kwargs) and return their results in order."""
+        futures = []
+        try:
+            for footprint, fn, args, kwargs in tasks:
+                self._check()
+                # The window progress is reported by the threads of this process only
+                if self.processes:
+                    future = self.scheduler.submit(footprint, fn, *args, **kwargs)
+                else:
+                    future = self.scheduler.submit(footprint, self._run, fn, args, kwargs)
+                future.add_done_callback(self._done)
+                futures.append(future)
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+class AsyncHarmonizer:
+    """Run harmonizations from an asyncio event loop, with their bands in a shared memory-budgeted scheduler."""
+
+    def __init__(self, memory_budget='4G', workers: int = 1, processes: bool = False, scenes: int = 1,
+                 scheduler: Scheduler = None):
+        """Create an asynchronous harmonizer.
+
+        Args:
+            memory_budget (int|str): memory budget of the band scheduler, e.g. '8G'.
+            workers (int): maximum number of bands running at once, for all the scenes.
+            processes (bool): run the bands in processes instead of threads.
+            scenes (int): maximum number of scenes harmonized at once, the others wait for a slot.
+            scheduler (Scheduler): band scheduler used instead of memory_budget, workers and processes.
+                It is not shut down by the harmonizer.
+        """
+        self.scheduler = scheduler or Scheduler(memory_budget, workers=workers, processes=processes)
+        self._owned = scheduler is None
+        self.scenes = scenes
+        self._pool = ThreadPoolExecutor(max_workers=scenes)
+        self._slots = None
+
+    async def events(self, fn, *args, **kwargs):
+        """Harmonize a scene and stream its events, see the module documentation.
+
+        Closing the stream (or cancelling its consumer) before the last event cancels the harmonization.
+
+        Args:
+            fn (callable): harmonizer accepting a ``scheduler`` keyword, e.g. landsat_harmonize or
+                sentinel_harmonize.
+            args (list): arguments of fn.
+            kwargs (dict): keywords of fn.
+
+        Yields:
+            dict: events of the scene, the last one is the 'done' event with the result of fn.
+        """
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.scenes)
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+        scheduler = SceneScheduler(self.scheduler, lambda event: loop.call_soon_threadsafe(queue.put_nowait, event),
+                                   cancelled)
+
+        async with self._slots:
+            future = loop.run_in_executor(self._pool, functools.partial(fn, *args, scheduler=scheduler, **kwargs))
+            # The events are delivered in order, before the completion of future
+            future.add_done_callback(lambda _: queue.put_nowait(None))
+            try:
+                event = await queue.get()
+                while event is not None:
+                    yield event
+                    event = await queue.get()
+                result = await future
+            finally:
+                if not future.done():
+                    # The scene slot is released once its bands are stopped
+                    cancelled.set()
+                    await asyncio.wait([future])
+                    if not future.cancelled():
+                        future.exception()
+        yield dict(event='done', result=result)
+
+    async def run(self, fn, *args, on_event=None, **kwargs):
+        """Harmonize a scene and return the result of the harmonizer.
+
+        Args:
+            fn (callable): harmonizer, see events.
+            args (list): arguments of fn.
+            on_event (callable): function receiving the events of the scene, e.g. to report its progress.
+            kwargs (dict): keywords of fn.
+
+        Returns:
+            The result of fn.
+        """
+        events = self.events(fn, *args, **kwargs)
+        try:
+            async for event in events:
+                if on_event is not None:
+                    on_event(event)
+                if event['event'] == 'done':
+                    return event['result']
+        finally:
+            await events.aclose()
+
+    def shutdown(self, wait: bool = True):
+        """Shutdown the scene pool and the band scheduler, unless it was given."""
+        self._pool.shutdown(wait=wait)
+        if self._owned:
+            self.scheduler.shutdown(wait=wait)
+
+    async def __aenter__(self):
+        """Enter the harmonizer context."""
+        return self
+
+    async def __aexit__(self, *args):
+        """Shutdown the harmonizer, without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+
+
+async def landsat_harmonize_async(scene_id, product_dir, target_dir=None, harmonizer: AsyncHarmonizer = None,
+                                  on_event=None, **kwargs):
+    """Harmonize a Landsat scene from an event loop, see landsat_harmonize.
+
+    Args:
+        scene_id (str): the Landsat scene identifier.
+        product_dir (str): path to directory containing original bands.
+        target_dir (str): path to output result images.
+        harmonizer (AsyncHarmonizer): harmonizer shared by the scenes. Default runs the scene alone.
+        on_event (callable): function receiving the events of the scene.
+        kwargs (dict): keywords of landsat_harmonize.
+
+    Returns:
+        The result of landsat_harmonize.
+    """
+    if harmonizer is not None:
+        return await harmonizer.run(landsat_harmonize, scene_id, product_dir, target_dir, on_event=on_event,
+                                    **kwargs)
+    async with AsyncHarmonizer() as harmonizer:
+        return await harmonizer.run(landsat_harmonize, scene_id, product_dir, target_dir, on_event=on_event,
+                                    **kwargs)
+
+
+async def sentinel_harmonize_async(sentinel2_entry, target_dir, apply_bandpass=True,
+                                   harmonizer: AsyncHarmonizer = None, on_event=None, **kwargs):
+    """Harmonize a Sentinel-2 scene from an event loop, see sentinel_harmonize.
+
+    Args:
+        sentinel2_entry (str): path to the Sen2cor .SAFE or LaSRC directory.
+        target_dir (str): path to output result images.
+        apply_bandpass (bool): apply the band pass processing.
+        harmonizer (AsyncHarmonizer): harmonizer shared by the scenes. Default runs the scene alone.
+        on_event (callable): function receiving the events of the scene.
+        kwargs (dict): keywords of sentinel_harmonize.
+
+    Returns:
+        The result of sentinel_harmonize.
+    """
+    if harmonizer is not None:
+        return await harmonizer.run(sentinel_harmonize, sentinel2_entry, target_dir, apply_bandpass,
+                                    on_event=on_event, **kwargs)
+    async with AsyncHarmonizer() as harmonizer:
+        return await harmonizer.run(sentinel_harmonize, sentinel2_entry, target_dir, apply_bandpass,
+                                    on_event=on_event, **kwargs)
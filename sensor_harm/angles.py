@@ -0,0 +1,393 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the angle providers used in data harmonization.
+
+An angle provider returns the view zenith, solar zenith and relative azimuth
+angles (in radians) of a band window, either by reading angle bands from disk
+or by computing them on the fly from the scene metadata.
+"""
+
+# Python Native
+import abc
+import logging
+import re
+import xml.etree.ElementTree as ElementTree
+
+# 3rdparty
+import numpy
+
+# sensor-harm
+from .harmonization_model import prepare_angles
+from .storage import read_bytes, read_text
+
+
+class AngleProvider(abc.ABC):
+    """Base class of angle providers."""
+
+    @abc.abstractmethod
+    def read(self, band, window):
+        """Retrieve the angles of a band window.
+
+        Args:
+            band (str): band.
+            window (Window): rasterio window in band pixel coordinates.
+
+        Returns:
+            raster, raster, raster: numpy.array (view_zenith, solar_zenith, relative_azimuth) in radians,
+                NaN at nodata pixels.
+        """
+
+
+class AngleFiles(AngleProvider):
+    """Angle provider reading precomputed angle bands scaled to hundredths of degree."""
+
+    def __init__(self, sz_path, sa_path, vz_path, va_path, satsen):
+        """Create an angle provider from the angle band files.
+
+        Args:
+            sz_path (str): path to solar zenith file.
+            sa_path (str): path to solar azimuth file.
+            vz_path (str): path to view (sensor) zenith file.
+            va_path (str): path to view (sensor) azimuth file.
+            satsen (str): satellite sensor.
+        """
+        self.sz_path = sz_path
+        self.sa_path = sa_path
+        self.vz_path = vz_path
+        self.va_path = va_path
+        self.satsen = satsen
+
+    def read(self, band, window):
+        """Read the angle bands window, convert to radians and calculate the relative azimuth."""
+        return prepare_angles(self.sz_path, self.sa_path, self.vz_path, self.va_path, self.satsen, band, window)
+
+
+def _parse_odl_value(value: str):
+    """Parse an ODL value into a float, a tuple of floats or a string."""
+    value = value.strip()
+    if value.startswith('('):
+        return tuple(float(v) for v in value.strip('()').split(',') if v.strip())
+    if value.startswith('"'):
+        return value.strip('"')
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_odl(file_path) -> dict:
+    """Parse a Landsat ODL metadata file (MTL.txt, ANG.txt) into nested dictionaries.
+
+    Args:
+        file_path (str): path to metadata file, local or in object storage.
+
+    Returns:
+        dict: groups as nested dictionaries of parsed values.
+    """
+    root = {}
+    stack = [root]
+    pending_key, pending_value = None, ''
+
+    for line in read_text(file_path).splitlines():
+        line = line.strip()
+        if pending_key is not None:
+            pending_value += line
+            if ')' in line:
+                stack[-1][pending_key] = _parse_odl_value(pending_value)
+                pending_key = None
+            continue
+        if not line or line == 'END' or '=' not in line:
+            continue
+
+        key, value = (item.strip() for item in line.split('=', 1))
+        if key == 'GROUP':
+            group = {}
+            stack[-1][value] = group
+            stack.append(group)
+        elif key == 'END_GROUP':
+            stack.pop()
+        elif value.startswith('(') and ')' not in value:
+            pending_key, pending_value = key, value
+        else:
+            stack[-1][key] = _parse_odl_value(value)
+
+    return root
+
+
+def _rpc_terms(line, samp, height, count, constant=True):
+    """Build the polynomial terms of a rational polynomial in (line, sample, height)."""
+    terms = [line, samp, height, line * samp, line * height, samp * height, line * line, samp * samp, height * height]
+    if constant:
+        terms = [1.] + terms
+    return terms[:count]
+
+
+def _rational(num, den, line, samp, height):
+    """Evaluate a rational polynomial with an implicit 1 on the denominator."""
+    numerator = sum(c * t for c, t in zip(num, _rpc_terms(line, samp, height, len(num))))
+    denominator = 1. + sum(c * t for c, t in zip(den, _rpc_terms(line, samp, height, len(den), constant=False)))
+    return numerator / denominator
+
+
+class LandsatANGAngles(AngleProvider):
+    """Angle provider computing Landsat angles from the ANG.txt rational polynomial coefficients.
+
+    For each pixel, the L1T line/sample is mapped to the L1R line/sample of the
+    detector (SCA) which observed it and the band satellite and sun vectors are
+    evaluated in the local frame (x east, y north, z up). Pixels observed by two
+    overlapping SCAs are averaged, like the USGS angle generation tool does.
+    """
+
+    def __init__(self, ang_path, height=None):
+        """Create an angle provider from a Landsat angle coefficient file.
+
+        Args:
+            ang_path (str): path to *_ANG.txt file.
+            height (float): pixel elevation. Defaults to the mean height of each band.
+        """
+        self.ang_path = ang_path
+        self.height = height
+        self._metadata = parse_odl(ang_path)
+        self._bands = {}
+
+    @staticmethod
+    def band_number(band: str) -> int:
+        """Retrieve the band number of a Landsat band name, e.g. 'SR_B5' or 'sr_band5'."""
+        match = re.search(r'(\d+)$', band)
+        if not match:
+            raise RuntimeError(f'Could not find the band number of {band}')
+        return int(match.group(1))
+
+    def _band_rpc(self, band):
+        """Retrieve the (cached) rational polynomial coefficients of a band."""
+        number = self.band_number(band)
+        if number not in self._bands:
+            prefix = f'BAND{number:02d}'
+            try:
+                group = self._metadata[f'RPC_{prefix}']
+            except KeyError:
+                raise RuntimeError(f'Missing RPC_{prefix} coefficients on {self.ang_path}')
+
+            rpc = {key[len(prefix) + 1:]: value for key, value in group.items()}
+            rpc['SCAS'] = [
+                {key[len(prefix) + 7:]: value for key, value in group.items() if key.startswith(f'{prefix}_SCA{sca:02d}_')}
+                for sca in range(1, int(rpc['NUM_SCA']) + 1)
+            ]
+            self._bands[number] = rpc
+        return self._bands[number]
+
+    def _l1r(self, rpc, lines, samps):
+        """Map L1T lines/samples to the L1R lines/samples of the observing SCAs.
+
+        Returns:
+            list: (l1r_line, l1r_samp, valid) per SCA.
+        """
+        num_samps = rpc.get('NUM_L1R_SAMPS')
+        result = []
+        for sca in rpc['SCAS']:
+            height = (self.height if self.height is not None else sca['MEAN_HEIGHT']) - sca['MEAN_HEIGHT']
+            line = lines - sca['MEAN_L1T_LINE_SAMP'][0]
+            samp = samps - sca['MEAN_L1T_LINE_SAMP'][1]
+            l1r_line = sca['MEAN_L1R_LINE_SAMP'][0] + _rational(sca['LINE_NUM_COEF'], sca['LINE_DEN_COEF'], line, samp, height)
+            l1r_samp = sca['MEAN_L1R_LINE_SAMP'][1] + _rational(sca['SAMP_NUM_COEF'], sca['SAMP_DEN_COEF'], line, samp, height)
+            if num_samps is not None:
+                valid = (l1r_samp >= 0) & (l1r_samp < num_samps)
+            else:
+                valid = numpy.abs(l1r_samp - sca['MEAN_L1R_LINE_SAMP'][1]) <= sca['MEAN_L1R_LINE_SAMP'][1]
+            result.append((l1r_line, l1r_samp, valid))
+        return result
+
+    def _angles(self, rpc, l1r, kind):
+        """Evaluate zenith and azimuth (radians) of the satellite ('SAT') or sun ('SUN') vector."""
+        height = (self.height if self.height is not None else rpc['MEAN_HEIGHT']) - rpc['MEAN_HEIGHT']
+        mean_vector = rpc[f'MEAN_{kind}_VECTOR']
+        shape = l1r[0][0].shape
+        vector = numpy.zeros((3,) + shape)
+        count = numpy.zeros(shape)
+        nearest_distance = numpy.full(shape, numpy.inf)
+        nearest_vector = numpy.zeros((3,) + shape)
+
+        for sca, (l1r_line, l1r_samp, valid) in zip(rpc['SCAS'], l1r):
+            line = l1r_line - rpc['MEAN_L1R_LINE_SAMP'][0]
+            samp = l1r_samp - rpc['MEAN_L1R_LINE_SAMP'][1]
+            sca_vector = numpy.stack([
+                mean_vector[i] + _rational(rpc[f'{kind}_{axis}_NUM_COEF'], rpc[f'{kind}_{axis}_DEN_COEF'], line, samp, height)
+                for i, axis in enumerate('XYZ')
+            ])
+            vector += numpy.where(valid, sca_vector, 0.)
+            count += valid
+
+            # Pixels outside every SCA footprint (scene fill) use the nearest SCA
+            distance = numpy.abs(l1r_samp - sca['MEAN_L1R_LINE_SAMP'][1])
+            nearest = distance < nearest_distance
+            nearest_distance = numpy.where(nearest, distance, nearest_distance)
+            nearest_vector = numpy.where(nearest, sca_vector, nearest_vector)
+
+        vector = numpy.where(count > 0, vector / numpy.maximum(count, 1), nearest_vector)
+        norm = numpy.sqrt((vector * vector).sum(axis=0))
+        zenith = numpy.arccos(numpy.clip(vector[2] / norm, -1., 1.))
+        azimuth = numpy.arctan2(vector[0], vector[1])
+
+        return zenith, azimuth
+
+    def read(self, band, window):
+        """Compute the angles of a band window from the rational polynomial coefficients."""
+        rpc = self._band_rpc(band)
+        lines, samps = numpy.mgrid[
+            window.row_off: window.row_off + window.height,
+            window.col_off: window.col_off + window.width
+        ].astype('float64')
+        logging.debug(f'Computing angles of band {band} window {window} from {self.ang_path}')
+
+        l1r = self._l1r(rpc, lines, samps)
+        view_zenith, view_azimuth = self._angles(rpc, l1r, 'SAT')
+        solar_zenith, solar_azimuth = self._angles(rpc, l1r, 'SUN')
+
+        return view_zenith, solar_zenith, view_azimuth - solar_azimuth
+
+
+# Sentinel-2 band identifiers (bandId) on MTD_TL.xml
+SENTINEL2_BAND_IDS = {
+    'B01': 0, 'B02': 1, 'B03': 2, 'B04': 3, 'B05': 4, 'B06': 5, 'B07': 6,
+    'B08': 7, 'B8A': 8, 'B09': 9, 'B10': 10, 'B11': 11, 'B12': 12,
+    'sr_band1': 0, 'sr_band2': 1, 'sr_band3': 2, 'sr_band4': 3, 'sr_band5': 4, 'sr_band6': 5, 'sr_band7': 6,
+    'sr_band8': 7, 'sr_band8a': 8, 'sr_band9': 9, 'sr_band10': 10, 'sr_band11': 11, 'sr_band12': 12,
+}
+
+# Sentinel-2 bands processed at 20 m
+SENTINEL2_20M_BANDS = ['B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'sr_band8a', 'sr_band11', 'sr_band12']
+
+
+def _local_name(element):
+    """Retrieve the tag of a XML element without namespace."""
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _find(element, name):
+    """Find the first descendant of a XML element by tag name, ignoring namespaces."""
+    return next((item for item in element.iter() if _local_name(item) == name), None)
+
+
+def _angle_grid(element):
+    """Parse a Sentinel-2 angle grid (Zenith or Azimuth) into a numpy array in degrees."""
+    values = _find(element, 'Values_List')
+    return numpy.array([
+        [float(v) for v in row.text.split()] for row in values if _local_name(row) == 'VALUES'
+    ])
+
+
+def _to_vector(zenith, azimuth):
+    """Convert zenith/azimuth degree grids to unit vectors (x east, y north, z up)."""
+    zenith, azimuth = numpy.radians(zenith), numpy.radians(azimuth)
+    return numpy.stack([numpy.sin(zenith) * numpy.sin(azimuth),
+                        numpy.sin(zenith) * numpy.cos(azimuth),
+                        numpy.cos(zenith)])
+
+
+def _fill_nearest(vector):
+    """Fill the invalid (NaN) nodes of a vector grid with the mean of their valid neighbours."""
+    vector = vector.copy()
+    invalid = numpy.isnan(vector[0])
+    while invalid.any() and not invalid.all():
+        padded = numpy.pad(vector, ((0, 0), (1, 1), (1, 1)), constant_values=numpy.nan)
+        neighbours = numpy.stack([
+            padded[:, 1 + dr: padded.shape[1] - 1 + dr, 1 + dc: padded.shape[2] - 1 + dc]
+            for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc
+        ])
+        count = (~numpy.isnan(neighbours[:, 0])).sum(axis=0)
+        mean = numpy.nansum(neighbours, axis=0) / numpy.maximum(count, 1)
+        fill = invalid & (count > 0)
+        vector[:, fill] = mean[:, fill]
+        invalid = numpy.isnan(vector[0])
+    return vector
+
+
+class Sentinel2MetadataAngles(AngleProvider):
+    """Angle provider interpolating Sentinel-2 angles from the tile metadata (MTD_TL.xml) grids.
+
+    The sun and viewing incidence angle grids (5 km step) are parsed once. The
+    viewing grids of all detectors of a band are merged and, like the sun grid,
+    bilinearly interpolated as unit vectors on exactly the window being processed,
+    at the band resolution (10 m or 20 m).
+    """
+
+    def __init__(self, mtd_path, resolutions=None):
+        """Create an angle provider from a Sentinel-2 tile metadata file.
+
+        Args:
+            mtd_path (str): path to MTD_TL.xml file.
+            resolutions (dict): pixel size (meters) by band. Defaults to 20 m for
+                SENTINEL2_20M_BANDS and 10 m for the others.
+        """
+        self.mtd_path = mtd_path
+        self.resolutions = resolutions or {}
+        root = ElementTree.fromstring(read_bytes(mtd_path))
+
+        sun = _find(root, 'Sun_Angles_Grid')
+        self.step = float(_find(_find(sun, 'Zenith'), 'COL_STEP').text)
+        self._sun = _fill_nearest(_to_vector(_angle_grid(_find(sun, 'Zenith')), _angle_grid(_find(sun, 'Azimuth'))))
+
+        detectors = {}
+        for grid in root.iter():
+            if _local_name(grid) != 'Viewing_Incidence_Angles_Grids':
+                continue
+            vector = _to_vector(_angle_grid(_find(grid, 'Zenith')), _angle_grid(_find(grid, 'Azimuth')))
+            detectors.setdefault(int(grid.get('bandId')), []).append(vector)
+        if not detectors:
+            raise RuntimeError(f'Missing Viewing_Incidence_Angles_Grids on {mtd_path}')
+
+        self._view = {
+            band_id: _fill_nearest(numpy.nanmean(numpy.stack(vectors), axis=0))
+            for band_id, vectors in detectors.items()
+        }
+        self._view_mean = _fill_nearest(numpy.nanmean(numpy.stack(list(self._view.values())), axis=0))
+
+    def resolution(self, band: str) -> float:
+        """Retrieve the pixel size (meters) of a band."""
+        return self.resolutions.get(band, 20. if band in SENTINEL2_20M_BANDS else 10.)
+
+    def _interpolate(self, vector, rows, cols):
+        """Interpolate a vector grid on fractional grid rows/cols and convert to zenith/azimuth (radians)."""
+        size_y, size_x = vector.shape[1:]
+        r0 = numpy.clip(numpy.floor(rows).astype(int), 0, size_y - 2)
+        c0 = numpy.clip(numpy.floor(cols).astype(int), 0, size_x - 2)
+        fr = numpy.clip(rows - r0, 0., 1.)[:, None]
+        fc = numpy.clip(cols - c0, 0., 1.)[None, :]
+
+        top = vector[:, r0][:, :, c0] * (1 - fc) + vector[:, r0][:, :, c0 + 1] * fc
+        bottom = vector[:, r0 + 1][:, :, c0] * (1 - fc) + vector[:, r0 + 1][:, :, c0 + 1] * fc
+        x, y, z = top * (1 - fr) + bottom * fr
+
+        zenith = numpy.arctan2(numpy.sqrt(x * x + y * y), z)
+        azimuth = numpy.arctan2(x, y)
+        return zenith, azimuth
+
+    def read(self, band, window):
+        """Interpolate the angles of a band window from the metadata grids."""
+        resolution = self.resolution(band)
+        # Pixel centers on the angle grid coordinates (nodes at ULX + i * step)
+        rows = (numpy.arange(window.row_off, window.row_off + window.height) + 0.5) * resolution / self.step
+        cols = (numpy.arange(window.col_off, window.col_off + window.width) + 0.5) * resolution / self.step
+        logging.debug(f'Interpolating angles of band {band} window {window} from {self.mtd_path}')
+
+        view = self._view.get(SENTINEL2_BAND_IDS.get(band), self._view_mean)
+        view_zenith, view_azimuth = self._interpolate(view, rows, cols)
+        solar_zenith, solar_azimuth = self._interpolate(self._sun, rows, cols)
+
+        return view_zenith, solar_zenith, view_azimuth - solar_azimuth
@@ -0,0 +1,391 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define benchmarks of the harmonization I/O paths."""
+
+# Python Native
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+# 3rdparty
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+
+
+def synthetic_band(size: int, seed: int = 0, dtype='int32') -> numpy.ndarray:
+    """Create a reflectance-like band (smooth field plus noise) in the 0-10000 range."""
+    rng = numpy.random.default_rng(seed)
+    rows, cols = numpy.mgrid[0:size, 0:size] / size
+    field = 3000 + 2000 * numpy.sin(6 * rows) * numpy.cos(4 * cols)
+    return (field + rng.normal(0, 150, (size, size))).clip(0, 10000).astype(dtype)
+
+
+def _directory_size(path) -> int:
+    """Retrieve the size in bytes of a file or of a directory tree."""
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(item.stat().st_size for item in path.rglob('*') if item.is_file())
+
+
+def benchmark_outputs(work_dir, bands: int = 7, size: int = 5490, block: int = 512, dtype='int32') -> list:
+    """Compare write/read throughput of one GeoTIFF per band against a single chunked Zarr store.
+
+    Args:
+        work_dir (str): directory for the temporary outputs.
+        bands (int): number of bands.
+        size (int): band width and height in pixels.
+        block (int): GeoTIFF block and Zarr chunk size.
+        dtype (str): output data type.
+
+    Returns:
+        list: one row (dict) per output format.
+    """
+    from .zarr_store import ZarrStore
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    data = [synthetic_band(size, seed=i, dtype=dtype) for i in range(bands)]
+    transform = from_origin(500000, 9000000, 10, 10)
+    crs = rasterio.crs.CRS.from_epsg(32723)
+    megabytes = sum(band.nbytes for band in data) / 1024 ** 2
+    rows = []
+
+    # GeoTIFF, one deflate tiled file per band
+    gtiff_dir = work_dir / 'gtiff'
+    gtiff_dir.mkdir(exist_ok=True)
+    start = time.perf_counter()
+    for i, band in enumerate(data):
+        with rasterio.open(str(gtiff_dir / f'band{i}_NBAR.tif'), 'w', driver='GTiff', height=size, width=size, count=1,
+                           dtype=dtype, crs=crs, transform=transform, nodata=0, compress='deflate', tiled=True,
+                           blockxsize=block, blockysize=block) as dst:
+            dst.write(band, 1)
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(bands):
+        with rasterio.open(str(gtiff_dir / f'band{i}_NBAR.tif')) as src:
+            src.read(1)
+    read_time = time.perf_counter() - start
+    rows.append(dict(format='GTiff', write_s=write_time, write_MBps=megabytes / write_time, read_s=read_time,
+                     read_MBps=megabytes / read_time, size_MB=_directory_size(gtiff_dir) / 1024 ** 2))
+
+    # Zarr, one store with all bands
+    store = ZarrStore(work_dir / 'nbar.zarr')
+    time_index = store.scene_index('benchmark')
+    start = time.perf_counter()
+    for i, band in enumerate(data):
+        store.create_band(f'band{i}', size, size, dtype, 0, transform, crs, (block, block))
+        store.write(f'band{i}', time_index, band)
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(bands):
+        store.read(f'band{i}', time_index)
+    read_time = time.perf_counter() - start
+    rows.append(dict(format='Zarr', write_s=write_time, write_MBps=megabytes / write_time, read_s=read_time,
+                     read_MBps=megabytes / read_time, size_MB=_directory_size(store.path) / 1024 ** 2))
+
+    shutil.rmtree(str(gtiff_dir), ignore_errors=True)
+    shutil.rmtree(store.path, ignore_errors=True)
+    return rows
+
+
+def benchmark_jp2(img_path, work_dir=None, threads='ALL_CPUS') -> list:
+    """Compare the JPEG2000 decode strategies reading every block window of a band (e.g. a full granule band).
+
+    The strategies are: reopening the file for each window (the former behaviour),
+    keeping it open with a single decoding thread, keeping it open with the tile
+    aligned multi-threaded decoding ('open') and the one-shot GeoTIFF transcode
+    ('transcode').
+
+    Args:
+        img_path (str): path to JPEG2000 file.
+        work_dir (str): directory of the transcoded GeoTIFF.
+        threads (int|str): number of decoding threads or 'ALL_CPUS'.
+
+    Returns:
+        list: one row (dict) per strategy.
+    """
+    from .jp2 import jp2_env, open_jp2, open_reflectance
+
+    with rasterio.open(str(img_path)) as src:
+        windows = [window for _, window in src.block_windows()]
+    megapixels = sum(int(w.width) * int(w.height) for w in windows) / 1e6
+    rows = []
+
+    def _row(strategy, elapsed):
+        rows.append(dict(strategy=strategy, windows=len(windows), seconds=elapsed, Mpx_per_s=megapixels / elapsed))
+
+    start = time.perf_counter()
+    with jp2_env(1):
+        for window in windows:
+            with rasterio.open(str(img_path)) as src:
+                src.read(1, window=window)
+    _row('reopen', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with jp2_env(1), open_jp2(img_path) as src:
+        for _, window in src.block_windows():
+            src.read(1, window=window)
+    _row('open-1-thread', time.perf_counter() - start)
+
+    for strategy in ('open', 'transcode'):
+        start = time.perf_counter()
+        with open_reflectance(img_path, strategy, tmp_dir=work_dir, threads=threads) as src:
+            for _, window in src.block_windows():
+                src.read(1, window=window)
+        _row(strategy, time.perf_counter() - start)
+
+    return rows
+
+
+def benchmark_object_storage(scene_id, product_dir, target_dir, aois=None) -> list:
+    """Measure the bytes fetched from object storage by a Landsat harmonization against the scene size.
+
+    Each run is a separate process reporting the GDAL network statistics
+    (CPL_VSIL_SHOW_NETWORK_STATS), so the block cache starts empty.
+
+    Args:
+        scene_id (str): Landsat scene identifier.
+        product_dir (str): S3 product directory, e.g. s3://bucket/prefix/scene_id.
+        target_dir (str): local output directory.
+        aois (dict): areas of interest by name, a bounding box or a GeoJSON-like geometry (EPSG:4326).
+            The whole scene is always run.
+
+    Returns:
+        list: one row (dict) per run with the fetched bytes, requests and the share of the scene size.
+    """
+    from .storage import size
+
+    scene_bytes = size(product_dir)
+    code = ('import json, sys; from sensor_harm.landsat import landsat_harmonize; '
+            'landsat_harmonize(sys.argv[1], sys.argv[2], sys.argv[3], aoi=json.loads(sys.argv[4]), '
+            'cp_quality_band=False)')
+    env = dict(os.environ, CPL_VSIL_SHOW_NETWORK_STATS='YES')
+    rows = []
+    for name, aoi in dict(scene=None, **(aois or {})).items():
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', code, scene_id, str(product_dir), str(target_dir),
+                                  json.dumps(aoi)], env=env, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            raise RuntimeError(f'Harmonization of {product_dir} failed: {process.stderr[-2000:]}')
+        # GDAL prints the statistics on exit, to the standard output
+        _, _, stats = (process.stdout + process.stderr).partition('Network statistics:')
+        methods = json.loads(stats).get('methods', {}) if stats.strip() else {}
+        fetched = sum(method.get('downloaded_bytes', 0) for method in methods.values())
+        requests = sum(method.get('count', 0) for method in methods.values())
+        rows.append(dict(run=name, seconds=elapsed, requests=requests, fetched_MB=fetched / 1024 ** 2,
+                         scene_MB=scene_bytes / 1024 ** 2, fetched_share=fetched / scene_bytes))
+    return rows
+
+
+# Values of the GDAL options tried by autotune
+AUTOTUNE_GRID = {
+    'GDAL_CACHEMAX': [256, 1024],
+    'GDAL_NUM_THREADS': ['1', 'ALL_CPUS'],
+    'VSI_CACHE': ['FALSE', 'TRUE'],
+}
+
+
+def autotune(entry, work_dir, grid: dict = None, repeat: int = 1, profile_path=None, options: dict = None) -> list:
+    """Find the fastest GDAL profile of the harmonization of a sample scene on this machine.
+
+    The scene is harmonized with each combination of the values of the grid,
+    each run in a separate process (the block cache starts empty) without the
+    profile of the environment. The fastest combination is written as the GDAL
+    profile, see sensor_harm.gdal_env.
+
+    Args:
+        entry (str): sample scene, a Landsat product directory (named by scene id) or a Sentinel-2 entry.
+        work_dir (str): directory of the temporary outputs and of the default profile file.
+        grid (dict): values (list) of each GDAL option. Default is AUTOTUNE_GRID.
+        repeat (int): runs of each combination, the best time is kept.
+        profile_path (str): profile file written. Default is work_dir/gdal_profile.json.
+        options (dict): keywords of the harmonizer, e.g. {"bands": ["sr_band4"]} for a shorter sample.
+
+    Returns:
+        list: one row (dict) per combination with its options, seconds and whether it is the fastest.
+    """
+    from .gdal_env import GDAL_PROFILE_ENV, save_profile
+
+    grid = grid or AUTOTUNE_GRID
+    name = Path(str(entry).rstrip('/')).name
+    if name.startswith('S2'):
+        code = ('import json, sys, time; from sensor_harm.sentinel2 import sentinel_harmonize; '
+                'start = time.perf_counter(); '
+                'sentinel_harmonize(sys.argv[1], sys.argv[2], gdal_options=json.loads(sys.argv[3]), '
+                '**json.loads(sys.argv[4])); print(time.perf_counter() - start)')
+        harmonizer_options = dict(options or {})
+    else:
+        code = ('import json, sys, time; from sensor_harm.landsat import landsat_harmonize; '
+                'start = time.perf_counter(); '
+                'landsat_harmonize(sys.argv[5], sys.argv[1], sys.argv[2], gdal_options=json.loads(sys.argv[3]), '
+                '**json.loads(sys.argv[4])); print(time.perf_counter() - start)')
+        harmonizer_options = dict(dict(cp_quality_band=False), **(options or {}))
+    env = {key: value for key, value in os.environ.items() if key != GDAL_PROFILE_ENV}
+
+    target_dir = Path(work_dir) / 'autotune'
+    rows = []
+    for values in itertools.product(*grid.values()):
+        settings = dict(zip(grid, values))
+        timings = []
+        for _ in range(repeat):
+            shutil.rmtree(target_dir, ignore_errors=True)
+            process = subprocess.run([sys.executable, '-c', code, str(entry), str(target_dir), json.dumps(settings),
+                                      json.dumps(harmonizer_options), name], env=env, capture_output=True, text=True)
+            if process.returncode != 0:
+                raise RuntimeError(f'Harmonization of {entry} with {settings} failed: {process.stderr[-2000:]}')
+            timings.append(float(process.stdout.split()[-1]))
+        rows.append(dict(settings, seconds=min(timings), fastest=False))
+    shutil.rmtree(target_dir, ignore_errors=True)
+
+    fastest = min(rows, key=lambda row: row['seconds'])
+    fastest['fastest'] = True
+    save_profile({key: fastest[key] for key in grid}, profile_path or Path(work_dir) / 'gdal_profile.json')
+    return rows
+
+
+def _window_angles(size: int, seed: int = 0) -> list:
+    """Create Landsat-like angle bands (view zenith, solar zenith, relative azimuth) in hundredths of degree."""
+    rng = numpy.random.default_rng(seed)
+    rows, cols = numpy.mgrid[0:size, 0:size] / size
+    view_zenith = 750 * numpy.abs(2 * cols - 1) + rng.normal(0, 5, (size, size))
+    solar_zenith = 3500 + 300 * rows
+    relative_azimuth = numpy.where(cols < 0.5, -9000, 9000) + 1000 * rows
+    return [angle.astype('int16') for angle in (view_zenith, solar_zenith, relative_azimuth)]
+
+
+def _masked_window(reflectance, angles, nodata, band_coef, out):
+    """Harmonize a window with masked arrays, the former hot path (see benchmark_window)."""
+    from .harmonization_model import DE2RA, calc_brf, quantize
+
+    reflectance = numpy.ma.masked_equal(reflectance, nodata)
+    view_zenith, solar_zenith, relative_azimuth = (numpy.ma.masked_equal(angle, nodata) / 100 * DE2RA
+                                                   for angle in angles)
+    brf_sensor = calc_brf(view_zenith, solar_zenith, relative_azimuth, band_coef)
+    brf_ref = calc_brf(numpy.zeros(view_zenith.shape), solar_zenith, numpy.zeros(view_zenith.shape), band_coef)
+    values = numpy.ma.getdata(reflectance * (brf_ref / brf_sensor))
+    return quantize(values, nodata, out, numpy.ma.getmaskarray(reflectance))
+
+
+def _plain_window(reflectance, angles, nodata, band_coef, out, arena=None):
+    """Harmonize a window with plain arrays and a nodata mask, as harmonize_band with its scratch arena."""
+    from .harmonization_model import (angle_radians, apply_cfactor,
+                                      calc_cfactor, quantize)
+
+    def buffer(name, dtype='float64'):
+        return arena.buffer(name, reflectance.shape, dtype) if arena is not None else None
+
+    view_zenith, solar_zenith, relative_azimuth = (
+        angle_radians(angle, numpy.equal(angle, nodata, out=buffer(f'{name}_mask', bool)), buffer(name))
+        for name, angle in zip(('view_zenith', 'solar_zenith', 'relative_azimuth'), angles)
+    )
+    mask = numpy.equal(reflectance, nodata, out=buffer('reflectance_mask', bool))
+    c_factor = calc_cfactor(view_zenith, solar_zenith, relative_azimuth, band_coef, arena)
+    return quantize(apply_cfactor(reflectance, mask, c_factor, arena=arena), nodata, out, mask, arena)
+
+
+def _window_peak(fn, inputs, outputs) -> float:
+    """Measure the peak memory (KB, tracemalloc) allocated by a window path above its steady state."""
+    tracemalloc.start()
+    try:
+        # The first window fills the arena
+        fn(*inputs[0], outputs[0])
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for arguments, out in zip(inputs, outputs):
+            fn(*arguments, out)
+        return (tracemalloc.get_traced_memory()[1] - baseline) / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_window(size: int = 512, windows: int = 8) -> list:
+    """Compare the window paths of the NBAR kernels.
+
+    The paths are the former masked arrays, plain arrays with a nodata mask
+    allocating their temporaries and plain arrays written into a scratch arena
+    (harmonize_band). They run on the same in-memory windows, the read and write
+    excluded: full windows (every pixel valid, the common case) and scene edge
+    windows, a quarter of their pixels nodata in the reflectance and in the angles.
+    The peak memory allocated by a window is measured in a separate run.
+
+    Args:
+        size (int): window width and height in pixels, e.g. the block size of the band.
+        windows (int): number of windows of each kind.
+
+    Returns:
+        list: one row (dict) per window kind and path, with the throughput, the peak memory
+            allocated per window and whether the outputs are identical to the masked path.
+    """
+    from .harmonization_model import ScratchArena
+    from .registry import get_sensor
+
+    band_coef = get_sensor('LC08').brdf('sr_band4')
+    nodata = 0
+    full = [(synthetic_band(size, seed=i, dtype='int16'), _window_angles(size, seed=i)) for i in range(windows)]
+    edge = []
+    for reflectance, angles in full:
+        reflectance, angles = reflectance.copy(), [angle.copy() for angle in angles]
+        for data in (reflectance, *angles):
+            data[:, :size // 4] = nodata
+        edge.append((reflectance, angles))
+    megapixels = windows * size * size / 1e6
+    rows = []
+
+    for kind, windows_data in (('full', full), ('edge', edge)):
+        outputs, reference = {}, None
+        paths = (
+            ('masked', lambda reflectance, angles, out: _masked_window(reflectance, angles, nodata, band_coef, out)),
+            ('plain', lambda reflectance, angles, out: _plain_window(reflectance, angles, nodata, band_coef, out)),
+            ('arena', lambda reflectance, angles, out, arena=ScratchArena(): _plain_window(
+                reflectance, angles, nodata, band_coef, out, arena)),
+        )
+        for path, fn in paths:
+            outputs[path] = [numpy.empty((size, size), dtype='int32') for _ in windows_data]
+            start = time.perf_counter()
+            for (reflectance, angles), out in zip(windows_data, outputs[path]):
+                fn(reflectance, angles, out)
+            elapsed = time.perf_counter() - start
+            reference = reference or elapsed
+            rows.append(dict(
+                window=kind, path=path, windows=windows, seconds=elapsed, Mpx_per_s=megapixels / elapsed,
+                speedup=reference / elapsed, peak_KB=_window_peak(fn, windows_data, outputs[path]),
+                identical=all(numpy.array_equal(a, b) for a, b in zip(outputs['masked'], outputs[path])),
+            ))
+    return rows
+
+
+def format_table(rows: list) -> str:
+    """Format benchmark rows as a plain text table."""
+    if not rows:
+        return ''
+    columns = list(rows[0])
+    cells = [[f'{row[c]:.3f}' if isinstance(row[c], float) else str(row[c]) for c in columns] for row in rows]
+    widths = [max(len(c), *(len(line[i]) for line in cells)) for i, c in enumerate(columns)]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines.extend('  '.join(v.ljust(w) for v, w in zip(line, widths)) for line in cells)
+    return os.linesep.join(lines)
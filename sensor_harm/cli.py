@@ -0,0 +1,497 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the sensor-harm command line interface.
+
+Only Click is imported at startup. NumPy, rasterio and the harmonizers are
+imported by the commands which use them, so ``sensor-harm --help`` and job
+wrapper scripts do not pay for them.
+"""
+
+# Python Native
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+# 3rdparty
+import click
+
+STARTUP_BUDGET = 0.5
+
+
+def _parse_aoi(value):
+    """Parse an area of interest, a bounding box 'xmin,ymin,xmax,ymax' or a GeoJSON file."""
+    if value is None:
+        return None
+    if os.path.isfile(value):
+        with open(value) as fd:
+            geojson = json.load(fd)
+        if geojson.get('type') == 'FeatureCollection':
+            geojson = geojson['features'][0]
+        return geojson.get('geometry', geojson)
+    try:
+        bbox = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4:
+        raise click.BadParameter(f'{value} is not a bounding box xmin,ymin,xmax,ymax nor a GeoJSON file')
+    return bbox
+
+
+def _parse_factors(ctx, param, value):
+    """Parse comma separated overview factors, e.g. '2,4,8,16'."""
+    if not value:
+        return None
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise click.BadParameter(f'{value} is not a comma separated list of factors')
+
+
+def _parse_names(ctx, param, value):
+    """Parse comma separated names, e.g. 'NDVI,NBR'."""
+    return [name.strip() for name in value.split(',')] if value else None
+
+
+def _parse_tile(ctx, param, value):
+    """Parse a grid tile 'h,v'."""
+    if not value:
+        return None
+    try:
+        h, v = (int(index) for index in value.split(','))
+    except ValueError:
+        raise click.BadParameter(f'{value} is not a tile h,v')
+    return h, v
+
+
+def _parse_profile(ctx, param, value):
+    """Load a GDAL profile file, see sensor_harm.gdal_env."""
+    if value is None:
+        return None
+    from .gdal_env import load_profile
+    try:
+        return load_profile(value)
+    except RuntimeError as e:
+        raise click.BadParameter(str(e))
+
+
+def _scheduler(memory, workers, processes=False):
+    """Create the band scheduler when a memory budget is given."""
+    if memory is None:
+        return None
+    from .scheduler import Scheduler
+    return Scheduler(memory, workers=workers, processes=processes)
+
+
+def _harmonize(fn, *args, memory=None, workers=1, processes=False, **kwargs):
+    """Run a harmonizer with an optional scheduler and report its duration."""
+    start = time.perf_counter()
+    scheduler = _scheduler(memory, workers, processes)
+    try:
+        result = fn(*args, scheduler=scheduler, **kwargs)
+    finally:
+        if scheduler is not None:
+            scheduler.shutdown()
+    click.echo(f'Harmonization duration time: {time.perf_counter() - start:.2f}s', err=True)
+    return result
+
+
+def _echo_statistics(statistics: dict):
+    """Print the statistics of the harmonized bands."""
+    for band, stats in statistics.items():
+        if not stats['count']:
+            click.echo(f'{band}: no valid pixels')
+            continue
+        click.echo(f'{band}: min={stats["minimum"]:g} max={stats["maximum"]:g} mean={stats["mean"]:.2f} '
+                   f'stddev={stats["stddev"]:.2f} valid={stats["valid_percent"]:.1f}%')
+
+
+def _echo_skip(target_dir):
+    """Print the pixels and windows skipped by the quality mask in the harmonized bands."""
+    from pathlib import Path
+
+    from .qa import skip_report
+
+    for name, counts in skip_report(sorted(Path(target_dir).glob('*.tif'))).items():
+        click.echo(f'{name}: skipped {counts["skipped"]} of {counts["pixels"]} pixels '
+                   f'({counts["skipped_percent"]:.1f}%), {counts["skipped_windows"]} of {counts["windows"]} windows')
+
+
+def _common_options(fn):
+    """Add the options shared by the harmonization commands."""
+    options = [
+        click.option('--aoi', help='Area of interest, bounding box xmin,ymin,xmax,ymax or GeoJSON file.'),
+        click.option('--aoi-crs', default='EPSG:4326', show_default=True, help='CRS of the bounding box.'),
+        click.option('--store', help='Zarr store path, instead of GeoTIFF files.'),
+        click.option('--memory', help='Memory budget of the band scheduler, e.g. 8G.'),
+        click.option('--workers', default=1, show_default=True, help='Number of bands processed at once.'),
+        click.option('--processes', is_flag=True, help='Run the scheduler tasks in processes instead of threads.'),
+        click.option('--rows-per-shard', type=int, help='Split the bands into resumable row shards.'),
+        click.option('--dtype', 'output_dtype', type=click.Choice(['int32', 'int16', 'uint16']), default='int32',
+                     show_default=True, help='Output data type, the 16-bit types saturate at their range.'),
+        click.option('--nodata', 'mapped_nodata', type=int, help='Output nodata value replacing the band nodata.'),
+        click.option('--cfactor-dir', type=click.Path(file_okay=False),
+                     help='Directory where the band c-factors are saved and reused.'),
+        click.option('--overviews', callback=_parse_factors,
+                     help='Factors of the internal overviews built from the bands in memory, e.g. 2,4,8,16.'),
+        click.option('--overview-resampling', type=click.Choice(['average', 'nearest']), default='average',
+                     show_default=True, help='Overview resampling.'),
+        click.option('--statistics', is_flag=True,
+                     help='Write the band statistics and histograms as GeoTIFF metadata and print them.'),
+        click.option('--grid', help='Target grid the bands are warped into, JSON file or string with crs, '
+                                    'resolution, origin and tile_size.'),
+        click.option('--tile', callback=_parse_tile, help='Tile h,v of the target grid.'),
+        click.option('--indices', callback=_parse_names,
+                     help='Spectral indices derived from the bands in memory, e.g. NDVI,EVI,NBR.'),
+        click.option('--skip-qa', callback=_parse_names,
+                     help='Quality classes written as nodata without computing their NBAR, e.g. '
+                          'fill,cloud,shadow,cirrus.'),
+        click.option('--gdal-profile', 'gdal_options', type=click.Path(exists=True, dir_okay=False),
+                     callback=_parse_profile, help='GDAL profile (JSON file of GDAL options) of the reads and writes, '
+                                                   'e.g. from bench autotune.'),
+    ]
+    for option in reversed(options):
+        fn = option(fn)
+    return fn
+
+
+@click.group()
+@click.option('--verbose', '-v', is_flag=True, help='Log the processing steps.')
+def cli(verbose):
+    """Sensor harmonization (NBAR) of Landsat and Sentinel-2 surface reflectance."""
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING, stream=sys.stderr)
+
+
+@cli.command()
+@click.argument('scene_id')
+@click.argument('product_dir')
+@click.argument('target_dir', type=click.Path(file_okay=False))
+@click.option('--bands', help='Comma separated bands, defaults to all harmonized bands.')
+@click.option('--angle-dir', help='Directory of the angle bands, defaults to the scene ANG.txt.')
+@click.option('--no-quality-band', is_flag=True, help='Do not copy the quality band.')
+@_common_options
+def landsat(scene_id, product_dir, target_dir, bands, angle_dir, no_quality_band, aoi, aoi_crs, store, memory, workers,
+            processes, rows_per_shard, output_dtype, mapped_nodata, cfactor_dir, overviews, overview_resampling,
+            statistics, grid, tile, indices, skip_qa, gdal_options):
+    """Harmonize a Landsat scene."""
+    from .landsat import landsat_harmonize
+
+    result = _harmonize(landsat_harmonize, scene_id, product_dir, target_dir,
+                        bands=bands.split(',') if bands else None, angle_dir=angle_dir,
+                        cp_quality_band=not no_quality_band, aoi=_parse_aoi(aoi), aoi_crs=aoi_crs, store=store,
+                        rows_per_shard=rows_per_shard, output_dtype=output_dtype, mapped_nodata=mapped_nodata,
+                        cfactor_dir=cfactor_dir, overviews=overviews, overview_resampling=overview_resampling,
+                        statistics=statistics, grid=grid, tile=tile, indices=indices, skip_qa=skip_qa,
+                        gdal_options=gdal_options, memory=memory, workers=workers, processes=processes)
+    if statistics:
+        _echo_statistics(result[2])
+    if skip_qa:
+        _echo_skip(result[0])
+    click.echo(str(result[0]))
+
+
+@cli.command()
+@click.argument('entry')
+@click.argument('target_dir', type=click.Path(file_okay=False))
+@click.option('--no-bandpass', is_flag=True, help='Do not apply the bandpass adjustment.')
+@click.option('--jp2-strategy', type=click.Choice(['open', 'transcode']), default='open', show_default=True,
+              help='JPEG2000 decode strategy.')
+@_common_options
+def sentinel2(entry, target_dir, no_bandpass, jp2_strategy, aoi, aoi_crs, store, memory, workers, processes,
+              rows_per_shard, output_dtype, mapped_nodata, cfactor_dir, overviews, overview_resampling, statistics,
+              grid, tile, indices, skip_qa, gdal_options):
+    """Harmonize a Sentinel-2 scene (Sen2cor .SAFE or LaSRC directory)."""
+    from .sentinel2 import sentinel_harmonize
+
+    target = _harmonize(sentinel_harmonize, entry, target_dir, not no_bandpass, aoi=_parse_aoi(aoi),
+                        aoi_crs=aoi_crs, store=store, jp2_strategy=jp2_strategy, rows_per_shard=rows_per_shard,
+                        output_dtype=output_dtype, mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir,
+                        overviews=overviews, overview_resampling=overview_resampling, statistics=statistics,
+                        grid=grid, tile=tile, indices=indices, skip_qa=skip_qa, gdal_options=gdal_options,
+                        memory=memory, workers=workers, processes=processes)
+    if statistics:
+        target, _, band_statistics = target
+        _echo_statistics(band_statistics)
+    if skip_qa:
+        _echo_skip(target)
+    click.echo(str(target))
+
+
+@cli.command()
+@click.argument('jobs', type=click.File('r'), default='-')
+@click.option('--spool', type=click.Path(file_okay=False), help='Consume jobs from a spool directory instead.')
+@click.option('--exit-when-empty', is_flag=True, help='Stop when the spool directory is empty.')
+@click.option('--memory', help='Memory budget of the band scheduler, e.g. 8G.')
+@click.option('--workers', default=1, show_default=True, help='Number of bands processed at once.')
+def batch(jobs, spool, exit_when_empty, memory, workers):
+    """Harmonize JSON-lines jobs (file or standard input) or the jobs of a spool directory.
+
+    Each job is a JSON object with at least "input" and "output", see sensor_harm.worker.
+    """
+    from .worker import Worker
+
+    scheduler = _scheduler(memory, workers)
+    worker = Worker(scheduler=scheduler)
+    worker.install_signal_handlers()
+    try:
+        if spool:
+            worker.serve_spool(spool, exit_when_empty=exit_when_empty)
+        else:
+            worker.serve_stream(jobs, sys.stdout)
+    finally:
+        if scheduler is not None:
+            scheduler.shutdown()
+
+
+@cli.command()
+@click.argument('target_dir', type=click.Path(file_okay=False))
+@click.argument('entries', nargs=-1, required=True)
+@click.option('--no-bandpass', is_flag=True, help='Do not apply the Sentinel-2 bandpass adjustment.')
+@click.option('--view-tolerance', type=float, default=0.001, show_default=True,
+              help='Maximum view zenith difference (degrees) to reuse the view terms of a previous date.')
+@click.option('--dates-per-pass', default=64, show_default=True, help='Maximum number of dates harmonized together.')
+@click.option('--aoi', help='Area of interest, bounding box xmin,ymin,xmax,ymax or GeoJSON file.')
+@click.option('--aoi-crs', default='EPSG:4326', show_default=True, help='CRS of the bounding box.')
+@click.option('--store', help='Zarr store path, instead of GeoTIFF files.')
+@click.option('--memory', help='Memory budget of the scheduler, e.g. 8G.')
+@click.option('--workers', default=1, show_default=True, help='Number of bands processed at once.')
+@click.option('--processes', is_flag=True, help='Run the scheduler tasks in processes instead of threads.')
+@click.option('--dtype', 'output_dtype', type=click.Choice(['int32', 'int16', 'uint16']), default='int32',
+              show_default=True, help='Output data type, the 16-bit types saturate at their range.')
+@click.option('--nodata', 'mapped_nodata', type=int, help='Output nodata value replacing the band nodata.')
+@click.option('--statistics', is_flag=True, help='Write the band statistics and histograms as GeoTIFF metadata.')
+@click.option('--gdal-profile', 'gdal_options', type=click.Path(exists=True, dir_okay=False),
+              callback=_parse_profile, help='GDAL profile (JSON file of GDAL options) of the reads and writes.')
+def stack(target_dir, entries, no_bandpass, view_tolerance, dates_per_pass, aoi, aoi_crs, store, memory, workers,
+          processes, output_dtype, mapped_nodata, statistics, gdal_options):
+    """Harmonize a time series of scenes (e.g. of one tile), reusing the repeating view geometry."""
+    from .stack import harmonize_stack
+
+    outputs = _harmonize(harmonize_stack, list(entries), target_dir, not no_bandpass, view_tolerance=view_tolerance,
+                         dates_per_pass=dates_per_pass, aoi=_parse_aoi(aoi), aoi_crs=aoi_crs, store=store,
+                         output_dtype=output_dtype, mapped_nodata=mapped_nodata, statistics=statistics,
+                         gdal_options=gdal_options, memory=memory, workers=workers, processes=processes)
+    click.echo(f'{len(outputs)} bands written')
+
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8000, show_default=True)
+@click.option('--work-dir', type=click.Path(file_okay=False), help='Directory of the prepared scenes.')
+@click.option('--cache-size', default='256M', show_default=True, help='Size of the rendered tile cache.')
+@click.option('--plane-cache-size', default='1G', show_default=True, help='Size of the c-factor plane cache.')
+@click.option('--no-bandpass', is_flag=True, help='Do not apply the Sentinel-2 bandpass adjustment.')
+@click.option('--gdal-profile', 'gdal_options', type=click.Path(exists=True, dir_okay=False),
+              callback=_parse_profile, help='GDAL profile (JSON file of GDAL options) of the reads.')
+def serve(root, host, port, work_dir, cache_size, plane_cache_size, no_bandpass, gdal_options):
+    """Serve NBAR tiles (XYZ or bounding box, PNG or GeoTIFF) of the scenes of ROOT, harmonized on request.
+
+    See sensor_harm.tiles for the URLs.
+    """
+    from .tiles import TileServer
+
+    tiles = TileServer(root, work_dir=work_dir, cache_size=cache_size, plane_cache_size=plane_cache_size,
+                       apply_bandpass=not no_bandpass, gdal_options=gdal_options)
+    server = tiles.serve(host, port)
+    click.echo(f'Serving NBAR tiles of {root} on http://{host}:{server.server_address[1]}/scenes', err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@cli.group()
+def shard():
+    """Run and assemble the row shards planned in a parts directory (see sensor_harm.sharding)."""
+
+
+@shard.command('run')
+@click.argument('parts_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--index', default=0, show_default=True, help='Runner index, from 0 to count - 1.')
+@click.option('--count', default=1, show_default=True, help='Number of runners (e.g. machines) sharing the plan.')
+@click.option('--memory', help='Memory budget of the shard scheduler, e.g. 8G.')
+@click.option('--workers', default=1, show_default=True, help='Number of shards processed at once.')
+@click.option('--processes', is_flag=True, help='Run the shards in processes instead of threads.')
+def shard_run(parts_dir, index, count, memory, workers, processes):
+    """Run the incomplete shards assigned to this runner."""
+    from .sharding import run_shards
+
+    scheduler = _scheduler(memory, workers, processes)
+    try:
+        parts = run_shards(parts_dir, scheduler, index, count)
+    finally:
+        if scheduler is not None:
+            scheduler.shutdown()
+    click.echo(f'{len(parts)} shards written')
+
+
+@shard.command('assemble')
+@click.argument('parts_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--vrt', is_flag=True, help='Write VRTs referencing the parts (metadata only) instead of GeoTIFF '
+                                         'files, which copy the pixels of the parts once.')
+@click.option('--remove-parts', is_flag=True, help='Remove the parts directory once assembled.')
+def shard_assemble(parts_dir, vrt, remove_parts):
+    """Assemble the shard parts into the band outputs.
+
+    The GeoTIFF outputs copy the pixels of the parts once, and read the bands again to build their overviews.
+    """
+    from .sharding import assemble
+
+    try:
+        outputs = assemble(parts_dir, driver='VRT' if vrt else 'GTiff', remove_parts=remove_parts)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    for output in outputs:
+        for band, output_file in output.items():
+            click.echo(f'{band}: {output_file}')
+
+
+@cli.group()
+def bench():
+    """Run the I/O, accuracy and startup benchmarks."""
+
+
+@bench.command('outputs')
+@click.argument('work_dir', type=click.Path(file_okay=False))
+@click.option('--bands', default=7, show_default=True)
+@click.option('--size', default=5490, show_default=True)
+@click.option('--block', default=512, show_default=True)
+def bench_outputs(work_dir, bands, size, block):
+    """Compare GeoTIFF and Zarr outputs throughput."""
+    from .benchmark import benchmark_outputs, format_table
+
+    click.echo(format_table(benchmark_outputs(work_dir, bands=bands, size=size, block=block)))
+
+
+@bench.command('jp2')
+@click.argument('img_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--work-dir', type=click.Path(file_okay=False), help='Directory of the transcoded GeoTIFF.')
+@click.option('--threads', default='ALL_CPUS', show_default=True)
+def bench_jp2(img_path, work_dir, threads):
+    """Compare the JPEG2000 decode strategies."""
+    from .benchmark import benchmark_jp2, format_table
+
+    click.echo(format_table(benchmark_jp2(img_path, work_dir, threads)))
+
+
+@bench.command('window')
+@click.option('--size', default=512, show_default=True, help='Window width and height in pixels.')
+@click.option('--windows', default=8, show_default=True, help='Number of windows of each kind.')
+def bench_window(size, windows):
+    """Compare the masked array and plain array window paths of the kernels."""
+    from .benchmark import benchmark_window, format_table
+
+    click.echo(format_table(benchmark_window(size, windows)))
+
+
+@bench.command('storage')
+@click.argument('scene_id')
+@click.argument('product_dir')
+@click.argument('target_dir', type=click.Path(file_okay=False))
+@click.option('--aoi', 'aois', multiple=True, help='Also run an area of interest, bounding box xmin,ymin,xmax,ymax.')
+def bench_storage(scene_id, product_dir, target_dir, aois):
+    """Measure the bytes fetched from object storage versus the scene size."""
+    from .benchmark import benchmark_object_storage, format_table
+
+    aois = {f'aoi{i}': _parse_aoi(aoi) for i, aoi in enumerate(aois)}
+    click.echo(format_table(benchmark_object_storage(scene_id, product_dir, target_dir, aois)))
+
+
+@bench.command('autotune')
+@click.argument('entry')
+@click.argument('work_dir', type=click.Path(file_okay=False))
+@click.option('--grid', help='Values of each GDAL option, JSON file or string, e.g. {"GDAL_NUM_THREADS": ["1", "4"]}.')
+@click.option('--options', help='Harmonizer keywords of the sample runs, JSON string, e.g. {"bands": ["sr_band4"]}.')
+@click.option('--repeat', default=1, show_default=True, help='Runs of each combination, the best time is kept.')
+@click.option('--profile', 'profile_path', type=click.Path(dir_okay=False),
+              help='GDAL profile file written, defaults to WORK_DIR/gdal_profile.json.')
+def bench_autotune(entry, work_dir, grid, options, repeat, profile_path):
+    """Find the fastest GDAL profile of the harmonization of a sample scene."""
+    from .benchmark import autotune, format_table
+
+    if grid is not None:
+        grid = json.loads(open(grid).read() if os.path.isfile(grid) else grid)
+    profile_path = profile_path or os.path.join(work_dir, 'gdal_profile.json')
+    try:
+        rows = autotune(entry, work_dir, grid=grid, repeat=repeat, profile_path=profile_path,
+                        options=json.loads(options) if options else None)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(format_table(rows))
+    click.echo(f'GDAL profile: {profile_path}')
+
+
+@bench.command('accuracy')
+@click.argument('work_dir', type=click.Path(file_okay=False))
+@click.option('--config', 'configs', multiple=True,
+              help='Alternative configuration NAME=JSON keywords, e.g. threads={"memory": "2G", "workers": 2}.')
+@click.option('--max-abs', default=1., show_default=True, help='Maximum absolute DN error threshold.')
+@click.option('--mean-abs', default=0.1, show_default=True, help='Mean absolute DN error threshold.')
+@click.option('--changed', default=0.01, show_default=True, help='Share of changed pixels threshold.')
+def bench_accuracy(work_dir, configs, max_abs, mean_abs, changed):
+    """Compare the default and alternative configurations with the pinned reference NBAR on a synthetic scene."""
+    from .accuracy import accuracy_report, check_accuracy
+    from .benchmark import format_table
+
+    configurations = None
+    if configs:
+        configurations = {}
+        for config in configs:
+            name, _, options = config.partition('=')
+            configurations[name] = json.loads(options or '{}')
+
+    rows = accuracy_report(work_dir, configurations, max_abs=max_abs, mean_abs=mean_abs, changed=changed)
+    click.echo(format_table(rows))
+    try:
+        check_accuracy(rows)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+def measure_startup(repeat: int = 5) -> float:
+    """Measure the best wall time (seconds) of a fresh interpreter running ``sensor-harm --help``."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'sensor_harm.cli', '--help'], check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@bench.command('startup')
+@click.option('--budget', default=STARTUP_BUDGET, show_default=True, help='Startup time budget (seconds).')
+@click.option('--repeat', default=5, show_default=True)
+def bench_startup(budget, repeat):
+    """Check the command line startup time and that the heavy dependencies are not imported."""
+    heavy = ('numpy', 'rasterio', 's2angs', 'zarr')
+    code = f'import sys, sensor_harm.cli; print(",".join(m for m in {heavy!r} if m in sys.modules))'
+    loaded = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout.strip()
+    elapsed = measure_startup(repeat)
+    click.echo(f'startup: {elapsed:.3f}s (budget {budget:.3f}s), eager imports: {loaded or "none"}')
+    if loaded or elapsed > budget:
+        raise click.ClickException('Startup time budget exceeded or heavy dependencies imported at startup')
+
+
+if __name__ == '__main__':
+    cli()
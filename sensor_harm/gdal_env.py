@@ -0,0 +1,95 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the GDAL configuration of the harmonization I/O.
+
+The reads and writes of the harmonization (bands, angles, quality bands,
+c-factors, outputs and shard assembly) run in a GDAL environment built from a
+profile, a JSON object of GDAL configuration options, e.g.::
+
+    {"GDAL_CACHEMAX": 1024, "GDAL_NUM_THREADS": "ALL_CPUS", "VSI_CACHE": "TRUE", "VSI_CACHE_SIZE": 67108864}
+
+The profile of the file named by the ``SENSOR_HARM_GDAL_PROFILE`` environment
+variable applies to every run, and the ``gdal_options`` of a run override it.
+The options of the profile also override the JPEG2000 decoding defaults (see
+jp2_env) and the object storage defaults (see OBJECT_STORAGE_CONFIG). A profile
+is measured for a machine with ``sensor-harm bench autotune``.
+"""
+
+# Python Native
+import json
+import os
+from contextlib import nullcontext
+from functools import lru_cache
+from pathlib import Path
+
+# 3rdparty
+import rasterio
+import rasterio.env
+
+GDAL_PROFILE_ENV = 'SENSOR_HARM_GDAL_PROFILE'
+
+
+def load_profile(path) -> dict:
+    """Load a GDAL profile file, a JSON object of GDAL configuration options."""
+    try:
+        with open(path) as fd:
+            profile = json.load(fd)
+    except (OSError, ValueError) as e:
+        raise RuntimeError(f'Invalid GDAL profile {path}: {e}')
+    if not isinstance(profile, dict):
+        raise RuntimeError(f'Invalid GDAL profile {path}, expected a JSON object of GDAL options')
+    return {str(name).upper(): value for name, value in profile.items()}
+
+
+def save_profile(profile: dict, path) -> Path:
+    """Write a GDAL profile file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(profile, indent=2) + '\n')
+    return path
+
+
+@lru_cache(maxsize=None)
+def _environment_profile(path) -> dict:
+    """Load the profile of the environment once per process."""
+    return load_profile(path) if path else {}
+
+
+def gdal_options(options=None) -> dict:
+    """Retrieve the GDAL options of a run, the profile of the environment overridden by options."""
+    return dict(_environment_profile(os.environ.get(GDAL_PROFILE_ENV)), **(options or {}))
+
+
+def io_env(options=None):
+    """Create the GDAL environment of the harmonization I/O, or a null context without options.
+
+    Args:
+        options (dict): GDAL options overriding the profile of the environment.
+    """
+    options = gdal_options(options)
+    return rasterio.Env(**options) if options else nullcontext()
+
+
+def env_option(name: str, default=None):
+    """Retrieve a GDAL option of the active rasterio environment, or default when it is not set."""
+    if rasterio.env.hasenv():
+        value = rasterio.env.getenv().get(name)
+        if value is not None:
+            return value
+    return default
@@ -0,0 +1,145 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the target grid (e.g. a data cube grid) of the harmonized bands.
+
+A grid is a CRS, a pixel resolution, the origin (upper left corner) of its
+tile (0, 0) and a tile size in pixels. The harmonized band is warped from
+memory into the grid, either into a tile or into the grid aligned extent of
+the scene, so no native grid product is written and read again. A tile also
+restricts the harmonization to the windows of the scene covering it.
+
+A grid is described by a dict, e.g. a JSON file::
+
+    {"crs": "EPSG:32722", "resolution": 30, "origin": [100000, 10000000], "tile_size": [3660, 3660]}
+"""
+
+# Python Native
+import json
+import math
+from pathlib import Path
+
+# 3rdparty
+import numpy
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine, array_bounds
+from rasterio.warp import reproject, transform_bounds
+
+GRID_RESAMPLING = ('nearest', 'bilinear', 'cubic', 'average')
+
+# Source pixels kept around a tile, so that the resampling kernels at its edges are complete
+TILE_MARGIN = 2
+
+
+class TargetGrid:
+    """Target grid of the harmonized bands."""
+
+    def __init__(self, crs, resolution, origin, tile_size=None, resampling: str = 'nearest'):
+        """Create a grid.
+
+        Args:
+            crs (str|CRS): coordinate reference system of the grid.
+            resolution (float|tuple): pixel size, or (x, y) pixel sizes, in CRS units.
+            origin (tuple): (x, y) upper left corner of the tile (0, 0).
+            tile_size (tuple): (columns, rows) of a tile. Required to warp into tiles.
+            resampling (str): resampling of the harmonized bands, 'nearest', 'bilinear', 'cubic' or 'average'.
+                The quality bands are always warped with 'nearest'.
+        """
+        if resampling not in GRID_RESAMPLING:
+            raise RuntimeError(f'Invalid grid resampling {resampling}, expected one of {GRID_RESAMPLING}')
+        self.crs = CRS.from_user_input(crs)
+        self.resolution = tuple(resolution) if isinstance(resolution, (list, tuple)) else (resolution, resolution)
+        self.origin = tuple(origin)
+        self.tile_size = tuple(tile_size) if tile_size is not None else None
+        self.resampling = resampling
+
+    @classmethod
+    def load(cls, value) -> 'TargetGrid':
+        """Create a grid from a dict, a JSON string or a JSON file."""
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            value = json.loads(Path(value).read_text() if not value.lstrip().startswith('{') else value)
+        return cls(**value)
+
+    def tile_bounds(self, tile, margin: int = 0) -> tuple:
+        """Compute the bounds of a tile in the grid CRS.
+
+        Args:
+            tile (tuple): (horizontal, vertical) tile index, vertical growing southwards.
+            margin (int): pixels added around the tile.
+
+        Returns:
+            tuple: (xmin, ymin, xmax, ymax).
+        """
+        if self.tile_size is None:
+            raise RuntimeError('The grid has no tile size')
+        (h, v), (columns, rows), (x_res, y_res) = tile, self.tile_size, self.resolution
+        xmin = self.origin[0] + h * columns * x_res
+        ymax = self.origin[1] - v * rows * y_res
+        return (xmin - margin * x_res, ymax - (rows + margin) * y_res,
+                xmin + (columns + margin) * x_res, ymax + margin * y_res)
+
+    def target(self, transform, width: int, height: int, crs, tile=None) -> tuple:
+        """Compute the grid transform and shape of a tile, or of the grid aligned extent of a raster.
+
+        Args:
+            transform (Affine): affine transform of the raster.
+            width (int): raster columns.
+            height (int): raster rows.
+            crs (CRS): raster coordinate reference system.
+            tile (tuple): (horizontal, vertical) tile index. Default is the extent of the raster.
+
+        Returns:
+            Affine, int, int: transform, width and height in the grid.
+        """
+        x_res, y_res = self.resolution
+        if tile is not None:
+            left, _, _, top = self.tile_bounds(tile)
+            return Affine(x_res, 0, left, 0, -y_res, top), self.tile_size[0], self.tile_size[1]
+
+        left, bottom, right, top = transform_bounds(crs, self.crs, *array_bounds(height, width, transform),
+                                                    densify_pts=21)
+        col_start = math.floor((left - self.origin[0]) / x_res)
+        col_end = math.ceil((right - self.origin[0]) / x_res)
+        row_start = math.floor((self.origin[1] - top) / y_res)
+        row_end = math.ceil((self.origin[1] - bottom) / y_res)
+        return (Affine(x_res, 0, self.origin[0] + col_start * x_res, 0, -y_res, self.origin[1] - row_start * y_res),
+                col_end - col_start, row_end - row_start)
+
+    def warp(self, data, transform, crs, nodata, tile=None, resampling: str = None) -> tuple:
+        """Warp an array into the grid.
+
+        Args:
+            data (numpy.array): 2D array.
+            transform (Affine): affine transform of data.
+            crs (CRS): coordinate reference system of data.
+            nodata (int): nodata value of data, kept as the output nodata.
+            tile (tuple): (horizontal, vertical) target tile. Default is the grid aligned extent of data.
+            resampling (str): resampling, defaults to the grid resampling.
+
+        Returns:
+            numpy.array, Affine: warped array and its transform.
+        """
+        dst_transform, width, height = self.target(transform, data.shape[1], data.shape[0], crs, tile)
+        warped = numpy.full((height, width), nodata, dtype=data.dtype)
+        reproject(data, warped, src_transform=transform, src_crs=crs, src_nodata=nodata,
+                  dst_transform=dst_transform, dst_crs=self.crs, dst_nodata=nodata,
+                  resampling=Resampling[resampling or self.resampling])
+        return warped, dst_transform
@@ -27,57 +27,39 @@ References:
 
 # Python Native
 import logging
+import math
 import os
 import re
+import threading
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 
 # 3rdparty
 import numpy
-import numpy.ma
 import rasterio
-from rasterio.enums import Resampling
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.errors import RasterioIOError
+from rasterio.features import bounds as geometry_bounds
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_bounds, transform_geom
 from rasterio.windows import Window
+from rasterio.windows import from_bounds as window_from_bounds
+from rasterio.windows import intersect as windows_intersect
+
+# sensor-harm
+from .gdal_env import io_env
+from .grid import TILE_MARGIN
+from .jp2 import open_reflectance
+from .registry import brdf_coefficients, get_sensor, sensors
+from .statistics import BandStatistics
+from .storage import listdir, object_env
 
 br_ratio = 1.0  # shape parameter
 hb_ratio = 2.0  # crown relative height
 DE2RA = 0.0174532925199432956  # Degree to Radian proportion
-
-# Coeffients in  Roy, D. P., Zhang, H. K., Ju, J., Gomez-Dans, J. L., Lewis, P. E., Schaaf, C. B., Sun Q., Li J., Huang H., & Kovalskyy, V. (2016).
-# A general method to normalize Landsat reflectance data to nadir BRDF adjusted reflectance.
-# Remote Sensing of Environment, 176, 255-271.
-brdf_coefficients = {
-    'blue': {
-        'fiso': 774,
-        'fgeo': 79,
-        'fvol': 372
-    },
-    'green': {
-        'fiso': 1306,
-        'fgeo': 178,
-        'fvol': 580
-    },
-    'red': {
-        'fiso': 1690,
-        'fgeo': 227,
-        'fvol': 574
-    },
-    'nir': {
-        'fiso': 3093,
-        'fgeo': 330,
-        'fvol': 1535
-    },
-    'swir1': {
-        'fiso': 3430,
-        'fgeo': 453,
-        'fvol': 1154
-    },
-    'swir2': {
-        'fiso': 2658,
-        'fgeo': 387,
-        'fvol': 639
-    }
-}
-
+WINDOW_TEMPORARIES = 32  # Full window arrays alive at once while computing the kernels
+OUTPUT_DTYPES = ('int32', 'int16', 'uint16')
+OVERVIEW_RESAMPLING = ('average', 'nearest')
 
 def consult_band(b: str, satsen: str):
     """Consult band common name.
@@ -89,33 +71,7 @@ def consult_band(b: str, satsen: str):
     Returns:
         str: band common name.
     """
-    if satsen == 'LT05':
-        common_name = {'sr_band1': 'blue', 'sr_band2':'green', 'sr_band3':'red', 'sr_band4':'nir', 'sr_band5':'swir1',
-                       'sr_band7':'swir2',
-                       'SR_B1': 'blue', 'SR_B2':'green', 'SR_B3':'red', 'SR_B4':'nir', 'SR_B5':'swir1',
-                       'SR_B7':'swir2'}
-        return common_name[b]
-    elif satsen == 'LE07':
-        common_name = {'sr_band1': 'blue', 'sr_band2':'green', 'sr_band3':'red', 'sr_band4':'nir', 'sr_band5':'swir1',
-                       'sr_band7':'swir2',
-                       'SR_B1': 'blue', 'SR_B2':'green', 'SR_B3':'red', 'SR_B4':'nir', 'SR_B5':'swir1',
-                       'SR_B7':'swir2'}
-        return common_name[b]
-    elif satsen == 'LC08':
-        common_name = {'sr_band1': 'coastal', 'sr_band2':'blue', 'sr_band3':'green', 'sr_band4':'red', 'sr_band5':'nir',
-                       'sr_band6':'swir1', 'sr_band7':'swir2',
-                       'SR_B1': 'coastal', 'SR_B2':'blue', 'SR_B3':'green', 'SR_B4':'red', 'SR_B5':'nir',
-                       'SR_B6':'swir1', 'SR_B7':'swir2'}
-        return common_name[b]
-    elif satsen == 'S2A' or satsen == 'S2B':
-        common_name = {'sr_band1': 'coastal', 'sr_band2': 'blue', 'sr_band3': 'green', 'sr_band4': 'red',
-                       'sr_band5': 'rededge1', 'sr_band6': 'rededge2', 'sr_band7': 'rededge3',
-                       'sr_band8': 'nir', 'sr_band8a': 'nir', 'sr_band11': 'swir1', 'sr_band12': 'swir2',
-                       'B01': 'coastal', 'B02': 'blue', 'B03': 'green', 'B04': 'red',
-                       'B05': 'rededge1', 'B06': 'rededge2', 'B07': 'rededge3',
-                       'B08': 'nir', 'B8A': 'nir', 'B11': 'swir1', 'B12': 'swir2'}
-        return common_name[b]
-    return
+    return get_sensor(satsen).common_name(b)
 
 
 def is_landsat(scene_id: str):
@@ -144,56 +100,263 @@ def is_sentinel2(scene_id: str):
     return False
 
 
-def load_raster_resampled(img_path, resample_factor=1/2, window=None):
+def is_geometry(aoi) -> bool:
+    """Verify if an area of interest is a geometry instead of a bounding box.
+
+    Args:
+        aoi (tuple|dict): bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+    Returns:
+        bool: True if aoi is a geometry, False otherwise.
+    """
+    return isinstance(aoi, dict) or hasattr(aoi, '__geo_interface__')
+
+
+def aoi_window(dataset, aoi, aoi_crs='EPSG:4326'):
+    """Compute the pixel window of a dataset intersecting an area of interest.
+
+    The window is snapped outwards to whole pixels and clipped to the dataset extent.
+
+    Args:
+        dataset (DatasetReader): opened raster dataset.
+        aoi (tuple|dict): bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+        aoi_crs (str): coordinate reference system of aoi.
+
+    Returns:
+        Window: rasterio window in dataset pixel coordinates.
+    """
+    if is_geometry(aoi):
+        geom = transform_geom(aoi_crs, dataset.crs, getattr(aoi, '__geo_interface__', aoi))
+        left, bottom, right, top = geometry_bounds(geom)
+    else:
+        left, bottom, right, top = transform_bounds(aoi_crs, dataset.crs, *aoi, densify_pts=21)
+
+    window = window_from_bounds(left, bottom, right, top, transform=dataset.transform)
+    col_start = max(0, math.floor(window.col_off))
+    row_start = max(0, math.floor(window.row_off))
+    col_end = min(dataset.width, math.ceil(window.col_off + window.width))
+    row_end = min(dataset.height, math.ceil(window.row_off + window.height))
+
+    if col_end <= col_start or row_end <= row_start:
+        raise RuntimeError(f'Area of interest {aoi} does not intersect {dataset.name}')
+
+    return Window(col_start, row_start, col_end - col_start, row_end - row_start)
+
+
+def aoi_mask(aoi, aoi_crs, crs, transform, shape):
+    """Rasterize a geometry area of interest into an outside mask.
+
+    Args:
+        aoi (dict): GeoJSON-like geometry.
+        aoi_crs (str): coordinate reference system of aoi.
+        crs (CRS): coordinate reference system of the output grid.
+        transform (Affine): affine transform of the output grid.
+        shape (tuple): output grid shape (height, width).
+
+    Returns:
+        numpy.array: boolean array, True for pixels outside the geometry.
+    """
+    geom = transform_geom(aoi_crs, crs, getattr(aoi, '__geo_interface__', aoi))
+    return geometry_mask([geom], out_shape=shape, transform=transform, all_touched=True)
+
+
+def crop_raster(img_path, output_file, aoi, aoi_crs='EPSG:4326', grid=None, tile=None):
+    """Write the area of interest of a raster into a new GeoTIFF.
+
+    Args:
+        img_path (str): path to input file.
+        output_file (str): path to output file.
+        aoi (tuple|dict): bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry. None for the whole raster.
+        aoi_crs (str): coordinate reference system of aoi.
+        grid (TargetGrid): target grid the raster is warped into (nearest neighbour), e.g. a quality band.
+        tile (tuple): target tile of the grid.
+
+    Returns:
+        str: path to output file.
+    """
+    with rasterio.open(img_path) as src:
+        window = aoi_window(src, aoi, aoi_crs) if aoi is not None else Window(0, 0, src.width, src.height)
+        profile = src.profile
+        profile.update(
+            driver='GTiff',
+            height=int(window.height),
+            width=int(window.width),
+            transform=src.window_transform(window),
+            compress='deflate'
+        )
+        data = src.read(window=window)
+
+    if grid is not None:
+        nodata = profile['nodata'] if profile['nodata'] is not None else 0
+        warped, transform = grid.warp(data[0], profile['transform'], profile['crs'], nodata, tile, 'nearest')
+        data = warped[numpy.newaxis]
+        profile.update(count=1, crs=grid.crs, transform=transform, height=warped.shape[0], width=warped.shape[1],
+                       tiled=False)
+        profile.pop('blockxsize', None)
+        profile.pop('blockysize', None)
+
+    with rasterio.open(str(output_file), 'w', **profile) as dst:
+        dst.write(data)
+
+    return output_file
+
+
+class ScratchArena:
+    """Window buffers reused by the windows (and bands) harmonized by a worker.
+
+    The buffers are flat arrays sized to the largest window seen, viewed with the
+    shape of each window so that they stay contiguous. The kernels, the c-factor and
+    the NBAR values of a window are written into them with ``out=`` and in-place
+    operations, so that the steady state of the window loop does not allocate.
+    A buffer is valid until the same name is requested again, i.e. for one window.
+    """
+
+    def __init__(self):
+        """Create an empty arena."""
+        self._buffers = {}
+
+    def buffer(self, name: str, shape, dtype='float64') -> numpy.ndarray:
+        """Retrieve the buffer of a name and data type, with the window shape."""
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(shape))
+        buffer = self._buffers.get((name, dtype))
+        if buffer is None or buffer.size < size:
+            buffer = self._buffers[(name, dtype)] = numpy.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+    @property
+    def nbytes(self) -> int:
+        """Retrieve the size of the buffers in bytes."""
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+_worker = threading.local()
+
+
+def scratch_arena() -> ScratchArena:
+    """Retrieve the scratch arena of the current worker (thread)."""
+    if not hasattr(_worker, 'arena'):
+        _worker.arena = ScratchArena()
+    return _worker.arena
+
+
+@contextmanager
+def window_progress(callback):
+    """Report the windows of the bands harmonized by the current worker (thread) to a callback.
+
+    The callback receives the band, the number of windows done and the number of
+    windows of the band before each window and once the band is done. An exception
+    raised by the callback stops the band, e.g. to cancel it between windows.
+    """
+    previous = getattr(_worker, 'progress', None)
+    _worker.progress = callback
+    try:
+        yield
+    finally:
+        _worker.progress = previous
+
+
+def read_window(dataset, window=None, out_shape=None, resampling=Resampling.nearest, arena=None, name='read'):
+    """Read a window of the first band as a plain array and its nodata mask.
+
+    The mask is that of a masked read (the nodata value, NaN or the GDAL mask band
+    of the dataset), without the overhead of a masked array in the computations.
+
+    Args:
+        dataset (DatasetReader): opened dataset.
+        window (Window): rasterio window.
+        out_shape (tuple): (rows, columns) of the window resampled on read.
+        resampling (Resampling): resampling of out_shape.
+        arena (ScratchArena): arena receiving the window and its mask, see ScratchArena.
+        name (str): buffer name in arena.
+
+    Returns:
+        numpy.array, numpy.array: window values and boolean array, True for nodata pixels.
+    """
+    if arena is None:
+        data = dataset.read(1, window=window, out_shape=out_shape, resampling=resampling)
+        mask = None
+    else:
+        shape = out_shape or ((dataset.height, dataset.width) if window is None
+                              else (int(window.height), int(window.width)))
+        data = dataset.read(1, window=window, out=arena.buffer(name, shape, dataset.dtypes[0]), resampling=resampling)
+        mask = arena.buffer(f'{name}_mask', shape, bool)
+
+    nodata = dataset.nodata
+    if nodata is not None:
+        return data, numpy.isnan(data, out=mask) if math.isnan(nodata) else numpy.equal(data, nodata, out=mask)
+    if MaskFlags.all_valid in dataset.mask_flag_enums[0]:
+        if mask is None:
+            return data, numpy.zeros(data.shape, dtype=bool)
+        mask[...] = False
+        return data, mask
+    if arena is None:
+        return data, dataset.read_masks(1, window=window, out_shape=out_shape, resampling=resampling) == 0
+    valid = dataset.read_masks(1, window=window, out=arena.buffer(f'{name}_valid', data.shape, 'uint8'),
+                               resampling=resampling)
+    return data, numpy.equal(valid, 0, out=mask)
+
+
+def load_raster_resampled(img_path, resample_factor=1/2, window=None, arena=None, name='read'):
     """Load and resample image.
 
     Args:
         img_path (str): path to image.
         resample_factor (str): resample factor.
         window (Window): window.
+        arena (ScratchArena): arena receiving the window, see read_window.
+        name (str): buffer name in arena.
 
     Returns:
-        raster: numpy.array.
+        raster, mask: numpy.array values and nodata mask, see read_window.
     """
     # Resample the window
     res_window = Window(window.col_off * resample_factor, window.row_off * resample_factor,
                         window.width * resample_factor, window.height * resample_factor)
     with rasterio.open(img_path) as dataset:
         try:
-            raster = dataset.read(
-                out_shape=(
-                    1,
-                    int(window.height),
-                    int(window.width),
-                ),
-                resampling=Resampling.average,
-                masked=True,
-                window=res_window
-            )
-        except:
-            logging.info("BREAK RES WINDOW {}".format(res_window))
-            return
-        return raster
-
-
-def load_img(img_path, window=None):
-    """Load image into an xarray Data Array.
+            return read_window(dataset, res_window, out_shape=(int(window.height), int(window.width)),
+                               resampling=Resampling.average, arena=arena, name=name)
+        except RasterioIOError as e:
+            raise RuntimeError(f'Could not read the resampled window {res_window} of {img_path}: {e}') from e
+
+
+def load_img(img_path, window=None, arena=None, name='read'):
+    """Load image window.
 
     Args:
         img_path (str): path to input file.
         window (Window): rasterio window.
+        arena (ScratchArena): arena receiving the window, see read_window.
+        name (str): buffer name in arena.
 
     Returns:
-        raster: numpy.array.
+        raster, mask: numpy.array values and nodata mask, see read_window.
     """
     logging.debug('Loading {} ...'.format(img_path))
     with rasterio.open(img_path) as dataset:
-        raster = dataset.read(1, masked=True, window=window)
+        return read_window(dataset, window, arena=arena, name=name)
 
-    return raster
 
+def angle_radians(angle, mask, out=None):
+    """Convert an angle window in hundredths of degree to radians, NaN at its nodata pixels.
 
-def prepare_angles(sz_path, sa_path, vz_path, va_path, satsen, band, window=None):
+    NaN propagates through the kernels into an undefined c-factor, see apply_cfactor.
+
+    Args:
+        angle (numpy.array): angle window in hundredths of degree.
+        mask (numpy.array): boolean array, True for the nodata pixels of the angle.
+        out (numpy.array): float64 array receiving the angle.
+
+    Returns:
+        numpy.array: angle in radians.
+    """
+    out = numpy.divide(angle, 100, out=out)
+    numpy.multiply(out, DE2RA, out=out)
+    numpy.copyto(out, numpy.nan, where=mask)
+    return out
+
+
+def prepare_angles(sz_path, sa_path, vz_path, va_path, satsen, band, window=None, angles=None, arena=None):
     """Scale angle bands, convert from radians, calculate relative azimuth angle band.
 
     Args:
@@ -204,24 +367,32 @@ def prepare_angles(sz_path, sa_path, vz_path, va_path, satsen, band, window=None
         satsen (str): satellite sensor.
         band (str): band.
         window (Window): rasterio window.
+        angles (AngleProvider): angle provider. When given, the angles are retrieved from it instead of the angle files.
+        arena (ScratchArena): arena receiving the angles of the angle files.
 
     Returns:
-        raster, raster, raster: numpy.array (view_zenith, solar_zenith, relative_azimuth).
+        raster, raster, raster: numpy.array (view_zenith, solar_zenith, relative_azimuth), NaN at nodata pixels.
     """
-    if satsen == 'S2A' or satsen == 'S2B':
-        if band in ['sr_band8a', 'sr_band11', 'sr_band12']: # ['B8A','B11','B12']:
-            relative_azimuth = numpy.divide(
-                numpy.subtract(load_raster_resampled(va_path, 0.5, window),
-                               load_raster_resampled(sa_path, 0.5, window)),
-                100) * DE2RA
-            solar_zenith = numpy.divide(load_raster_resampled(sz_path, 0.5, window), 100) * DE2RA
-            view_zenith = numpy.divide(load_raster_resampled(vz_path, 0.5, window), 100) * DE2RA
-
-            return view_zenith, solar_zenith, relative_azimuth
-
-    relative_azimuth = numpy.divide(numpy.subtract(load_img(va_path, window), load_img(sa_path, window)), 100) * DE2RA
-    solar_zenith = numpy.divide(load_img(sz_path, window), 100) * DE2RA
-    view_zenith = numpy.divide(load_img(vz_path, window), 100) * DE2RA
+    if angles is not None:
+        return angles.read(band, window)
+
+    if (satsen == 'S2A' or satsen == 'S2B') and band in ['sr_band8a', 'sr_band11', 'sr_band12']: # ['B8A','B11','B12']:
+        load, args = load_raster_resampled, (0.5, window)
+    else:
+        load, args = load_img, (window,)
+    va, va_mask = load(va_path, *args, arena=arena, name='view_azimuth')
+    sa, sa_mask = load(sa_path, *args, arena=arena, name='solar_azimuth')
+    sz, sz_mask = load(sz_path, *args, arena=arena, name='solar_zenith')
+    vz, vz_mask = load(vz_path, *args, arena=arena, name='view_zenith')
+
+    def buffer(name, dtype='float64'):
+        return arena.buffer(name, va.shape, dtype) if arena is not None else None
+
+    relative_azimuth = numpy.subtract(va, sa, out=buffer('azimuth', numpy.result_type(va, sa)))
+    relative_azimuth = angle_radians(relative_azimuth, numpy.logical_or(va_mask, sa_mask, out=va_mask),
+                                     buffer('relative_azimuth_rad'))
+    solar_zenith = angle_radians(sz, sz_mask, buffer('solar_zenith_rad'))
+    view_zenith = angle_radians(vz, vz_mask, buffer('view_zenith_rad'))
 
     return view_zenith, solar_zenith, relative_azimuth
 
@@ -341,6 +512,169 @@ def calc_brf(view_zenith, solar_zenith, relative_azimuth, band_coef):
     return band_coef['fiso'] + band_coef['fvol']*ross +band_coef['fgeo']*li
 
 
+# Kernel terms of the nadir view (zenith and relative azimuth 0)
+NADIR_TERMS = dict(cos=1., sin=0., tan_i=0., sec_i=1., cos_i=1., sin_i=0.)
+
+
+def kernel_terms(zenith, arena=None, name='terms'):
+    """Precompute the terms of the kernels depending on a zenith angle (of the view or of the sun).
+
+    Args:
+        zenith (numpy array): view or solar zenith.
+        arena (ScratchArena): arena receiving the terms. Default allocates them.
+        name (str): buffer name prefix in arena, e.g. 'view' or 'sun'.
+
+    Returns:
+        dict: cos and sin of the zenith, tan, sec, cos and sin of its Li-Sparse transformed zenith.
+    """
+    arena = arena or ScratchArena()
+    terms = {term: arena.buffer(f'{name}_{term}', zenith.shape) for term in ('cos', 'sin', 'tan_i', 'sec_i', 'cos_i',
+                                                                              'sin_i')}
+    # theta_i, see calc_theta_i
+    theta_i = numpy.tan(zenith, out=terms['sin_i'])
+    numpy.multiply(br_ratio, theta_i, out=theta_i)
+    numpy.arctan(theta_i, out=theta_i)
+
+    numpy.cos(zenith, out=terms['cos'])
+    numpy.sin(zenith, out=terms['sin'])
+    numpy.tan(theta_i, out=terms['tan_i'])
+    numpy.cos(theta_i, out=terms['cos_i'])
+    numpy.divide(1., terms['cos_i'], out=terms['sec_i'])
+    numpy.sin(theta_i, out=terms['sin_i'])
+    return terms
+
+
+def calc_brf_terms(view, sun, cos_azimuth, sin_azimuth, band_coef, arena=None, out=None):
+    """Calculate brf from precomputed view and sun kernel terms, as calc_brf.
+
+    The view terms of a repeating geometry (or NADIR_TERMS) are computed once and
+    the sun terms once for both the sensor and the nadir brf of a date. The
+    operations are those of calc_brf, in the same order, written into four
+    window buffers.
+
+    Args:
+        view (dict): view zenith terms, see kernel_terms.
+        sun (dict): solar zenith terms, see kernel_terms.
+        cos_azimuth (numpy array): cosine of the relative azimuth.
+        sin_azimuth (numpy array): sine of the relative azimuth.
+        band_coef (float): MODIS band coefficient.
+        arena (ScratchArena): arena of the temporaries. Default allocates them.
+        out (numpy array): array receiving the brf. Default allocates it.
+
+    Returns:
+        brf : numpy.array.
+    """
+    arena = arena or ScratchArena()
+    shape = numpy.broadcast(sun['cos'], view['cos'], cos_azimuth).shape
+    a, b, c, d = (arena.buffer(f'brf_{name}', shape) for name in 'abcd')
+    out = numpy.empty(shape) if out is None else out
+
+    # Li-Sparse kernel, see li_kernel
+    # d = sqrt(tan_s*tan_s + tan_v*tan_v - 2*tan_s*tan_v*cos_azimuth)
+    numpy.multiply(sun['tan_i'], sun['tan_i'], out=a)
+    numpy.add(a, numpy.multiply(view['tan_i'], view['tan_i'], out=b), out=a)
+    numpy.multiply(2, sun['tan_i'], out=b)
+    numpy.multiply(b, view['tan_i'], out=b)
+    numpy.subtract(a, numpy.multiply(b, cos_azimuth, out=b), out=a)
+    numpy.sqrt(a, out=a)
+    # cos_t = hb_ratio * sqrt(d*d + (tan_s*tan_v*sin_azimuth)**2) / (sec_s + sec_v)
+    numpy.multiply(sun['tan_i'], view['tan_i'], out=b)
+    numpy.power(numpy.multiply(b, sin_azimuth, out=b), 2, out=b)
+    numpy.add(numpy.multiply(a, a, out=c), b, out=c)
+    numpy.multiply(hb_ratio, numpy.sqrt(c, out=c), out=c)
+    numpy.divide(c, numpy.add(sun['sec_i'], view['sec_i'], out=b), out=c)
+    # t = arccos(clip(cos_t)), big_o = (1/pi)*(t - sin(t)*cos_t)*(sec_v*sec_s)
+    numpy.arccos(numpy.maximum(-1., numpy.minimum(1., c, out=b), out=b), out=b)
+    numpy.multiply(numpy.sin(b, out=d), c, out=d)
+    numpy.multiply(1./numpy.pi, numpy.subtract(b, d, out=d), out=d)
+    numpy.multiply(d, numpy.multiply(view['sec_i'], sun['sec_i'], out=b), out=d)
+    # cos_e_i = cos_s*cos_v + sin_s*sin_v*cos_azimuth
+    numpy.multiply(sun['cos_i'], view['cos_i'], out=a)
+    numpy.multiply(numpy.multiply(sun['sin_i'], view['sin_i'], out=c), cos_azimuth, out=c)
+    numpy.add(a, c, out=a)
+    # li = big_o - sec_s - sec_v + 0.5*(1. + cos_e_i)*sec_v*sec_s
+    numpy.subtract(numpy.subtract(d, sun['sec_i'], out=d), view['sec_i'], out=d)
+    numpy.multiply(0.5, numpy.add(1., a, out=a), out=a)
+    numpy.multiply(numpy.multiply(a, view['sec_i'], out=a), sun['sec_i'], out=a)
+    li = numpy.add(d, a, out=d)
+
+    # Ross-Thick kernel, see ross_kernel
+    # cos_e = cos_s*cos_v + sin_s*sin_v*cos_azimuth
+    numpy.multiply(sun['cos'], view['cos'], out=a)
+    numpy.multiply(numpy.multiply(sun['sin'], view['sin'], out=c), cos_azimuth, out=c)
+    numpy.add(a, c, out=a)
+    # ross = (((pi/2 - e)*cos_e + sin(e)) / (cos_s + cos_v)) - pi/4
+    e = numpy.arccos(a, out=b)
+    numpy.multiply(numpy.subtract(numpy.pi / 2., e, out=c), a, out=c)
+    numpy.add(c, numpy.sin(e, out=b), out=c)
+    numpy.divide(c, numpy.add(sun['cos'], view['cos'], out=a), out=c)
+    ross = numpy.subtract(c, numpy.pi / 4, out=c)
+
+    # fiso + fvol*ross + fgeo*li
+    numpy.add(band_coef['fiso'], numpy.multiply(band_coef['fvol'], ross, out=out), out=out)
+    return numpy.add(out, numpy.multiply(band_coef['fgeo'], li, out=li), out=out)
+
+
+def calc_cfactor(view_zenith, solar_zenith, relative_azimuth, band_coef, arena=None, out=None):
+    """Calculate the c-factor (nadir brf over sensor brf) of a window.
+
+    The nadir geometry is expressed by NADIR_TERMS instead of zero view zenith
+    and relative azimuth arrays. Nodata (NaN) angles and kernels out of their
+    domain leave an undefined (NaN) c-factor, see apply_cfactor.
+
+    Args:
+        view_zenith (numpy array): view zenith.
+        solar_zenith (numpy array): solar zenith.
+        relative_azimuth (numpy array): relative azimuth.
+        band_coef (float): MODIS band coefficient.
+        arena (ScratchArena): arena of the kernel terms and temporaries. Default allocates them.
+        out (numpy array): array receiving the c-factor. Default is a buffer of arena.
+
+    Returns:
+        numpy.array: c-factor.
+    """
+    arena = arena or ScratchArena()
+    shape = solar_zenith.shape
+    out = arena.buffer('cfactor', shape) if out is None else out
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        sun = kernel_terms(solar_zenith, arena, 'sun')
+        view = kernel_terms(view_zenith, arena, 'view')
+        cos_azimuth = numpy.cos(relative_azimuth, out=arena.buffer('cos_azimuth', shape))
+        sin_azimuth = numpy.sin(relative_azimuth, out=arena.buffer('sin_azimuth', shape))
+        brf_sensor = calc_brf_terms(view, sun, cos_azimuth, sin_azimuth, band_coef, arena,
+                                    arena.buffer('brf_sensor', shape))
+        brf_ref = calc_brf_terms(NADIR_TERMS, sun, 1., 0., band_coef, arena, out)
+        return numpy.divide(brf_ref, brf_sensor, out=brf_ref)
+
+
+def calc_cfactor_where(view_zenith, solar_zenith, relative_azimuth, band_coef, where, arena=None):
+    """Calculate the c-factor of the pixels of a window where a condition holds.
+
+    The angles of these pixels are packed before the kernels, so that their cost
+    is that of the pixels computed. The c-factor of the other pixels is undefined (NaN).
+
+    Args:
+        view_zenith (numpy array): view zenith.
+        solar_zenith (numpy array): solar zenith.
+        relative_azimuth (numpy array): relative azimuth.
+        band_coef (float): MODIS band coefficient.
+        where (numpy array): boolean array, True for the pixels computed.
+        arena (ScratchArena): arena of the packed angles, kernel terms and c-factor. Default allocates them.
+
+    Returns:
+        numpy.array: c-factor.
+    """
+    arena = arena or ScratchArena()
+    count = int(numpy.count_nonzero(where))
+    packed = [numpy.compress(where.ravel(), angle.ravel(), out=arena.buffer(f'{name}_packed', (count,), angle.dtype))
+              for name, angle in (('view_zenith', view_zenith), ('solar_zenith', solar_zenith),
+                                  ('relative_azimuth', relative_azimuth))]
+    c_factor = arena.buffer('cfactor', where.shape)
+    c_factor.fill(numpy.nan)
+    numpy.place(c_factor, where, calc_cfactor(*packed, band_coef, arena, arena.buffer('cfactor_packed', (count,))))
+    return c_factor
+
+
 def bandpassHLS_1_4(img, band, satsen):
     """Bandpass function applied to Sentinel-2 data as followed in HLS 1.4 products.
 
@@ -349,173 +683,705 @@ def bandpassHLS_1_4(img, band, satsen):
 
     Args:
         img (array): Array containing image pixel values.
-        band (str): Band that will be processed, which can be 'B02','B03','B04','B8A','B01','B11' or 'B12'.
+        band (str): Band that will be processed, which can be 'B02','B03','B04','B8A','B01','B11' or 'B12',
+            or its common name.
         satsen (str): Satellite sensor, which can be 'S2A' or 'S2B'.
     Returns:
         array: Array containing image pixel values bandpassed.
     """
-    logging.info('Applying bandpass band {} satsen {}'.format(band, satsen))
+    logging.debug('Applying bandpass band {} satsen {}'.format(band, satsen))
     # Skakun et. al, 2018 - Harmonized Landsat Sentinel-2 (HLS) Product User’s Guide
-    if satsen == 'S2A':
-        if band == 'coastal':  # UltraBlue/coastal #MODIS don't have this band # B01
-            slope = 0.9959
-            offset = -0.0002
-        elif band == 'blue':  # Blue # B02
-            slope = 0.9778
-            offset = -0.004
-        elif band == 'green':  # Green # B03
-            slope = 1.0053
-            offset = -0.0009
-        elif band == 'red':  # Red # B04
-            slope = 0.9765
-            offset = 0.0009
-        elif band == 'nir':  # Nir # B08 B8A
-            slope = 0.9983
-            offset = -0.0001
-        elif band == 'swir1':  # Swir 1 # B11
-            slope = 0.9987
-            offset = -0.0011
-        elif band == 'swir2':  # Swir 2 # B12
-            slope = 1.003
-            offset = -0.0012
-        img = numpy.add(numpy.multiply(img, slope), offset)
-
-    elif satsen == 'S2B':
-        logging.debug("S2B")
-        if band == 'coastal':  # UltraBlue/coastal #MODIS don't have this band # B01
-            slope = 0.9959
-            offset = -0.0002
-        elif band == 'blue':  # Blue # B02
-            slope = 0.9778
-            offset = -0.004
-        elif band == 'green':  # Green # B03
-            slope = 1.0075
-            offset = -0.0008
-        elif band == 'red':  # Red # B04
-            slope = 0.9761
-            offset = 0.001
-        elif band == 'nir':  # Nir # B08 B8A
-            slope = 0.9966
-            offset = 0.000
-        elif band == 'swir1':  # Swir 1 # B11
-            slope = 1.000
-            offset = -0.0003
-        elif band == 'swir2':  # Swir 2 # B12
-            slope = 0.9867
-            offset = -0.0004
-
-        img = numpy.add(numpy.multiply(img, slope), offset)
-
-    return img
-
-
-def process_NBAR(parsed_sceneid, img_dir, bands, sz_path, sa_path, vz_path, va_path, out_dir, apply_bandpass=True, nodata = 0):
-    """Calculate Normalized BRDF Adjusted Reflectance (NBAR).
+    sensor = sensors.get(satsen)
+    if sensor is None or not sensor.has_bandpass:
+        return img
+    if band not in sensor.index:
+        # A common name, the bands of a common name share its coefficients
+        matches = numpy.flatnonzero(sensor.common_names == band)
+        if not matches.size:
+            return img
+        band = sensor.bands[matches[0]]
+    slope, offset = sensor.bandpass(band)
+    return numpy.add(numpy.multiply(img, slope), offset)
+
+
+def band_paths(parsed_sceneid, img_dir, b, out_dir, nodata=0):
+    """Retrieve the input and output files of a band.
 
     Args:
         parsed_sceneid (dict): parsed scene id.
         img_dir (str): input directory.
-        bands (list): list of bands to process.
-        sz_path (str): solar zenith angle.
-        sa_path (str): solar azimuth angle.
-        vz_path (str): view (sensor) zenith angle.
-        va_path (str): view (sensor) azimuth angle.
+        b (str): band.
         out_dir: output directory.
-        apply_bandpass (bool): verify if band pass will be applied.
+        nodata (int): nodata value, overwritten by the Landsat collection nodata.
+
+    Returns:
+        satsen, img_path, output_file, nodata: satellite sensor, input file path, output file path and nodata value.
     """
     scene_id = parsed_sceneid.group(0)
-    output_files = []
+    # Search for input file
+    r = re.compile('.*_{}.tif$|.*_{}.*jp2$'.format(b, b))
+    imgs_in_dir = listdir(img_dir)
+    logging.debug(list(filter(r.match, imgs_in_dir)))
+
+    # TODO: We should use file name. Check which of them have same filename and try to get from some angle band
+    if is_sentinel2(scene_id):
+        satsen = f'S{parsed_sceneid["sensor"]}{parsed_sceneid["satellite"]}'
+        input_file = Path(list(filter(r.match, imgs_in_dir))[0])
+        output_file = out_dir.joinpath(Path(input_file).stem + '_NBAR').with_suffix('.tif')
+    elif is_landsat(scene_id):
+        satsen = f'L{parsed_sceneid["sensor"]}{parsed_sceneid["satellite"]}'
+        if parsed_sceneid["collectionNumber"] == '01':
+            nodata = -9999
+            _extension = 'tif'
+            _processing_level = '_sr_'
+        elif parsed_sceneid["collectionNumber"] == '02':
+            nodata = 0
+            _extension = 'TIF'
+            _processing_level = '_SR_'
+
+        input_file = Path(img_dir).joinpath(f'{scene_id}_{b}.{_extension}')
+        output_file = out_dir.joinpath(Path(input_file.name.replace(_processing_level, '_NBAR_')).with_suffix('.tif'))
+
+    img_path = Path(img_dir).joinpath(input_file)
+
+    return satsen, img_path, output_file, nodata
+
+
+def output_nodata(output_dtype, nodata, mapped_nodata=None):
+    """Retrieve the output nodata value of an output data type.
 
-    for b in bands:
-        logging.info(f"Harmonizing band {b} ...")
-        # Search for input file
-        r = re.compile('.*_{}.tif$|.*_{}.*jp2$'.format(b, b))
-        imgs_in_dir = os.listdir(img_dir)
-        logging.debug(list(filter(r.match, imgs_in_dir)))
-
-        # TODO: We should use file name. Check which of them have same filename and try to get from some angle band
-        if is_sentinel2(scene_id):
-            satsen = f'S{parsed_sceneid["sensor"]}{parsed_sceneid["satellite"]}'
-            input_file = Path(list(filter(r.match, imgs_in_dir))[0])
-            output_file = out_dir.joinpath(Path(input_file).stem + '_NBAR').with_suffix('.tif')
-        elif is_landsat(scene_id):
-            satsen = f'L{parsed_sceneid["sensor"]}{parsed_sceneid["satellite"]}'
-            if parsed_sceneid["collectionNumber"] == '01':
-                nodata = -9999
-                _extension = 'tif'
-                _processing_level = '_sr_'
-            elif parsed_sceneid["collectionNumber"] == '02':
-                nodata = 0
-                _extension = 'TIF'
-                _processing_level = '_SR_'
-
-            input_file = Path(img_dir).joinpath(f'{scene_id}_{b}.{_extension}')
-            output_file = out_dir.joinpath(Path(input_file.name.replace(_processing_level, '_NBAR_')).with_suffix('.tif'))
-
-        img_path = img_dir.joinpath(input_file)
+    Args:
+        output_dtype (str): output data type, one of OUTPUT_DTYPES.
+        nodata (int): nodata value of the input band.
+        mapped_nodata (int): explicit output nodata value. Defaults to the input nodata value.
 
-        # Prepare template band
-        with rasterio.open(img_path) as src:
-            profile = src.profile
-            tilelist = list(src.block_windows())
-            height, width = src.shape
-            profile['nodata'] = nodata
-        nbar = numpy.full((height, width), dtype='float', fill_value=nodata)
+    Returns:
+        int: output nodata value.
+    """
+    if output_dtype not in OUTPUT_DTYPES:
+        raise RuntimeError(f'Output data type {output_dtype} is not one of {", ".join(OUTPUT_DTYPES)}')
+    value = nodata if mapped_nodata is None else mapped_nodata
+    info = numpy.iinfo(output_dtype)
+    if not info.min <= value <= info.max:
+        raise RuntimeError(f'Nodata {value} cannot be represented as {output_dtype}, set an output nodata value')
+    return value
 
-        band_common_name = consult_band(b, satsen)
-        band_coef = brdf_coefficients[band_common_name]
 
-        for _, window in tilelist:
-            logging.debug(f"Harmonizing band {b} window {window}")
-            row_offset = window.row_off + window.height
-            col_offset = window.col_off + window.width
+def quantize(values, nodata, out, mask=None, arena=None):
+    """Convert a window of NBAR values into the integer output array, saturating at its range.
+
+    The values are truncated towards zero as the int32 output. Masked and NaN pixels
+    are set to nodata and the valid values are clipped to the range of the output data
+    type, excluding nodata when it is the minimum or the maximum of the range, so that
+    saturated pixels remain valid.
+
+    Args:
+        values (numpy.array): NBAR values of the window.
+        nodata (int): output nodata value.
+        out (numpy.array): output array view of the window, receiving the values.
+        mask (numpy.array): boolean array, True for nodata pixels.
+        arena (ScratchArena): arena of the nodata mask. Default allocates it.
+
+    Returns:
+        numpy.array: out.
+    """
+    info = numpy.iinfo(out.dtype)
+    low = info.min + 1 if nodata == info.min else info.min
+    high = info.max - 1 if nodata == info.max else info.max
+    values = numpy.asarray(values)
+    invalid = arena.buffer('invalid', values.shape, bool) if arena is not None else None
+    if values.dtype.kind == 'f':
+        invalid = numpy.isnan(values, out=invalid)
+    elif invalid is None:
+        invalid = numpy.zeros(values.shape, dtype=bool)
+    else:
+        invalid[...] = False
+    if mask is not None:
+        invalid |= mask
+    numpy.clip(values, low, high, out=out, casting='unsafe')
+    numpy.copyto(out, nodata, where=invalid)
+    return out
+
+
+def downsample(data, factor: int, nodata, resampling: str = 'average'):
+    """Reduce a band by an integer factor, as an overview level.
+
+    Args:
+        data (numpy.array): band.
+        factor (int): reduction factor.
+        nodata (int): nodata value, ignored by the average.
+        resampling (str): 'average' (of the valid pixels, rounded) or 'nearest'.
 
-            # Load angle bands
-            view_zenith, solar_zenith, relative_azimuth = prepare_angles(sz_path, sa_path, vz_path, va_path, satsen, b,
-                                                                         window)
+    Returns:
+        numpy.array: reduced band, of ceil(height / factor) by ceil(width / factor) pixels.
+    """
+    height, width = data.shape
+    out = numpy.full((-(-height // factor), -(-width // factor)), nodata, dtype=data.dtype)
+    if resampling == 'nearest':
+        out[...] = data[::factor, ::factor]
+        return out
+
+    # Row strips bound the temporaries
+    step = factor * max(1, 1024 // factor)
+    for row in range(0, height, step):
+        strip = data[row: row + step]
+        rows = -(-strip.shape[0] // factor)
+        padded = numpy.full((rows * factor, out.shape[1] * factor), nodata, dtype=data.dtype)
+        padded[:strip.shape[0], :width] = strip
+        blocks = padded.reshape(rows, factor, out.shape[1], factor)
+        valid = blocks != nodata
+        count = valid.sum(axis=(1, 3))
+        total = numpy.where(valid, blocks, 0).sum(axis=(1, 3), dtype='float64')
+        mean = numpy.floor(total / numpy.maximum(count, 1) + 0.5)
+        out[row // factor: row // factor + rows] = numpy.where(count > 0, mean, nodata)
+    return out
+
+
+def write_overviews(output_file, data, overviews, resampling: str = 'average', nodata=0):
+    """Write the internal overviews of a band from its array in memory, without reading the band file.
+
+    The overview levels must exist (created empty by ``build_overviews`` before
+    the band is written). Each level is reduced from the previous one.
+
+    Args:
+        output_file (str): path to the GeoTIFF band.
+        data (numpy.array): band written in output_file.
+        overviews (list): increasing overview factors, e.g. [2, 4, 8, 16].
+        resampling (str): 'average' or 'nearest'.
+        nodata (int): nodata value.
+    """
+    if resampling not in OVERVIEW_RESAMPLING:
+        raise RuntimeError(f'Overview resampling {resampling} is not one of {", ".join(OVERVIEW_RESAMPLING)}')
+    level, previous = data, 1
+    for index, factor in enumerate(overviews):
+        if factor % previous == 0:
+            level = downsample(level, factor // previous, nodata, resampling)
+        else:
+            level = downsample(data, factor, nodata, resampling)
+        previous = factor
+        with rasterio.open(str(output_file), 'r+', overview_level=index) as dst:
+            dst.write(level, 1)
+
+
+def cfactor_path(cfactor_dir, img_path, window=None) -> Path:
+    """Retrieve the path of the persisted c-factor of a band (and of an output window).
+
+    Args:
+        cfactor_dir (str): directory of the persisted c-factors.
+        img_path (str): path to input band file.
+        window (Window): output window of the band, when cropped to an area of interest or to row shards.
+
+    Returns:
+        Path: path to the c-factor raster.
+    """
+    name = f'{Path(img_path).stem}_CFACTOR'
+    if window is not None:
+        name += f'_{int(window.col_off)}_{int(window.row_off)}_{int(window.width)}_{int(window.height)}'
+    return Path(cfactor_dir) / f'{name}.tif'
+
+
+def open_cfactor(cfactor_file, profile):
+    """Open a persisted c-factor raster for reading, or its temporary file for writing when it is missing.
+
+    The c-factor is written as deflate compressed float32 with the floating point predictor,
+    about a tenth of float64. The run saving it applies the float32 values too, so the runs reusing it
+    write the same NBAR. Its rounding changes a few NBAR pixels by 1 DN at most from a run without c-factors.
 
-            brf_sensor = calc_brf(view_zenith, solar_zenith, relative_azimuth, band_coef)
-            brf_ref = calc_brf(numpy.zeros(view_zenith.shape), solar_zenith, numpy.zeros(view_zenith.shape), band_coef)
-            c_factor = brf_ref/brf_sensor
+    Args:
+        cfactor_file (Path): path to the c-factor raster.
+        profile (dict): output profile (height, width, crs, transform) of the band.
 
-            # Reading input reflectance image
-            reflectance_img = load_img(img_path, window)
+    Returns:
+        DatasetReader|DatasetWriter, Path: opened c-factor dataset and the temporary file (None when reading).
+    """
+    if cfactor_file.exists():
+        dataset = rasterio.open(str(cfactor_file))
+        if dataset.shape != (profile['height'], profile['width']):
+            dataset.close()
+            raise RuntimeError(f'C-factor {cfactor_file} does not match the output grid')
+        return dataset, None
+
+    cfactor_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cfactor_file.with_name(f'.{cfactor_file.stem}.{os.getpid()}.tif')
+    block_height, block_width = (profile['blockysize'], profile['blockxsize']) if profile.get('tiled') else (256, 256)
+    dataset = rasterio.open(str(tmp_file), 'w', driver='GTiff', height=profile['height'], width=profile['width'],
+                            count=1, dtype='float32', crs=profile['crs'], transform=profile['transform'],
+                            nodata=float('nan'), tiled=True, blockxsize=block_width, blockysize=block_height,
+                            compress='deflate', predictor=3)
+    return dataset, tmp_file
+
+
+def apply_cfactor(reflectance, mask, c_factor, rescale=False, arena=None):
+    """Apply the c-factor to the reflectance of a window, as plain arrays.
+
+    The reflectance is kept unchanged where the c-factor is undefined (NaN or
+    infinite), i.e. at the nodata pixels of the angles or where the kernels are
+    out of their domain.
 
-            # Apply scale for Landsat Collection-2
-            if is_landsat(scene_id) and \
-            (not numpy.all(reflectance_img.mask)) and \
-            parsed_sceneid["collectionNumber"] == '02':
-                reflectance_img =  ((reflectance_img * 0.275)-2000) #Rescale data to 0-10000 -> ((raster1_arr * 0.0000275)-0.2)
+    Args:
+        reflectance (numpy.array): reflectance of the window.
+        mask (numpy.array): boolean array, True for the nodata pixels of the reflectance.
+        c_factor (numpy.array): c-factor of the window.
+        rescale (bool): rescale Landsat Collection-2 reflectance to 0-10000.
+        arena (ScratchArena): arena receiving the NBAR values. Default allocates them.
+
+    Returns:
+        numpy.array: NBAR values of the window.
+    """
+    def buffer(name, dtype):
+        return arena.buffer(name, reflectance.shape, dtype) if arena is not None else None
 
-            # Producing NBAR band
-            nbar[window.row_off: row_offset, window.col_off: col_offset] = reflectance_img * c_factor
+    # Apply scale for Landsat Collection-2
+    if rescale and not mask.all():
+        #Rescale data to 0-10000 -> ((raster1_arr * 0.0000275)-0.2)
+        reflectance = numpy.multiply(reflectance, 0.275, out=buffer('rescaled', 'float64'))
+        numpy.subtract(reflectance, 2000, out=reflectance)
+
+    values = numpy.multiply(reflectance, c_factor, out=buffer('nbar', numpy.result_type(reflectance, c_factor)))
+    undefined = numpy.isfinite(c_factor, out=buffer('undefined', bool))
+    numpy.logical_not(undefined, out=undefined)
+    if undefined.any():
+        numpy.copyto(values, reflectance, where=undefined)
+    return values
+
+
+def nbar_window(src, window, c_factor, b, satsen, rescale=False, bandpass=False, arena=None):
+    """Apply the c-factor to the reflectance of a window.
+
+    Args:
+        src (DatasetReader): opened reflectance dataset.
+        window (Window): window of the dataset.
+        c_factor (numpy.array): c-factor of the window, see apply_cfactor.
+        b (str): band.
+        satsen (str): satellite sensor.
+        rescale (bool): rescale Landsat Collection-2 reflectance to 0-10000.
+        bandpass (bool): apply the sensor bandpass.
+        arena (ScratchArena): arena receiving the reflectance, its mask and the NBAR values.
+
+    Returns:
+        numpy.array, numpy.array: NBAR values and nodata mask of the window.
+    """
+    # Reading input reflectance image
+    reflectance_img, mask = read_window(src, window, arena=arena, name='reflectance')
+
+    # Producing NBAR band
+    values = apply_cfactor(reflectance_img, mask, c_factor, rescale, arena)
+    if bandpass:
+        values = bandpassHLS_1_4(values, b, satsen).astype(src.dtypes[0])
+
+    return values, mask
+
+
+def harmonize_band(img_path, output_file, b, satsen, sz_path, sa_path, vz_path, va_path,
+                   apply_bandpass=True, nodata=0, aoi=None, aoi_crs='EPSG:4326', angles=None, rescale=False,
+                   store=None, time_index=0, jp2_strategy='open', rows=None, output_dtype='int32',
+                   mapped_nodata=None, cfactor_dir=None, overviews=None, overview_resampling='average',
+                   statistics=False, grid=None, tile=None, arrays=None, qa=None, gdal_options=None):
+    """Calculate the Normalized BRDF Adjusted Reflectance (NBAR) of a band.
+
+    Args:
+        img_path (str): path to input band file.
+        output_file (str): path to output NBAR file.
+        b (str): band.
+        satsen (str): satellite sensor.
+        sz_path (str): solar zenith angle.
+        sa_path (str): solar azimuth angle.
+        vz_path (str): view (sensor) zenith angle.
+        va_path (str): view (sensor) azimuth angle.
+        apply_bandpass (bool): verify if band pass will be applied.
+        nodata (int): output nodata value.
+        aoi (tuple|dict): area of interest, bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+        aoi_crs (str): coordinate reference system of aoi.
+        angles (AngleProvider): angle provider used instead of the angle files.
+        rescale (bool): rescale Landsat Collection-2 reflectance to 0-10000.
+        store (ZarrStore): chunked store receiving the band instead of a GeoTIFF file.
+        time_index (int): scene time index in store.
+        jp2_strategy (str): JPEG2000 decode strategy, 'open' (multi-threaded, tile aligned) or 'transcode'
+            (one-shot transcode into a temporary tiled GeoTIFF).
+        rows (tuple): (start, stop) rows of the output grid to harmonize, e.g. a shard. Default is all rows.
+        output_dtype (str): output data type, 'int32', 'int16' or 'uint16'. Each window is quantized into
+            the output array with a saturating conversion, see quantize.
+        mapped_nodata (int): output nodata value replacing nodata, e.g. when nodata cannot be represented
+            as output_dtype.
+        cfactor_dir (str): directory of the persisted c-factors. When the c-factor of the band (and of
+            its output window) exists, it is read instead of computing the angles and kernels, otherwise
+            the computed c-factor is saved in it.
+        overviews (list): overview factors (e.g. [2, 4, 8, 16]) of the internal overviews of the GeoTIFF output,
+            reduced from the band in memory. Row shards leave them to the assembly.
+        overview_resampling (str): overview resampling, 'average' or 'nearest'.
+        statistics (bool): accumulate the statistics and histogram of the band per window and write
+            them as GDAL band metadata of the GeoTIFF output, see BandStatistics.
+        grid (TargetGrid): target grid the band is warped into, from memory, before it is written.
+        tile (tuple): (horizontal, vertical) tile of grid receiving the band. Default is the grid aligned
+            extent of the band. The aoi should cover the tile, see nbar_tasks.
+        arrays (dict): receives the output array and profile (tuple) of the band, e.g. to derive
+            spectral indices from memory, see harmonize_indices.
+        qa (QualityMask): quality mask of the scene. Its skipped pixels are written as nodata, the angles and
+            kernels of the other pixels only are computed, and the skip counts are written as GDAL band metadata
+            of the GeoTIFF output. A saved c-factor is computed for whole windows, so it is reusable.
+        gdal_options (dict): GDAL options of the reads and writes, overriding the GDAL profile, see io_env.
+
+    Returns:
+        dict: output file by band.
+    """
+    logging.info(f"Harmonizing band {b} ...")
+    out_nodata = output_nodata(output_dtype, nodata, mapped_nodata)
+    if statistics and store is not None:
+        raise RuntimeError('Band statistics are written as GeoTIFF metadata, not into a store')
+    if grid is not None and rows is not None:
+        raise RuntimeError('Row shards are written in the native grid, not in a target grid')
+    # The statistics of a warped band are those of the grid pixels
+    stats = BandStatistics() if statistics and grid is None else None
+
+    # The reflectance dataset is kept open for all windows
+    with object_env(img_path), io_env(gdal_options), open_reflectance(img_path, jp2_strategy) as src, \
+            ExitStack() as stack:
+        # Prepare template band
+        profile = src.profile
+        tilelist = list(src.block_windows())
+        height, width = src.shape
+        profile['nodata'] = out_nodata
+        output_window = aoi_window(src, aoi, aoi_crs) if aoi is not None else Window(0, 0, width, height)
+        if rows is not None:
+            output_window = Window(output_window.col_off, output_window.row_off + rows[0], output_window.width,
+                                   min(rows[1], output_window.height) - rows[0])
+        cropped = aoi is not None or rows is not None
+        if cropped:
+            profile['height'] = height = int(output_window.height)
+            profile['width'] = width = int(output_window.width)
+            profile['transform'] = src.window_transform(output_window)
+        nbar = numpy.full((height, width), dtype=output_dtype, fill_value=out_nodata)
+
+        band_coef = get_sensor(satsen).brdf(b)
+
+        # Reuse or persist the geometry dependent c-factor. A cropped output reuses the c-factor of the
+        # whole band when it exists, otherwise the c-factor of its own window
+        cfactor, cfactor_tmp, whole_band = None, None, False
+        if cfactor_dir is not None:
+            cfactor_file = cfactor_path(cfactor_dir, img_path)
+            whole_band = cropped and cfactor_file.exists()
+            if cropped and not whole_band:
+                cfactor_file = cfactor_path(cfactor_dir, img_path, output_window)
+            cfactor, cfactor_tmp = open_cfactor(cfactor_file, src.profile if whole_band else profile)
+            stack.enter_context(cfactor)
+            logging.info(f'{"Saving" if cfactor_tmp else "Reusing"} c-factor {cfactor_file}')
+
+        # The quality band is read window by window, before the c-factor
+        qa_src, skipped = None, None
+        if qa is not None:
+            from .qa import QualitySkip
+            qa_src = stack.enter_context(open_reflectance(qa.path, jp2_strategy))
+            skipped = QualitySkip()
+
+        # Mask out pixels outside of a geometry area of interest
+        outside = None
+        if aoi is not None and is_geometry(aoi):
+            outside = aoi_mask(aoi, aoi_crs, profile['crs'], profile['transform'], nbar.shape)
 
         # Check if apply bandpass
-        if apply_bandpass:
-            if (satsen == 'S2A') or (satsen == 'S2B'):
-                logging.info("Performing bandpass ...")
-                nbar = bandpassHLS_1_4(nbar, consult_band(b, satsen), satsen).astype(profile['dtype'])
-
-        logging.info(profile)
-        profile['dtype'] = numpy.intc
-        nbar_dataset = rasterio.open(
-            str(output_file),
-            'w',
-            driver='GTiff',
-            height=profile['height'],
-            width=profile['width'],
-            count=profile['count'],
-            dtype=numpy.intc,#str(resampled_array.dtype),
-            crs=profile['crs'],
-            transform=profile['transform'],
-            nodata=profile['nodata'],
-            compress='deflate'
-        )
-        nbar_dataset.write(nbar.astype(numpy.intc), 1)
-        nbar_dataset.close()
+        bandpass = apply_bandpass and get_sensor(satsen).has_bandpass
+        if bandpass:
+            logging.info("Performing bandpass ...")
+
+        # The temporaries of the windows are written into the buffers of the worker
+        arena = scratch_arena()
+        progress = getattr(_worker, 'progress', None)
+        if cropped:
+            tilelist = [(index, window) for index, window in tilelist if windows_intersect(window, output_window)]
+
+        for done, (_, window) in enumerate(tilelist):
+            if progress is not None:
+                progress(b, done, len(tilelist))
+            if cropped:
+                window = window.intersection(output_window)
+            logging.debug(f"Harmonizing band {b} window {window}")
+            row_start = window.row_off - output_window.row_off
+            col_start = window.col_off - output_window.col_off
+            row_offset = row_start + window.height
+            col_offset = col_start + window.width
+            cfactor_window = Window(col_start, row_start, window.width, window.height)
+            shape = (int(window.height), int(window.width))
+
+            skip = None
+            if qa_src is not None:
+                skip = qa.read(qa_src, src, window, arena)
+                skipped.update(skip)
+                if skip.all() and cfactor_tmp is None:
+                    # The output window is left nodata
+                    if stats is not None:
+                        stats.update(nbar[row_start: row_offset, col_start: col_offset], out_nodata)
+                    continue
+                if not skip.any():
+                    skip = None
+
+            if cfactor is not None and cfactor_tmp is None:
+                c_factor = cfactor.read(1, window=window if whole_band else cfactor_window,
+                                        out=arena.buffer('cfactor', shape, 'float32'))
+            else:
+                # Load angle bands
+                view_zenith, solar_zenith, relative_azimuth = prepare_angles(sz_path, sa_path, vz_path, va_path,
+                                                                             satsen, b, window, angles=angles,
+                                                                             arena=arena)
+
+                if skip is not None and cfactor is None:
+                    kept = numpy.logical_not(skip, out=arena.buffer('kept', shape, bool))
+                    c_factor = calc_cfactor_where(view_zenith, solar_zenith, relative_azimuth, band_coef, kept,
+                                                  arena)
+                else:
+                    c_factor = calc_cfactor(view_zenith, solar_zenith, relative_azimuth, band_coef, arena)
+                if cfactor is not None:
+                    # The saved float32 c-factor is applied, so a run reusing it writes the same NBAR
+                    saved = arena.buffer('cfactor_float32', shape, 'float32')
+                    numpy.copyto(saved, c_factor, casting='same_kind')
+                    cfactor.write(saved, 1, window=cfactor_window)
+                    c_factor = saved
+
+            window_nbar, mask = nbar_window(src, window, c_factor, b, satsen, rescale, bandpass, arena)
+            if outside is not None:
+                numpy.logical_or(mask, outside[row_start: row_offset, col_start: col_offset], out=mask)
+            if skip is not None:
+                numpy.logical_or(mask, skip, out=mask)
+
+            quantize(window_nbar, out_nodata, nbar[row_start: row_offset, col_start: col_offset], mask, arena)
+            if stats is not None:
+                stats.update(nbar[row_start: row_offset, col_start: col_offset], out_nodata)
+
+        if cfactor_tmp is not None:
+            cfactor.close()
+            os.replace(cfactor_tmp, cfactor_file)
+        if progress is not None:
+            progress(b, len(tilelist), len(tilelist))
+
+    tags = None
+    if skipped is not None:
+        logging.info(f'Band {b}: quality mask {skipped}')
+        tags = skipped.tags()
+    logging.info(profile)
+    profile['dtype'] = output_dtype
+    if grid is not None:
+        nbar, profile['transform'] = grid.warp(nbar, profile['transform'], profile['crs'], out_nodata, tile)
+        profile.update(crs=grid.crs, height=nbar.shape[0], width=nbar.shape[1])
+        if statistics:
+            stats = BandStatistics().update(nbar, out_nodata)
+    if store is not None and rows is not None:
+        raise RuntimeError('Row shards are written as GeoTIFF parts, not into a store')
+    if arrays is not None:
+        arrays[b] = nbar, profile
+
+    overviews = overviews if rows is None else None
+    with io_env(gdal_options):
+        return {b: write_band(nbar, output_file, b, profile, store, time_index, overviews, overview_resampling,
+                              stats, tags)}
+
+
+def write_band(data, output_file, name, profile, store=None, time_index=0, overviews=None,
+               overview_resampling='average', stats=None, tags=None):
+    """Write a harmonized (or derived) band into a GeoTIFF file or into a store.
 
-        output = {}
-        output[b] = output_file
-        output_files.append(output)
+    Args:
+        data (numpy.array): band array.
+        output_file (str): path to output file.
+        name (str): band name in store.
+        profile (dict): output profile (height, width, crs, transform, nodata and blocks).
+        store (ZarrStore): chunked store receiving the band instead of a GeoTIFF file.
+        time_index (int): scene time index in store.
+        overviews (list): overview factors of the GeoTIFF output, reduced from data.
+        overview_resampling (str): overview resampling, 'average' or 'nearest'.
+        stats (BandStatistics): statistics written as GDAL band metadata.
+        tags (dict): other GDAL band metadata of the GeoTIFF output, e.g. the quality skip counts.
 
-    return output_files
+    Returns:
+        Path: path to the output file or to the band array of store.
+    """
+    if store is not None:
+        chunks = (profile['blockysize'], profile['blockxsize']) if profile.get('tiled') else (512, 512)
+        store.create_band(name, profile['height'], profile['width'], data.dtype.name, profile['nodata'],
+                          profile['transform'], profile['crs'], chunks)
+        store.write(name, time_index, data)
+        return Path(store.path) / name
+
+    nbar_dataset = rasterio.open(
+        str(output_file),
+        'w',
+        driver='GTiff',
+        height=profile['height'],
+        width=profile['width'],
+        count=profile['count'],
+        dtype=data.dtype.name,
+        crs=profile['crs'],
+        transform=profile['transform'],
+        nodata=profile['nodata'],
+        compress='deflate'
+    )
+    overviews = sorted(overviews) if overviews else None
+    if overviews:
+        # Create the empty overview levels, filled from the array below
+        nbar_dataset.build_overviews(overviews, Resampling.nearest)
+    nbar_dataset.write(data, 1)
+    if stats is not None:
+        nbar_dataset.update_tags(1, **stats.tags())
+    if tags:
+        nbar_dataset.update_tags(1, **tags)
+    nbar_dataset.close()
+    if overviews:
+        write_overviews(output_file, data, overviews, overview_resampling, profile['nodata'])
+
+    return output_file
+
+
+def estimate_band_footprint(img_path, aoi=None, aoi_crs='EPSG:4326', output_dtype='int32', overviews=None,
+                            grid=None, tile=None):
+    """Estimate the peak memory (bytes) used by harmonize_band.
+
+    The estimate sums the full-size buffers (output array, geometry mask and overview
+    levels) and the live temporaries of a window iteration.
+
+    Args:
+        img_path (str): path to input band file.
+        aoi (tuple|dict): area of interest.
+        aoi_crs (str): coordinate reference system of aoi.
+        output_dtype (str): output data type.
+        overviews (list): overview factors.
+        grid (TargetGrid): target grid, its warped band is also kept in memory.
+        tile (tuple): target tile of grid.
+
+    Returns:
+        int: estimated memory in bytes.
+    """
+    with rasterio.open(img_path) as src:
+        window = aoi_window(src, aoi, aoi_crs) if aoi is not None else Window(0, 0, src.width, src.height)
+        block_height, block_width = src.block_shapes[0]
+        pixels = int(window.width) * int(window.height)
+        if grid is not None:
+            _, grid_width, grid_height = grid.target(src.window_transform(window), int(window.width),
+                                                     int(window.height), src.crs, tile)
+
+    output_buffers = numpy.dtype(output_dtype).itemsize + (1 if aoi is not None and is_geometry(aoi) else 0)
+    footprint = pixels * output_buffers
+    if grid is not None:
+        # The overviews are reduced from the warped band
+        pixels = grid_width * grid_height
+        footprint += pixels * numpy.dtype(output_dtype).itemsize
+    if overviews:
+        # The first level (a quarter of the band) and its reduction temporaries
+        footprint += pixels * (numpy.dtype(output_dtype).itemsize / 4 + 1)
+    return int(footprint) + block_height * block_width * 8 * WINDOW_TEMPORARIES
+
+
+def nbar_tasks(parsed_sceneid, img_dir, bands, sz_path, sa_path, vz_path, va_path, out_dir, apply_bandpass=True, nodata=0,
+               aoi=None, aoi_crs='EPSG:4326', angles=None, estimate=True, store=None, time_index=0,
+               jp2_strategy='open', output_dtype='int32', mapped_nodata=None, cfactor_dir=None, overviews=None,
+               overview_resampling='average', statistics=False, grid=None, tile=None, indices=None, qa=None,
+               gdal_options=None):
+    """Build the band harmonization tasks of a scene for a Scheduler.
+
+    A target tile without an area of interest restricts the harmonization to the windows covering it.
+    The bands of the spectral indices are grouped into a single harmonize_indices task.
+
+    Args:
+        See process_NBAR.
+        time_index (int): scene time index in store.
+        estimate (bool): estimate the task memory footprint. When False, the footprint is 0.
+
+    Returns:
+        list: tasks (footprint, function, args, kwargs).
+    """
+    scene_id = parsed_sceneid.group(0)
+    rescale = is_landsat(scene_id) and parsed_sceneid["collectionNumber"] == '02'
+    if grid is not None and tile is not None and aoi is None:
+        aoi, aoi_crs = grid.tile_bounds(tile, TILE_MARGIN), grid.crs
+    tasks = []
+    for b in bands:
+        satsen, img_path, output_file, band_nodata = band_paths(parsed_sceneid, img_dir, b, out_dir, nodata)
+        footprint = estimate_band_footprint(img_path, aoi, aoi_crs, output_dtype, overviews, grid,
+                                            tile) if estimate else 0
+        args = (img_path, output_file, b, satsen, sz_path, sa_path, vz_path, va_path)
+        kwargs = dict(apply_bandpass=apply_bandpass, nodata=band_nodata, aoi=aoi, aoi_crs=aoi_crs, angles=angles,
+                      rescale=rescale, store=store, time_index=time_index, jp2_strategy=jp2_strategy,
+                      output_dtype=output_dtype, mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir,
+                      overviews=overviews, overview_resampling=overview_resampling, statistics=statistics,
+                      grid=grid, tile=tile, qa=qa, gdal_options=gdal_options)
+        tasks.append((footprint, harmonize_band, args, kwargs))
+
+    if indices:
+        from .indices import harmonize_indices, index_bands, index_file
+        found = index_bands(indices, bands, satsen)
+        missing = [index for index in indices if index not in found]
+        if missing:
+            raise RuntimeError(f'Spectral indices {missing} need bands missing in {bands}')
+        index_band_names = {b for index_band_names in found.values() for b in index_band_names}
+        group = [task for task in tasks if task[2][2] in index_band_names]
+        tasks = [task for task in tasks if task[2][2] not in index_band_names]
+        # The band arrays are all kept, and each index array is smaller than a band footprint
+        footprint = sum(task[0] for task in group) + len(found) * max(task[0] for task in group)
+        output_files = {index: index_file(out_dir, scene_id, index) for index in found}
+        tasks.append((footprint, harmonize_indices, (group, found, output_files, statistics), {}))
+    return tasks
+
+
+def process_NBAR(parsed_sceneid, img_dir, bands, sz_path, sa_path, vz_path, va_path, out_dir, apply_bandpass=True, nodata = 0,
+                 aoi=None, aoi_crs='EPSG:4326', angles=None, scheduler=None, store=None, jp2_strategy='open',
+                 rows_per_shard=None, output_dtype='int32', mapped_nodata=None, cfactor_dir=None, overviews=None,
+                 overview_resampling='average', statistics=False, grid=None, tile=None, indices=None, qa=None,
+                 gdal_options=None):
+    """Calculate Normalized BRDF Adjusted Reflectance (NBAR).
+
+    Args:
+        parsed_sceneid (dict): parsed scene id.
+        img_dir (str): input directory.
+        bands (list): list of bands to process.
+        sz_path (str): solar zenith angle.
+        sa_path (str): solar azimuth angle.
+        vz_path (str): view (sensor) zenith angle.
+        va_path (str): view (sensor) azimuth angle.
+        out_dir: output directory.
+        apply_bandpass (bool): verify if band pass will be applied.
+        aoi (tuple|dict): area of interest, bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+            When given, only the intersecting windows are processed and the output is cropped to it.
+        aoi_crs (str): coordinate reference system of aoi.
+        angles (AngleProvider): angle provider used instead of the angle files (sz_path, sa_path, vz_path, va_path).
+        scheduler (Scheduler): memory-budgeted scheduler running the bands concurrently. Default is serial.
+        store (ZarrStore): chunked store receiving all bands of the scene instead of one GeoTIFF per band.
+        jp2_strategy (str): JPEG2000 decode strategy, 'open' or 'transcode'.
+        rows_per_shard (int): split each band into shards of about this number of rows, run as separate
+            (resumable) tasks and assembled into the output files. Default is one task per band.
+        output_dtype (str): output data type, 'int32' (default), 'int16' or 'uint16'. NBAR is in the
+            0-10000 range, so the 16-bit types halve the output size. The conversion saturates at the range
+            of the type.
+        mapped_nodata (int): output nodata value, replacing the band nodata (e.g. -9999 as uint16).
+        cfactor_dir (str): directory of the persisted c-factors of the bands. The c-factors found in it
+            are reused, so harmonizing the scene again (e.g. other bandpass setting, reflectance or output
+            data type) only reads, multiplies and writes the reflectance. The missing ones are saved.
+        overviews (list): factors of the internal overviews of the GeoTIFF outputs, e.g. [2, 4, 8, 16].
+            They are reduced from the band in memory, without reading the output again.
+        overview_resampling (str): overview resampling, 'average' (default) or 'nearest'.
+        statistics (bool): write the statistics and histogram of each band (accumulated while harmonizing)
+            as GDAL band metadata of the GeoTIFF outputs, see read_statistics.
+        grid (TargetGrid): target grid (e.g. of a data cube) the bands are warped into from memory, instead
+            of writing them in the native grid of the scene.
+        tile (tuple): (horizontal, vertical) tile of grid receiving the bands, only the windows covering it are
+            harmonized. Default is the grid aligned extent of the scene (or of aoi).
+        indices (list): spectral indices (e.g. ['NDVI', 'NBR'], see sensor_harm.indices) derived from the
+            bands in memory and written with their profile. Their bands must be in bands.
+        qa (QualityMask): quality mask of the scene (see sensor_harm.qa). The pixels of its skipped classes
+            (e.g. fill and clouds) are written as nodata without computing their NBAR, and the skipped pixels
+            and windows are written as GDAL band metadata of the GeoTIFF outputs, see skip_report.
+        gdal_options (dict): GDAL configuration options (e.g. GDAL_CACHEMAX, GDAL_NUM_THREADS, VSI_CACHE) of the
+            reads and writes of the bands, overriding the GDAL profile of the environment, see sensor_harm.gdal_env.
+    """
+    time_index = store.scene_index(parsed_sceneid.group(0)) if store is not None else 0
+    tasks = nbar_tasks(parsed_sceneid, img_dir, bands, sz_path, sa_path, vz_path, va_path, out_dir, apply_bandpass,
+                       nodata, aoi=aoi, aoi_crs=aoi_crs, angles=angles, estimate=scheduler is not None,
+                       store=store, time_index=time_index, jp2_strategy=jp2_strategy,
+                       output_dtype=output_dtype, mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir,
+                       overviews=overviews, overview_resampling=overview_resampling, statistics=statistics,
+                       grid=grid, tile=tile, indices=indices, qa=qa, gdal_options=gdal_options)
+
+    if rows_per_shard:
+        from .sharding import run_sharded
+        return run_sharded(tasks, Path(out_dir) / '.parts', rows_per_shard, scheduler)
+
+    if scheduler is not None:
+        return scheduler.run(tasks)
+
+    return [fn(*args, **kwargs) for _, fn, args, kwargs in tasks]
@@ -0,0 +1,172 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the spectral indices derived from the NBAR bands in memory.
+
+The bands of the indices are harmonized by a single task, which keeps their
+output arrays and derives the indices from them, strip by strip, before they
+are released, so no NBAR file is read again. The indices are scaled by
+INDEX_SCALE (e.g. NDVI 0.8 is 8000) and written with the profile of the bands,
+signed, with the minimum of the data type as nodata since 0 is a valid index.
+New indices are supported with ``register_index``.
+"""
+
+# Python Native
+import logging
+from pathlib import Path
+from typing import Callable, Dict, Tuple
+
+# 3rdparty
+import numpy
+
+# sensor-harm
+from .gdal_env import io_env
+from .harmonization_model import consult_band, quantize, write_band
+from .statistics import BandStatistics
+
+INDEX_SCALE = 10000
+
+# Rows of the float temporaries of an index
+INDEX_STRIP_ROWS = 512
+
+# Band common names and formula (of the NBAR DN, 0-10000) of each index
+spectral_indices: Dict[str, Tuple[Tuple[str, ...], Callable]] = {}
+
+
+def register_index(name: str, common_names: Tuple[str, ...], formula: Callable):
+    """Register a spectral index.
+
+    Args:
+        name (str): index name, e.g. 'NDVI', used in the output file names.
+        common_names (tuple): band common names of the formula arguments, e.g. ('nir', 'red').
+        formula (callable): function of the float64 band arrays (NBAR DN, 0-10000) returning the index.
+    """
+    spectral_indices[name] = tuple(common_names), formula
+
+
+register_index('NDVI', ('nir', 'red'), lambda nir, red: (nir - red) / (nir + red))
+register_index('EVI', ('nir', 'red', 'blue'),
+               lambda nir, red, blue: 2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + INDEX_SCALE))
+register_index('SAVI', ('nir', 'red'), lambda nir, red: 1.5 * (nir - red) / (nir + red + 0.5 * INDEX_SCALE))
+register_index('NDWI', ('green', 'nir'), lambda green, nir: (green - nir) / (green + nir))
+register_index('NDMI', ('nir', 'swir1'), lambda nir, swir1: (nir - swir1) / (nir + swir1))
+register_index('NBR', ('nir', 'swir2'), lambda nir, swir2: (nir - swir2) / (nir + swir2))
+
+
+def index_bands(indices, bands, satsen: str) -> dict:
+    """Find the indices which can be derived from a set of bands of the same grid.
+
+    Args:
+        indices (list): index names.
+        bands (list): band names.
+        satsen (str): satellite sensor.
+
+    Returns:
+        dict: band names (tuple, in the formula order) by index, for the indices whose bands are all available.
+            The first band of a common name is used, e.g. B08 rather than B8A.
+    """
+    by_common_name = {}
+    for b in bands:
+        by_common_name.setdefault(consult_band(b, satsen), b)
+
+    found = {}
+    for index in indices:
+        if index not in spectral_indices:
+            raise RuntimeError(f'Spectral index {index} is not supported, expected one of {list(spectral_indices)}')
+        common_names = spectral_indices[index][0]
+        if all(common_name in by_common_name for common_name in common_names):
+            found[index] = tuple(by_common_name[common_name] for common_name in common_names)
+    return found
+
+
+def index_dtype(output_dtype: str) -> str:
+    """Retrieve the data type of the indices of bands of a data type, signed as the indices."""
+    return 'int16' if output_dtype == 'uint16' else output_dtype
+
+
+def index_nodata(dtype) -> int:
+    """Retrieve the nodata value of the indices of a data type."""
+    return int(numpy.iinfo(dtype).min)
+
+
+def compute_index(index: str, arrays, nodata, out):
+    """Derive an index from band arrays, strip by strip.
+
+    Args:
+        index (str): index name.
+        arrays (list): band arrays, in the formula order.
+        nodata (list): nodata value of each band.
+        out (numpy.array): output array, filled with index_nodata where a band is nodata or the index is undefined.
+
+    Returns:
+        numpy.array: out.
+    """
+    formula = spectral_indices[index][1]
+    out_nodata = index_nodata(out.dtype)
+    for row in range(0, out.shape[0], INDEX_STRIP_ROWS):
+        strip = slice(row, row + INDEX_STRIP_ROWS)
+        mask = numpy.zeros(out[strip].shape, dtype=bool)
+        for data, band_nodata in zip(arrays, nodata):
+            mask |= data[strip] == band_nodata
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            values = formula(*(data[strip].astype('float64') for data in arrays))
+        values = numpy.rint(values * INDEX_SCALE)
+        # Undefined values (null denominators) are nodata
+        mask |= ~numpy.isfinite(values)
+        quantize(values, out_nodata, out[strip], mask)
+    return out
+
+
+def harmonize_indices(band_tasks, indices: dict, output_files: dict, statistics: bool = False) -> dict:
+    """Harmonize the bands of spectral indices and derive the indices from the bands in memory.
+
+    Args:
+        band_tasks (list): harmonize_band tasks (footprint, function, args, kwargs) of the bands of a grid.
+        indices (dict): band names (tuple) by index, see index_bands.
+        output_files (dict): output file by index.
+        statistics (bool): write the statistics of the indices as GDAL band metadata.
+
+    Returns:
+        dict: output file by band and index.
+    """
+    arrays, outputs = {}, {}
+    for _, fn, args, kwargs in band_tasks:
+        outputs.update(fn(*args, arrays=arrays, **kwargs))
+
+    kwargs = band_tasks[0][3]
+    for index, bands in indices.items():
+        logging.info(f'Deriving index {index} from {bands} ...')
+        data = [arrays[b][0] for b in bands]
+        profile = dict(arrays[bands[0]][1])
+        dtype = index_dtype(profile['dtype'])
+        out = compute_index(index, data, [arrays[b][1]['nodata'] for b in bands],
+                            numpy.empty(data[0].shape, dtype=dtype))
+        profile.update(dtype=dtype, nodata=index_nodata(dtype))
+        stats = None
+        if statistics:
+            stats = BandStatistics(range=(-INDEX_SCALE, INDEX_SCALE)).update(out, profile['nodata'])
+        with io_env(kwargs.get('gdal_options')):
+            outputs[index] = write_band(out, output_files[index], index, profile, kwargs.get('store'),
+                                        kwargs.get('time_index', 0), kwargs.get('overviews'),
+                                        kwargs.get('overview_resampling', 'average'), stats)
+    return outputs
+
+
+def index_file(out_dir, scene_id: str, index: str) -> Path:
+    """Retrieve the output file of an index of a scene."""
+    return Path(out_dir) / f'{scene_id}_NBAR_{index}.tif'
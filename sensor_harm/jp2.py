@@ -0,0 +1,130 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the JPEG2000 (Sen2cor) decode strategies.
+
+Reading a JPEG2000 band window by window may decode the same codestream
+regions many times. Two strategies avoid it:
+
+- ``open``: keep the dataset open for the whole band, use the codestream tiles
+  as blocks (so the block windows are aligned to them), decode with several
+  threads and keep the decoded tiles in the GDAL block cache;
+- ``transcode``: decode the band once into a temporary tiled GeoTIFF, which is
+  then read window by window.
+"""
+
+# Python Native
+import logging
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+# 3rdparty
+import rasterio
+import rasterio.shutil
+
+# sensor-harm
+from .gdal_env import env_option
+
+JP2_STRATEGIES = ('open', 'transcode')
+
+
+def is_jp2(img_path) -> bool:
+    """Verify if a file is a JPEG2000 image."""
+    return str(img_path).lower().endswith('.jp2')
+
+
+def jp2_threads(threads=None):
+    """Retrieve the decoding threads, by default GDAL_NUM_THREADS of the active environment or 'ALL_CPUS'."""
+    return threads or env_option('GDAL_NUM_THREADS', 'ALL_CPUS')
+
+
+def jp2_env(threads=None, cache_mb: int = None):
+    """Create the GDAL environment for multi-threaded JPEG2000 decoding.
+
+    The options of the active environment (e.g. a GDAL profile, see sensor_harm.gdal_env)
+    are kept, the defaults apply to those it does not set.
+
+    Args:
+        threads (int|str): number of decoding threads or 'ALL_CPUS', see jp2_threads.
+        cache_mb (int): GDAL block cache size (MB), large enough to keep the decoded tiles of a band row.
+            Default is GDAL_CACHEMAX of the active environment or 1024.
+
+    Returns:
+        rasterio.Env: GDAL environment.
+    """
+    threads = jp2_threads(threads)
+    return rasterio.Env(GDAL_NUM_THREADS=str(threads), OPJ_NUM_THREADS=str(env_option('OPJ_NUM_THREADS', threads)),
+                        GDAL_CACHEMAX=cache_mb or env_option('GDAL_CACHEMAX', 1024))
+
+
+def open_jp2(img_path):
+    """Open a JPEG2000 image using the codestream tiles as blocks."""
+    return rasterio.open(str(img_path), USE_TILE_AS_BLOCK='YES')
+
+
+def transcode_to_gtiff(img_path, out_dir, threads=None, block: int = 512) -> Path:
+    """Decode a JPEG2000 image once into a tiled, uncompressed GeoTIFF.
+
+    Args:
+        img_path (str): path to JPEG2000 file.
+        out_dir (str): directory of the temporary GeoTIFF.
+        threads (int|str): number of decoding threads or 'ALL_CPUS', see jp2_threads.
+        block (int): GeoTIFF block size.
+
+    Returns:
+        Path: path to the GeoTIFF file.
+    """
+    output_file = Path(out_dir) / (Path(img_path).stem + '.tif')
+    logging.info(f'Transcoding {img_path} to {output_file} ...')
+    threads = jp2_threads(threads)
+    with jp2_env(threads):
+        rasterio.shutil.copy(str(img_path), str(output_file), driver='GTiff', tiled=True,
+                             blockxsize=block, blockysize=block, num_threads=str(threads))
+    return output_file
+
+
+@contextmanager
+def open_reflectance(img_path, jp2_strategy: str = 'open', tmp_dir=None, threads=None):
+    """Open a reflectance band, applying the JPEG2000 decode strategy.
+
+    Args:
+        img_path (str): path to input band file.
+        jp2_strategy (str): 'open' or 'transcode', see JP2_STRATEGIES.
+        tmp_dir (str): directory of the transcoded GeoTIFF. Defaults to the system temporary directory.
+        threads (int|str): number of decoding threads or 'ALL_CPUS', see jp2_threads.
+
+    Yields:
+        DatasetReader: opened dataset. A transcoded file is removed when leaving the context.
+    """
+    if not is_jp2(img_path):
+        with rasterio.open(str(img_path)) as dataset:
+            yield dataset
+        return
+
+    if jp2_strategy not in JP2_STRATEGIES:
+        raise RuntimeError(f'Invalid JPEG2000 strategy {jp2_strategy}, use one of {JP2_STRATEGIES}')
+
+    if jp2_strategy == 'transcode':
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+            with rasterio.open(str(transcode_to_gtiff(img_path, tmp, threads))) as dataset:
+                yield dataset
+        return
+
+    with jp2_env(threads), open_jp2(img_path) as dataset:
+        yield dataset
@@ -20,12 +20,19 @@
 
 import logging
 import re
-import shutil
 from pathlib import Path
 from typing import List, Optional, Tuple
 
 # sensor-harm
-from .harmonization_model import process_NBAR
+from . import storage
+from .angles import LandsatANGAngles
+from .gdal_env import io_env
+from .grid import TargetGrid
+from .harmonization_model import crop_raster, process_NBAR
+from .qa import QualityMask
+from .registry import sensors
+from .statistics import band_statistics
+from .zarr_store import ZarrStore
 
 LANDSAT_SCENE_PARSER = (
     r"^L"
@@ -55,7 +62,7 @@ def landsat_angles(angle_dir: str, scene_id: str) -> Tuple[str, str, str, str]:
     Returns:
         sz_path, sa_path, vz_path, va_path: file paths to solar zenith, solar azimuth, view (sensor) zenith and vier (sensor) azimuth.
     """
-    img_list = list(angle_dir.glob(f'**/{scene_id}*.tif'))
+    img_list = storage.glob(angle_dir, f'{scene_id}*.tif')
     logging.info('Load Landsat Angles')
     try:
         pattern = re.compile('.*_solar_zenith_.*|.*_SZA.*')
@@ -72,40 +79,99 @@ def landsat_angles(angle_dir: str, scene_id: str) -> Tuple[str, str, str, str]:
     return sz_path, sa_path, vz_path, va_path
 
 
+def landsat_ang_file(product_dir: Path, scene_id: str) -> Optional[Path]:
+    """Retrieve the Landsat angle coefficient file (ANG.txt) path.
+
+    Args:
+        product_dir (Path): path to directory containing original bands.
+        scene_id (str): The Landsat Scene Identifier.
+    Returns:
+        Path: file path to *_ANG.txt or None when it does not exist.
+    """
+    ang_files = storage.glob(product_dir, f'{scene_id}*_ANG.txt')
+    return ang_files[0] if ang_files else None
+
+
+def landsat_quality_band(product_dir: Path) -> Optional[Path]:
+    """Retrieve the Landsat quality band (pixel_qa, QA_PIXEL or Fmask4) path.
+
+    Args:
+        product_dir (Path): path to directory containing original bands.
+    Returns:
+        Path: file path to the quality band or None when it does not exist.
+    """
+    # Both extensions, e.g. upper case bands besides lower case angle bands
+    img_list = storage.glob(product_dir, '*.tif') + storage.glob(product_dir, '*.TIF')
+
+    regex_list = ['.*pixel_qa.*', '.*qa_pixel.*', '.*Fmask4.*']
+    for regex in regex_list:
+        pattern = re.compile(regex, re.IGNORECASE)
+        matching_pattern = list(item for item in img_list if pattern.match(str(item)))
+
+        if len(matching_pattern) != 0:
+            return matching_pattern[0]
+    return None
+
+
 def landsat_bands(parsed_sceneid: str) -> Optional[List[str]]:
     """Retrieve the bands which can be harmonized in Landsat data products."""
     satsen = f'L{parsed_sceneid["sensor"]}{parsed_sceneid["satellite"]}'
     collection = parsed_sceneid["collectionNumber"]
-    if satsen == 'LT05' or satsen == 'LE07':
-        if collection=='01':
-            return ['sr_band1', 'sr_band2', 'sr_band3', 'sr_band4', 'sr_band5', 'sr_band7']
-        elif collection=='02':
-            return ['SR_B1', 'SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B7']
-    elif satsen == 'LC08':
-        if collection=='01':
-            return ['sr_band2', 'sr_band3', 'sr_band4', 'sr_band5', 'sr_band6', 'sr_band7']
-        elif collection=='02':
-            return ['SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'SR_B7']
-    return
+    if satsen not in sensors:
+        return
+    return sensors[satsen].harmonized_bands.get(collection)
 
 
 def landsat_harmonize(scene_id: str, product_dir: str, target_dir: Optional[str] = None,
                       bands: Optional[List[str]] = None, angle_dir: Optional[str] = None,
-                      cp_quality_band: Optional[bool] = True):
+                      cp_quality_band: Optional[bool] = True, aoi=None, aoi_crs: str = 'EPSG:4326', scheduler=None,
+                      store=None, angles=None, rows_per_shard=None, output_dtype='int32', mapped_nodata=None,
+                      cfactor_dir: Optional[str] = None, overviews: Optional[List[int]] = None,
+                      overview_resampling: str = 'average', statistics: bool = False, grid=None,
+                      tile: Optional[Tuple[int, int]] = None, indices: Optional[List[str]] = None,
+                      skip_qa: Optional[List[str]] = None, gdal_options: Optional[dict] = None):
     """Prepare Landsat NBAR.
 
     Args:
         scene_id (str) - The Landsat Scene Identifier
-        product_dir (str) - path to directory containing original bands.
+        product_dir (str) - path to directory containing original bands, local or an S3 prefix
+            (s3://bucket/prefix or /vsis3/bucket/prefix).
         target_dir (Optional[str]) - path to output result images.
         bands (Optional[List[str]]) - List of bands to generate. When "None", use all.
         angle_dir (Optional[str]) - path to directory containing angle bands.
+            When "None" and the scene *_ANG.txt is available in product_dir, the angles are computed on the fly
+            from its coefficients, otherwise the angle bands are searched in product_dir.
         cp_quality_band (Optional[bool]) - copy quality band to target_dir
+        aoi (Optional[tuple|dict]) - area of interest, bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+            When given, outputs are cropped to it.
+        aoi_crs (str) - coordinate reference system of aoi. Default is EPSG:4326.
+        scheduler (Optional[Scheduler]) - memory-budgeted scheduler running the bands concurrently.
+        store (Optional[str|ZarrStore]) - Zarr store receiving all bands and the quality band of the scene,
+            appended on its time axis, instead of GeoTIFF files in target_dir.
+        angles (Optional[AngleProvider]) - angle provider of the scene (e.g. cached by a worker).
+            When given, angle_dir and the *_ANG.txt are not read.
+        rows_per_shard (Optional[int]) - split the bands into resumable row shards of about this number of rows.
+        output_dtype (str) - output data type, 'int32' (default), 'int16' or 'uint16'.
+        mapped_nodata (Optional[int]) - output nodata value replacing the band nodata.
+        cfactor_dir (Optional[str]) - directory where the band c-factors are saved, and reused by later runs.
+        overviews (Optional[List[int]]) - factors of the internal overviews of the bands, e.g. [2, 4, 8, 16].
+        overview_resampling (str) - overview resampling, 'average' (default) or 'nearest'.
+        statistics (bool) - write the statistics and histogram of the bands as GDAL band metadata and return them.
+        grid (Optional[TargetGrid|dict|str]) - target grid (or its dict, JSON or JSON file, see TargetGrid)
+            the bands and the quality band are warped into, instead of the native grid of the scene.
+        tile (Optional[Tuple[int, int]]) - (horizontal, vertical) tile of grid, only its windows are harmonized.
+        indices (Optional[List[str]]) - spectral indices, e.g. ['NDVI', 'NBR'], derived from the bands in memory
+            and written as {scene_id}_NBAR_{index}.tif, see sensor_harm.indices.
+        skip_qa (Optional[List[str]]) - quality classes, e.g. ['fill', 'cloud', 'shadow', 'cirrus'], of the pixels
+            written as nodata without computing their NBAR, see sensor_harm.qa.
+        gdal_options (Optional[dict]) - GDAL configuration options of the reads and writes (e.g. GDAL_CACHEMAX,
+            GDAL_NUM_THREADS), overriding the GDAL profile of the environment, see sensor_harm.gdal_env.
 
     Returns:
-        str: path to folder containing result images.
+        str, list: path to folder containing result images and the output file by band (dict) of each band.
+            With statistics, a third item has the statistics (dict) by band.
     """
-    product_dir = Path(product_dir)
+    product_dir = storage.input_dir(product_dir)
     target_dir = Path(target_dir) / (scene_id + '_NBAR')
 
     parsed_sceneid = re.match(LANDSAT_SCENE_PARSER, scene_id, re.IGNORECASE)
@@ -113,9 +179,18 @@ def landsat_harmonize(scene_id: str, product_dir: str, target_dir: Optional[str]
     if not parsed_sceneid:
         raise RuntimeError(f'Invalid Landsat scene id {scene_id}')
 
-    angle_dir = Path(angle_dir) if angle_dir else product_dir
-    logging.info(f'Loading Angles from {angle_dir} ...')
-    sz_path, sa_path, vz_path, va_path = landsat_angles(angle_dir, scene_id)
+    ang_file = landsat_ang_file(product_dir, scene_id) if angle_dir is None and angles is None else None
+    if angles is not None:
+        sz_path = sa_path = vz_path = va_path = None
+    elif ang_file is not None:
+        logging.info(f'Computing Angles from {ang_file} ...')
+        angles = LandsatANGAngles(ang_file)
+        sz_path = sa_path = vz_path = va_path = None
+    else:
+        angle_dir = storage.input_dir(angle_dir) if angle_dir else product_dir
+        logging.info(f'Loading Angles from {angle_dir} ...')
+        sz_path, sa_path, vz_path, va_path = landsat_angles(angle_dir, scene_id)
+        angles = None
 
     if target_dir is None:
         target_dir = product_dir.joinpath(Path('HARMONIZED_DATA'))
@@ -125,20 +200,38 @@ def landsat_harmonize(scene_id: str, product_dir: str, target_dir: Optional[str]
     if bands is None:
         bands = landsat_bands(parsed_sceneid)
 
-    output_files = process_NBAR(parsed_sceneid, product_dir, bands, sz_path, sa_path, vz_path, va_path, target_dir)
+    if store is not None and not isinstance(store, ZarrStore):
+        store = ZarrStore(store)
 
-    # Copy quality band
-    if cp_quality_band:
-        img_list = list(product_dir.glob('**/*.tif')) or list(product_dir.glob('**/*.TIF'))
+    if grid is not None:
+        grid = TargetGrid.load(grid)
 
-        regex_list = ['.*pixel_qa.*', '.*qa_pixel.*', '.*Fmask4.*']
-        for regex in regex_list:
-            pattern = re.compile(regex, re.IGNORECASE)
-            matching_pattern = list(item for item in img_list if pattern.match(str(item)))
+    qa_path = landsat_quality_band(product_dir) if cp_quality_band or skip_qa else None
+    qa = None
+    if skip_qa:
+        if qa_path is None:
+            raise RuntimeError(f'File not Found: Missing quality band on {product_dir}')
+        qa = QualityMask(qa_path, skip_qa)
 
-            if len(matching_pattern) != 0:
-                qa_path = matching_pattern[0]
-                shutil.copy(qa_path, target_dir)
-                break
+    output_files = process_NBAR(parsed_sceneid, product_dir, bands, sz_path, sa_path, vz_path, va_path, target_dir,
+                                aoi=aoi, aoi_crs=aoi_crs, angles=angles,
+                                scheduler=scheduler, store=store, rows_per_shard=rows_per_shard,
+                                output_dtype=output_dtype, mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir,
+                                overviews=overviews, overview_resampling=overview_resampling,
+                                statistics=statistics, grid=grid, tile=tile, indices=indices, qa=qa,
+                                gdal_options=gdal_options)
 
+    # Copy quality band
+    if cp_quality_band and qa_path is not None:
+        if store is not None:
+            store.write_raster('qa', store.scene_index(scene_id), qa_path, aoi, aoi_crs, grid, tile)
+        elif aoi is not None or grid is not None:
+            with storage.object_env(qa_path), io_env(gdal_options):
+                crop_raster(qa_path, target_dir.joinpath(Path(qa_path.name).with_suffix('.tif')), aoi, aoi_crs,
+                            grid, tile)
+        else:
+            storage.copy_file(qa_path, target_dir)
+
+    if statistics:
+        return target_dir, output_files, band_statistics(output_files)
     return target_dir, output_files
@@ -0,0 +1,238 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the quality band masks skipping the NBAR of fill, cloudy or shadowed pixels.
+
+The quality band of a scene (Landsat QA_PIXEL or pixel_qa, Fmask4 or the
+Sentinel-2 SCL) is read for each window before its c-factor. The pixels of the
+skipped classes are written as nodata, the angles and kernels are only computed
+for the other pixels, and a window entirely skipped is not computed at all.
+The skipped pixels and windows are counted per band and written as GDAL band
+metadata (``QA_SKIP_*``) of the outputs, see read_skip.
+"""
+
+# Python Native
+import logging
+from pathlib import Path
+
+# 3rdparty
+import numpy
+import rasterio
+from rasterio.enums import Resampling
+
+# sensor-harm
+from .harmonization_model import ScratchArena
+
+QA_SKIP_CLASSES = ('fill', 'cloud', 'shadow', 'cirrus')
+
+# (mask, value) rules of the classes of each quality band, a pixel is in a class when
+# one of its rules matches, i.e. qa & mask == value
+QA_CLASSES = {
+    # Landsat Collection-2 QA_PIXEL bit flags
+    'QA_PIXEL': {
+        'fill': [(1, 1)],
+        'dilated_cloud': [(1 << 1, 1 << 1)],
+        'cirrus': [(1 << 2, 1 << 2)],
+        'cloud': [(1 << 3, 1 << 3)],
+        'shadow': [(1 << 4, 1 << 4)],
+        'snow': [(1 << 5, 1 << 5)],
+        'water': [(1 << 7, 1 << 7)],
+    },
+    # Landsat Collection-1 pixel_qa bit flags, cirrus of high confidence
+    'pixel_qa': {
+        'fill': [(1, 1)],
+        'water': [(1 << 2, 1 << 2)],
+        'shadow': [(1 << 3, 1 << 3)],
+        'snow': [(1 << 4, 1 << 4)],
+        'cloud': [(1 << 5, 1 << 5)],
+        'cirrus': [(3 << 8, 3 << 8)],
+    },
+    # Fmask 4 classes
+    'Fmask4': {
+        'water': [(0xFF, 1)],
+        'shadow': [(0xFF, 2)],
+        'snow': [(0xFF, 3)],
+        'cloud': [(0xFF, 4)],
+        'fill': [(0xFF, 255)],
+    },
+    # Sentinel-2 Sen2cor scene classification
+    'SCL': {
+        'fill': [(0xFF, 0)],
+        'saturated': [(0xFF, 1)],
+        'dark': [(0xFF, 2)],
+        'shadow': [(0xFF, 3)],
+        'water': [(0xFF, 6)],
+        'unclassified': [(0xFF, 7)],
+        'cloud': [(0xFF, 8), (0xFF, 9)],
+        'cirrus': [(0xFF, 10)],
+        'snow': [(0xFF, 11)],
+    },
+}
+
+
+def qa_kind(path) -> str:
+    """Retrieve the kind of a quality band (a key of QA_CLASSES) from its file name."""
+    name = Path(str(path)).name.upper()
+    for pattern, kind in (('QA_PIXEL', 'QA_PIXEL'), ('PIXEL_QA', 'pixel_qa'), ('FMASK', 'Fmask4'), ('SCL', 'SCL')):
+        if pattern in name:
+            return kind
+    raise RuntimeError(f'Unknown quality band {path}, expected one of {list(QA_CLASSES)}')
+
+
+class QualityMask:
+    """Skip mask of the windows of the bands of a scene, from the classes of its quality band."""
+
+    def __init__(self, path, classes=QA_SKIP_CLASSES, kind: str = None):
+        """Create a quality mask.
+
+        Args:
+            path (str): path to the quality band.
+            classes (list): skipped classes, e.g. ['fill', 'cloud', 'shadow', 'cirrus']. The classes
+                missing in the quality band (e.g. 'cirrus' of Fmask4) are ignored.
+            kind (str): kind of the quality band, a key of QA_CLASSES. Default is found from its name.
+        """
+        known = {name for rules in QA_CLASSES.values() for name in rules}
+        unknown = [name for name in classes if name not in known]
+        if unknown:
+            raise RuntimeError(f'Unknown quality classes {unknown}, expected some of {sorted(known)}')
+        self.path = path
+        self.kind = kind or qa_kind(path)
+        self.classes = tuple(classes)
+        missing = [name for name in self.classes if name not in QA_CLASSES[self.kind]]
+        if missing:
+            logging.info(f'Quality classes {missing} are not in {self.kind}, ignored')
+        self.rules = [rule for name in self.classes for rule in QA_CLASSES[self.kind].get(name, ())]
+
+    def read(self, dataset, src, window, arena=None) -> numpy.ndarray:
+        """Read the skip mask of a window of a band.
+
+        The quality band is read on the pixels of the band window, resampled
+        (nearest) when its grid differs, e.g. the 20 m SCL of a 10 m band.
+
+        Args:
+            dataset (DatasetReader): opened quality band.
+            src (DatasetReader): opened band.
+            window (Window): window of src.
+            arena (ScratchArena): arena receiving the quality window and the mask. Default allocates them.
+
+        Returns:
+            numpy.array: boolean array, True for the skipped pixels.
+        """
+        arena = arena or ScratchArena()
+        shape = (int(window.height), int(window.width))
+        if dataset.transform != src.transform:
+            window = dataset.window(*src.window_bounds(window))
+        data = dataset.read(1, window=window, out=arena.buffer('qa', shape, dataset.dtypes[0]),
+                            resampling=Resampling.nearest)
+
+        skip = arena.buffer('skip', shape, bool)
+        skip[...] = False
+        flags = arena.buffer('qa_flags', shape, data.dtype)
+        matched = arena.buffer('qa_matched', shape, bool)
+        for mask, value in self.rules:
+            numpy.bitwise_and(data, mask, out=flags)
+            numpy.logical_or(skip, numpy.equal(flags, value, out=matched), out=skip)
+        return skip
+
+
+class QualitySkip:
+    """Mergeable counts of the pixels and windows of a band skipped by a quality mask."""
+
+    def __init__(self):
+        """Create empty counts."""
+        self.pixels = 0
+        self.skipped = 0
+        self.windows = 0
+        self.skipped_windows = 0
+
+    def update(self, skip):
+        """Count the pixels of a window, see QualityMask.read."""
+        skipped = int(numpy.count_nonzero(skip))
+        self.pixels += skip.size
+        self.skipped += skipped
+        self.windows += 1
+        self.skipped_windows += int(skipped == skip.size)
+        return self
+
+    def merge(self, other: 'QualitySkip'):
+        """Merge the counts of other bands or shards into these counts."""
+        self.pixels += other.pixels
+        self.skipped += other.skipped
+        self.windows += other.windows
+        self.skipped_windows += other.skipped_windows
+        return self
+
+    @property
+    def skipped_percent(self) -> float:
+        """Retrieve the share (percent) of the skipped pixels."""
+        return 100. * self.skipped / self.pixels if self.pixels else 0.
+
+    def __str__(self):
+        """Describe the compute saved."""
+        return (f'skipped {self.skipped} of {self.pixels} pixels ({self.skipped_percent:.1f}%), '
+                f'{self.skipped_windows} of {self.windows} windows')
+
+    def to_dict(self) -> dict:
+        """Retrieve the counts as a dict."""
+        return dict(pixels=self.pixels, skipped=self.skipped, windows=self.windows,
+                    skipped_windows=self.skipped_windows, skipped_percent=self.skipped_percent)
+
+    def tags(self) -> dict:
+        """Retrieve the GDAL band metadata of the counts."""
+        return dict(QA_SKIP_PIXELS=self.skipped, QA_SKIP_TOTAL_PIXELS=self.pixels,
+                    QA_SKIP_WINDOWS=self.skipped_windows, QA_SKIP_TOTAL_WINDOWS=self.windows)
+
+    @classmethod
+    def from_tags(cls, tags: dict) -> 'QualitySkip':
+        """Create the counts from the GDAL band metadata written by ``tags``."""
+        if 'QA_SKIP_PIXELS' not in tags:
+            raise RuntimeError('Missing quality skip counts')
+        counts = cls()
+        counts.skipped = int(tags['QA_SKIP_PIXELS'])
+        counts.pixels = int(tags['QA_SKIP_TOTAL_PIXELS'])
+        counts.skipped_windows = int(tags['QA_SKIP_WINDOWS'])
+        counts.windows = int(tags['QA_SKIP_TOTAL_WINDOWS'])
+        return counts
+
+
+def read_skip(path) -> QualitySkip:
+    """Read the quality skip counts of a band file (its metadata only)."""
+    with rasterio.open(str(path)) as dataset:
+        return QualitySkip.from_tags(dataset.tags(1))
+
+
+def skip_report(paths) -> dict:
+    """Read the quality skip counts of the harmonized band files having them.
+
+    Args:
+        paths (list): band files, e.g. the GeoTIFF files of an output directory.
+
+    Returns:
+        dict: counts (dict, see QualitySkip.to_dict) by file stem, with their sum as 'total'.
+    """
+    report, total = {}, QualitySkip()
+    for path in paths:
+        with rasterio.open(str(path)) as dataset:
+            tags = dataset.tags(1)
+        if 'QA_SKIP_PIXELS' in tags:
+            counts = QualitySkip.from_tags(tags)
+            report[Path(str(path)).stem] = counts.to_dict()
+            total.merge(counts)
+    if report:
+        report['total'] = total.to_dict()
+    return report
@@ -0,0 +1,227 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the registry of sensors, bands and harmonization coefficients.
+
+Each sensor is compiled once, at registration, into NumPy arrays indexed by
+band (common names, BRDF and bandpass coefficients), so that the coefficients
+of many bands can be taken at once for a vectorized evaluation. New platforms
+are supported with ``register_sensor``.
+"""
+
+# Python Native
+from typing import Dict, List, Optional, Tuple
+
+# 3rdparty
+import numpy
+
+# Coeffients in  Roy, D. P., Zhang, H. K., Ju, J., Gomez-Dans, J. L., Lewis, P. E., Schaaf, C. B., Sun Q., Li J., Huang H., & Kovalskyy, V. (2016).
+# A general method to normalize Landsat reflectance data to nadir BRDF adjusted reflectance.
+# Remote Sensing of Environment, 176, 255-271.
+brdf_coefficients = {
+    'blue': {
+        'fiso': 774,
+        'fgeo': 79,
+        'fvol': 372
+    },
+    'green': {
+        'fiso': 1306,
+        'fgeo': 178,
+        'fvol': 580
+    },
+    'red': {
+        'fiso': 1690,
+        'fgeo': 227,
+        'fvol': 574
+    },
+    'nir': {
+        'fiso': 3093,
+        'fgeo': 330,
+        'fvol': 1535
+    },
+    'swir1': {
+        'fiso': 3430,
+        'fgeo': 453,
+        'fvol': 1154
+    },
+    'swir2': {
+        'fiso': 2658,
+        'fgeo': 387,
+        'fvol': 639
+    }
+}
+
+# Bandpass (slope, offset) by common name in Skakun et. al, 2018 - Harmonized Landsat Sentinel-2 (HLS) Product User’s Guide
+bandpass_coefficients = {
+    'S2A': {
+        'coastal': (0.9959, -0.0002),  # UltraBlue/coastal #MODIS don't have this band # B01
+        'blue': (0.9778, -0.004),  # Blue # B02
+        'green': (1.0053, -0.0009),  # Green # B03
+        'red': (0.9765, 0.0009),  # Red # B04
+        'nir': (0.9983, -0.0001),  # Nir # B08 B8A
+        'swir1': (0.9987, -0.0011),  # Swir 1 # B11
+        'swir2': (1.003, -0.0012),  # Swir 2 # B12
+    },
+    'S2B': {
+        'coastal': (0.9959, -0.0002),
+        'blue': (0.9778, -0.004),
+        'green': (1.0075, -0.0008),
+        'red': (0.9761, 0.001),
+        'nir': (0.9966, 0.000),
+        'swir1': (1.000, -0.0003),
+        'swir2': (0.9867, -0.0004),
+    }
+}
+
+
+class Sensor:
+    """Compiled bands and coefficients of a satellite sensor.
+
+    The band names (including the aliases of every product collection) index
+    the arrays ``common_names``, ``fiso``, ``fgeo``, ``fvol``, ``slope`` and
+    ``offset``. Bands without BRDF coefficients hold NaN (``brdf`` rejects them)
+    and bands without bandpass coefficients hold the identity (slope 1, offset 0).
+    """
+
+    def __init__(self, name: str, band_common_names: Dict[str, str], harmonized_bands: Dict[str, List[str]],
+                 bandpass: Optional[Dict[str, Tuple[float, float]]] = None):
+        """Compile a sensor.
+
+        Args:
+            name (str): satellite sensor, e.g. 'LC08' or 'S2A'.
+            band_common_names (dict): band common name by band name.
+            harmonized_bands (dict): bands which can be harmonized by product collection.
+            bandpass (dict): bandpass (slope, offset) by common name.
+        """
+        self.name = name
+        self.bands = tuple(band_common_names)
+        self.index = {band: i for i, band in enumerate(self.bands)}
+        self.common_names = numpy.array([band_common_names[band] for band in self.bands])
+        self.harmonized_bands = {collection: list(bands) for collection, bands in harmonized_bands.items()}
+        self.has_bandpass = bandpass is not None
+
+        nan = {'fiso': numpy.nan, 'fgeo': numpy.nan, 'fvol': numpy.nan}
+        coefficients = [brdf_coefficients.get(common_name, nan) for common_name in self.common_names]
+        self.fiso = numpy.array([coef['fiso'] for coef in coefficients], dtype='float64')
+        self.fgeo = numpy.array([coef['fgeo'] for coef in coefficients], dtype='float64')
+        self.fvol = numpy.array([coef['fvol'] for coef in coefficients], dtype='float64')
+
+        bandpass = bandpass or {}
+        self.slope = numpy.array([bandpass.get(c, (1., 0.))[0] for c in self.common_names], dtype='float64')
+        self.offset = numpy.array([bandpass.get(c, (1., 0.))[1] for c in self.common_names], dtype='float64')
+
+    def band_indexes(self, bands) -> numpy.ndarray:
+        """Retrieve the array indexes of band names."""
+        try:
+            return numpy.array([self.index[band] for band in bands], dtype='intp')
+        except KeyError as e:
+            raise RuntimeError(f'Band {e.args[0]} is not supported by {self.name}')
+
+    def common_name(self, band: str) -> str:
+        """Retrieve the common name of a band."""
+        return str(self.common_names[self.band_indexes([band])[0]])
+
+    def brdf(self, bands) -> Dict[str, numpy.ndarray]:
+        """Retrieve the BRDF coefficients (fiso, fgeo, fvol) of a band or a list of bands.
+
+        Returns:
+            dict: coefficient arrays, or floats when a single band name is given.
+
+        Raises:
+            RuntimeError: when a band has no BRDF coefficients (e.g. coastal), it cannot be harmonized.
+        """
+        indexes = self.band_indexes([bands] if isinstance(bands, str) else bands)
+        missing = [self.bands[i] for i in indexes if numpy.isnan(self.fiso[i])]
+        if missing:
+            raise RuntimeError(f'Bands {missing} of {self.name} have no BRDF coefficients')
+        if isinstance(bands, str):
+            i = indexes[0]
+            return dict(fiso=self.fiso[i], fgeo=self.fgeo[i], fvol=self.fvol[i])
+        return dict(fiso=self.fiso[indexes], fgeo=self.fgeo[indexes], fvol=self.fvol[indexes])
+
+    def bandpass(self, bands):
+        """Retrieve the bandpass slope and offset of a band or arrays of a list of bands."""
+        if isinstance(bands, str):
+            i = self.band_indexes([bands])[0]
+            return self.slope[i], self.offset[i]
+        indexes = self.band_indexes(bands)
+        return self.slope[indexes], self.offset[indexes]
+
+
+sensors: Dict[str, Sensor] = {}
+
+
+def register_sensor(name: str, band_common_names: Dict[str, str], harmonized_bands: Dict[str, List[str]],
+                    bandpass: Optional[Dict[str, Tuple[float, float]]] = None) -> Sensor:
+    """Compile and register a satellite sensor.
+
+    Args:
+        name (str): satellite sensor, e.g. 'LC08' or 'S2A'.
+        band_common_names (dict): band common name by band name.
+        harmonized_bands (dict): bands which can be harmonized by product collection.
+        bandpass (dict): bandpass (slope, offset) by common name.
+
+    Returns:
+        Sensor: the compiled sensor.
+    """
+    sensor = Sensor(name, band_common_names, harmonized_bands, bandpass)
+    sensors[name] = sensor
+    return sensor
+
+
+def get_sensor(satsen: str) -> Sensor:
+    """Retrieve a registered satellite sensor."""
+    try:
+        return sensors[satsen]
+    except KeyError:
+        raise RuntimeError(f'Sensor {satsen} is not supported')
+
+
+_tm_bands = {'sr_band1': 'blue', 'sr_band2': 'green', 'sr_band3': 'red', 'sr_band4': 'nir', 'sr_band5': 'swir1',
+             'sr_band7': 'swir2',
+             'SR_B1': 'blue', 'SR_B2': 'green', 'SR_B3': 'red', 'SR_B4': 'nir', 'SR_B5': 'swir1',
+             'SR_B7': 'swir2'}
+_tm_harmonized = {'01': ['sr_band1', 'sr_band2', 'sr_band3', 'sr_band4', 'sr_band5', 'sr_band7'],
+                  '02': ['SR_B1', 'SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B7']}
+
+register_sensor('LT04', _tm_bands, _tm_harmonized)
+register_sensor('LT05', _tm_bands, _tm_harmonized)
+register_sensor('LE07', _tm_bands, _tm_harmonized)
+register_sensor(
+    'LC08',
+    {'sr_band1': 'coastal', 'sr_band2': 'blue', 'sr_band3': 'green', 'sr_band4': 'red', 'sr_band5': 'nir',
+     'sr_band6': 'swir1', 'sr_band7': 'swir2',
+     'SR_B1': 'coastal', 'SR_B2': 'blue', 'SR_B3': 'green', 'SR_B4': 'red', 'SR_B5': 'nir',
+     'SR_B6': 'swir1', 'SR_B7': 'swir2'},
+    {'01': ['sr_band2', 'sr_band3', 'sr_band4', 'sr_band5', 'sr_band6', 'sr_band7'],
+     '02': ['SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'SR_B7']}
+)
+
+_msi_bands = {'sr_band1': 'coastal', 'sr_band2': 'blue', 'sr_band3': 'green', 'sr_band4': 'red',
+              'sr_band5': 'rededge1', 'sr_band6': 'rededge2', 'sr_band7': 'rededge3',
+              'sr_band8': 'nir', 'sr_band8a': 'nir', 'sr_band11': 'swir1', 'sr_band12': 'swir2',
+              'B01': 'coastal', 'B02': 'blue', 'B03': 'green', 'B04': 'red',
+              'B05': 'rededge1', 'B06': 'rededge2', 'B07': 'rededge3',
+              'B08': 'nir', 'B8A': 'nir', 'B11': 'swir1', 'B12': 'swir2'}
+# Sen2cor bands by resolution (R10m, R20m) and LaSRC bands (sr)
+_msi_harmonized = {'R10m': ['B02', 'B03', 'B04', 'B08'],
+                   'R20m': ['B8A', 'B11', 'B12'],
+                   'sr': ['sr_band2', 'sr_band3', 'sr_band4', 'sr_band8', 'sr_band8a', 'sr_band11', 'sr_band12']}
+
+register_sensor('S2A', _msi_bands, _msi_harmonized, bandpass_coefficients['S2A'])
+register_sensor('S2B', _msi_bands, _msi_harmonized, bandpass_coefficients['S2B'])
@@ -0,0 +1,152 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define a memory-budgeted scheduler for band and scene harmonization tasks."""
+
+# Python Native
+import logging
+import re
+import resource
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_memory(value) -> int:
+    """Parse a memory size such as 2048, '512M' or '8G' into bytes."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', str(value), re.IGNORECASE)
+    if not match:
+        raise RuntimeError(f'Invalid memory size {value}')
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def peak_rss() -> dict:
+    """Retrieve the observed peak resident set size (bytes) of this process and of its children."""
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return dict(
+        self=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        children=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    )
+
+
+class Scheduler:
+    """Run tasks concurrently while the sum of their estimated footprints stays under a memory budget.
+
+    A task is a tuple (footprint, function, args, kwargs). A task is admitted
+    only when its footprint fits in the remaining budget, or when nothing else
+    is running, so a task larger than the budget still runs, alone. Admission is
+    thread-safe: several scenes may share a scheduler from different threads.
+    """
+
+    def __init__(self, memory_budget, workers: int = 1, processes: bool = False):
+        """Create a scheduler.
+
+        Args:
+            memory_budget (int|str): memory budget in bytes or with a unit, e.g. '8G'.
+            workers (int): maximum number of tasks running at once.
+            processes (bool): run the tasks in a process pool instead of a thread pool.
+        """
+        self.memory_budget = parse_memory(memory_budget)
+        self.workers = workers
+        self.processes = processes
+        self._executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=workers)
+        self._condition = threading.Condition()
+        self._in_use = 0
+        self._running = 0
+        self.estimated_peak = 0
+
+    def _acquire(self, footprint):
+        with self._condition:
+            while self._running and (self._running >= self.workers or self._in_use + footprint > self.memory_budget):
+                self._condition.wait()
+            self._in_use += footprint
+            self._running += 1
+            self.estimated_peak = max(self.estimated_peak, self._in_use)
+
+    def _release(self, footprint):
+        with self._condition:
+            self._in_use -= footprint
+            self._running -= 1
+            self._condition.notify_all()
+
+    def submit(self, footprint, fn, *args, **kwargs):
+        """Wait until the task fits in the budget and submit it.
+
+        Returns:
+            Future: the task future.
+        """
+        if footprint > self.memory_budget:
+            logging.warning(f'Task {fn.__name__} footprint {footprint} exceeds the memory budget {self.memory_budget}')
+        self._acquire(footprint)
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release(footprint)
+            raise
+        future.add_done_callback(lambda _: self._release(footprint))
+        return future
+
+    def run(self, tasks) -> list:
+        """Run tasks (footprint, function, args, kwargs) and return their results in order."""
+        futures = [self.submit(footprint, fn, *args, **kwargs) for footprint, fn, args, kwargs in tasks]
+        return [future.result() for future in futures]
+
+    def run_scenes(self, scenes) -> list:
+        """Run scene harmonizations concurrently, sharing this scheduler for their bands.
+
+        Args:
+            scenes (list): (function, args, kwargs) of harmonizers accepting a ``scheduler`` keyword,
+                e.g. landsat_harmonize or sentinel_harmonize.
+
+        Returns:
+            list: the results of each scene, in order.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(len(scenes), self.workers))) as pool:
+            futures = [pool.submit(fn, *args, scheduler=self, **kwargs) for fn, args, kwargs in scenes]
+            return [future.result() for future in futures]
+
+    def stats(self) -> dict:
+        """Retrieve the estimated versus observed peak memory (bytes).
+
+        With processes, the observed peak RSS is the largest of the finished worker
+        processes, so it is only complete after shutdown.
+        """
+        rss = peak_rss()
+        return dict(
+            memory_budget=self.memory_budget,
+            workers=self.workers,
+            estimated_peak=self.estimated_peak,
+            observed_peak_rss=rss['children'] if self.processes else rss['self'],
+        )
+
+    def shutdown(self, wait: bool = True):
+        """Shutdown the executor."""
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        """Enter the scheduler context."""
+        return self
+
+    def __exit__(self, *args):
+        """Shutdown the executor when leaving the scheduler context."""
+        self.shutdown()
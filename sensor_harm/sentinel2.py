@@ -25,11 +25,18 @@ import re
 from pathlib import Path
 from typing import Optional
 
-# 3rdparty
-import s2angs
-
 # sensor-harm
-from .harmonization_model import process_NBAR
+from . import storage
+from .angles import Sentinel2MetadataAngles
+from .gdal_env import io_env
+from .grid import TargetGrid
+from .harmonization_model import crop_raster, nbar_tasks, process_NBAR
+from .indices import index_bands
+from .qa import QualityMask
+from .registry import get_sensor
+from .sharding import run_sharded
+from .statistics import band_statistics
+from .zarr_store import ZarrStore
 
 SENTINEL2_SCENE_PARSER = (
     r"^S"
@@ -55,27 +62,76 @@ SENTINEL2_SCENE_PARSER = (
 )
 
 
-def sentinel_harmonize_SAFE(safel2a: dict, target_dir: Optional[str] = None, apply_bandpass: bool = True):
+def sentinel_angles(s2_entry: Path):
+    """Retrieve the Sentinel-2 angles from the tile metadata or generate the angle bands.
+
+    Args:
+        s2_entry (Path): path to Sentinel-2 product directory.
+
+    Returns:
+        angles, sz_path, sa_path, vz_path, va_path: angle provider interpolating the MTD_TL.xml grids
+            when it exists (angle band paths are None) or None and the generated angle band paths.
+    """
+    mtd_files = storage.glob(s2_entry, 'MTD_TL.xml')
+    if mtd_files:
+        logging.info(f'Interpolating Angles from {mtd_files[0]} ...')
+        return Sentinel2MetadataAngles(mtd_files[0]), None, None, None, None
+
+    # Generating Angle bands
+    import s2angs
+
+    sz_path, sa_path, vz_path, va_path = s2angs.gen_s2_ang(str(s2_entry))
+    return None, sz_path, sa_path, vz_path, va_path
+
+
+def sentinel_harmonize_SAFE(safel2a: dict, target_dir: Optional[str] = None, apply_bandpass: bool = True,
+                            aoi=None, aoi_crs: str = 'EPSG:4326', scheduler=None, store=None,
+                            jp2_strategy: str = 'open', angles=None, rows_per_shard=None,
+                            output_dtype: str = 'int32', mapped_nodata=None, cfactor_dir=None, overviews=None,
+                            overview_resampling: str = 'average', statistics: bool = False, grid=None, tile=None,
+                            indices=None, skip_qa=None, gdal_options=None):
     """Prepare Sentinel-2 NBAR from Sen2cor.
 
     Args:
         safel2a (str): path to SAFEL2A directory.
         target_dir (str): path to output result images.
         apply_bandpass - Apply the band pass processing. Default is True.
+        aoi (tuple|dict): area of interest, bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+        aoi_crs (str): coordinate reference system of aoi. Default is EPSG:4326.
+        scheduler (Scheduler): memory-budgeted scheduler. The 10 m and 20 m bands run concurrently when they fit.
+        store (ZarrStore): Zarr store receiving all bands and the quality band instead of GeoTIFF files.
+        jp2_strategy (str): JPEG2000 decode strategy, 'open' (multi-threaded, tile aligned) or 'transcode'
+            (one-shot transcode into a temporary tiled GeoTIFF).
+        angles (AngleProvider): angle provider of the scene. When given, the angles are not loaded.
+        rows_per_shard (int): split the bands into resumable row shards of about this number of rows.
+        output_dtype (str): output data type, 'int32' (default), 'int16' or 'uint16'.
+        mapped_nodata (int): output nodata value replacing the band nodata.
+        cfactor_dir (str): directory where the band c-factors are saved, and reused by later runs.
+        overviews (list): factors of the internal overviews of the bands, e.g. [2, 4, 8, 16].
+        overview_resampling (str): overview resampling, 'average' (default) or 'nearest'.
+        statistics (bool): write the statistics and histogram of the bands as GDAL band metadata and return them.
+        grid (TargetGrid): target grid the bands and the quality band are warped into.
+        tile (tuple): (horizontal, vertical) tile of grid, only its windows are harmonized.
+        indices (list): spectral indices derived from the bands in memory, see sensor_harm.indices.
+        skip_qa (list): SCL classes, e.g. ['fill', 'cloud', 'shadow', 'cirrus'], of the pixels written as nodata
+            without computing their NBAR, see sensor_harm.qa.
+        gdal_options (dict): GDAL configuration options of the reads and writes, see sensor_harm.gdal_env.
 
     Returns:
-        str: path to folder containing result images.
+        str: path to folder containing result images. With statistics, the output file by band (dict) of
+            each band and the statistics (dict) by band follow it.
     """
     parsed_sceneid = re.match(SENTINEL2_SCENE_PARSER, safel2a.name[:-5], re.IGNORECASE)
     if not parsed_sceneid:
         raise RuntimeError(f'Invalid Sentinel2 scene id {safel2a.name}')
 
-    #TODO Check if angles already exists
-    # Generating Angle bands
-    sz_path, sa_path, vz_path, va_path = s2angs.gen_s2_ang(str(safel2a))
+    if angles is None:
+        angles, sz_path, sa_path, vz_path, va_path = sentinel_angles(safel2a)
+    else:
+        sz_path = sa_path = vz_path = va_path = None
 
     if target_dir is None:
-        target_dir = safel2a.joinpath('GRANULE', os.listdir(safel2a.joinpath('GRANULE'))[0], 'HARMONIZED_DATA/')
+        target_dir = safel2a.joinpath('GRANULE', storage.listdir(safel2a.joinpath('GRANULE'))[0], 'HARMONIZED_DATA/')
     target_dir.mkdir(parents=True, exist_ok=True)
 
     logging.info('Harmonization ...')
@@ -83,25 +139,59 @@ def sentinel_harmonize_SAFE(safel2a: dict, target_dir: Optional[str] = None, app
     satsen = safel2a.name[:3]
     logging.info('SatSen: {}'.format(satsen))
 
-    img_dir = safel2a.joinpath('GRANULE', os.listdir(safel2a.joinpath('GRANULE'))[0], 'IMG_DATA/R10m/')
-    bands10m = ['B02', 'B03', 'B04', 'B08']
-    process_NBAR(parsed_sceneid, img_dir, bands10m, sz_path, sa_path, vz_path, va_path, target_dir, apply_bandpass, nodata=0)
+    # Quality band
+    granule_dir = safel2a.joinpath('GRANULE', storage.listdir(safel2a.joinpath('GRANULE'))[0])
+    pattern = re.compile('.*SCL.*')
+    img_list = storage.glob(granule_dir.joinpath('IMG_DATA/R20m/'), '*.jp2')
+    qa_filepath = Path(list(item for item in img_list if pattern.match(str(item)))[0])
+    qa = QualityMask(qa_filepath, skip_qa) if skip_qa else None
 
-    img_dir = safel2a.joinpath('GRANULE', os.listdir(safel2a.joinpath('GRANULE'))[0], 'IMG_DATA/R20m/')
-    bands20m = ['B8A', 'B11', 'B12']
-    process_NBAR(parsed_sceneid, img_dir, bands20m, sz_path, sa_path, vz_path, va_path, target_dir, apply_bandpass, nodata=0)
+    time_index = store.scene_index(parsed_sceneid.group(0)) if store is not None else 0
+    tasks = []
+    # Each index is derived at the first resolution having all its bands
+    pending = list(indices or [])
+    for resolution in ['R10m', 'R20m']:
+        img_dir = granule_dir.joinpath(f'IMG_DATA/{resolution}/')
+        bands = get_sensor(satsen).harmonized_bands[resolution]
+        resolution_indices = list(index_bands(pending, bands, satsen))
+        pending = [index for index in pending if index not in resolution_indices]
+        tasks.extend(nbar_tasks(parsed_sceneid, img_dir, bands, sz_path, sa_path, vz_path, va_path, target_dir,
+                                apply_bandpass, nodata=0, aoi=aoi, aoi_crs=aoi_crs, angles=angles,
+                                estimate=scheduler is not None, store=store, time_index=time_index,
+                                jp2_strategy=jp2_strategy, output_dtype=output_dtype,
+                                mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir, overviews=overviews,
+                                overview_resampling=overview_resampling, statistics=statistics, grid=grid,
+                                tile=tile, indices=resolution_indices, qa=qa, gdal_options=gdal_options))
+    if pending:
+        raise RuntimeError(f'Spectral indices {pending} need bands of different resolutions')
+
+    if rows_per_shard:
+        output_files = run_sharded(tasks, target_dir / '.parts', rows_per_shard, scheduler)
+    elif scheduler is not None:
+        output_files = scheduler.run(tasks)
+    else:
+        output_files = [fn(*args, **kwargs) for _, fn, args, kwargs in tasks]
 
     # COPY quality band
-    pattern = re.compile('.*SCL.*')
-    img_list = img_dir.glob('**/*.jp2')
-    qa_filepath = Path(list(item for item in img_list if pattern.match(str(item)))[0])
     # Convert jp2 to tiff
-    os.system('gdal_translate -of Gtiff ' + str(qa_filepath) + ' ' + str(target_dir) + '/' + str(Path(qa_filepath.name).with_suffix('.tif')))
+    if store is not None:
+        store.write_raster('SCL', time_index, qa_filepath, aoi, aoi_crs, grid, tile)
+    elif aoi is not None or grid is not None:
+        with storage.object_env(qa_filepath), io_env(gdal_options):
+            crop_raster(qa_filepath, target_dir.joinpath(Path(qa_filepath.name).with_suffix('.tif')), aoi, aoi_crs,
+                        grid, tile)
+    else:
+        os.system('gdal_translate -of Gtiff ' + str(qa_filepath) + ' ' + str(target_dir) + '/' + str(Path(qa_filepath.name).with_suffix('.tif')))
 
+    if statistics:
+        return target_dir, output_files, band_statistics(output_files)
     return target_dir
 
 
-def sentinel_harmonize_sr(s2_entry, target_dir, apply_bandpass=True):
+def sentinel_harmonize_sr(s2_entry, target_dir, apply_bandpass=True, aoi=None, aoi_crs='EPSG:4326', scheduler=None,
+                          store=None, angles=None, rows_per_shard=None, output_dtype='int32', mapped_nodata=None,
+                          cfactor_dir=None, overviews=None, overview_resampling='average', statistics=False, grid=None,
+                          tile=None, indices=None, skip_qa=None, gdal_options=None):
     """Prepare Sentinel-2 NBAR from LaSRC.
 
     Args:
@@ -110,17 +200,37 @@ def sentinel_harmonize_sr(s2_entry, target_dir, apply_bandpass=True):
         sr_dir (str|Path): path to directory containing surface reflectance.
         target_dir (str): path to output result images.
         apply_bandpass - Apply the band pass processing. Default is True.
+        aoi (tuple|dict): area of interest, bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+        aoi_crs (str): coordinate reference system of aoi. Default is EPSG:4326.
+        scheduler (Scheduler): memory-budgeted scheduler running the bands concurrently.
+        store (ZarrStore): Zarr store receiving all bands instead of GeoTIFF files.
+        angles (AngleProvider): angle provider of the scene. When given, the angles are not loaded.
+        rows_per_shard (int): split the bands into resumable row shards of about this number of rows.
+        output_dtype (str): output data type, 'int32' (default), 'int16' or 'uint16'.
+        mapped_nodata (int): output nodata value replacing -9999, required for 'uint16'.
+        cfactor_dir (str): directory where the band c-factors are saved, and reused by later runs.
+        overviews (list): factors of the internal overviews of the bands, e.g. [2, 4, 8, 16].
+        overview_resampling (str): overview resampling, 'average' (default) or 'nearest'.
+        statistics (bool): write the statistics and histogram of the bands as GDAL band metadata and return them.
+        grid (TargetGrid): target grid the bands and the quality band are warped into.
+        tile (tuple): (horizontal, vertical) tile of grid, only its windows are harmonized.
+        indices (list): spectral indices derived from the bands in memory, see sensor_harm.indices.
+        skip_qa (list): Fmask4 classes, e.g. ['fill', 'cloud', 'shadow'], of the pixels written as nodata
+            without computing their NBAR, see sensor_harm.qa.
+        gdal_options (dict): GDAL configuration options of the reads and writes, see sensor_harm.gdal_env.
 
     Returns:
-        str: path to folder containing result images.
+        str: path to folder containing result images. With statistics, the output file by band (dict) of
+            each band and the statistics (dict) by band follow it.
     """
     parsed_sceneid = re.match(SENTINEL2_SCENE_PARSER, s2_entry.name, re.IGNORECASE)
     if not parsed_sceneid:
         raise RuntimeError(f'Invalid Sentinel2 scene id {s2_entry.name}')
 
-    #TODO Check if angles already exists
-    # Generating Angle bands
-    sz_path, sa_path, vz_path, va_path = s2angs.gen_s2_ang(str(s2_entry))
+    if angles is None:
+        angles, sz_path, sa_path, vz_path, va_path = sentinel_angles(s2_entry)
+    else:
+        sz_path = sa_path = vz_path = va_path = None
 
     target_dir.mkdir(parents=True, exist_ok=True)
 
@@ -129,13 +239,30 @@ def sentinel_harmonize_sr(s2_entry, target_dir, apply_bandpass=True):
     satsen = s2_entry.name[0:3]
     logging.info(f'SatSen: {satsen}')
 
-    bands = ['sr_band2', 'sr_band3', 'sr_band4', 'sr_band8', 'sr_band8a', 'sr_band11', 'sr_band12']
+    bands = get_sensor(satsen).harmonized_bands['sr']
 
-    process_NBAR(parsed_sceneid, s2_entry, bands, sz_path, sa_path, vz_path, va_path, target_dir, apply_bandpass, nodata=-9999)
+    qa = None
+    if skip_qa:
+        qa_files = storage.glob(s2_entry, '*Fmask4*.tif')
+        if not qa_files:
+            raise RuntimeError(f'File not Found: Missing Fmask4 quality band on {s2_entry}')
+        qa = QualityMask(qa_files[0], skip_qa)
+
+    output_files = process_NBAR(parsed_sceneid, s2_entry, bands, sz_path, sa_path, vz_path, va_path, target_dir,
+                                apply_bandpass, nodata=-9999, aoi=aoi, aoi_crs=aoi_crs, angles=angles,
+                                scheduler=scheduler, store=store, rows_per_shard=rows_per_shard,
+                                output_dtype=output_dtype, mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir,
+                                overviews=overviews, overview_resampling=overview_resampling, statistics=statistics,
+                                grid=grid, tile=tile, indices=indices, qa=qa, gdal_options=gdal_options)
+    if statistics:
+        return target_dir, output_files, band_statistics(output_files)
     return target_dir
 
 
-def sentinel_harmonize(sentinel2_entry, target_dir, apply_bandpass=True):
+def sentinel_harmonize(sentinel2_entry, target_dir, apply_bandpass=True, aoi=None, aoi_crs='EPSG:4326', scheduler=None,
+                       store=None, jp2_strategy='open', angles=None, rows_per_shard=None, output_dtype='int32',
+                       mapped_nodata=None, cfactor_dir=None, overviews=None, overview_resampling='average',
+                       statistics=False, grid=None, tile=None, indices=None, skip_qa=None, gdal_options=None):
     """Check if input surface reflectance is from Sen2cor or LaSRC and direct NBAR processing.
 
     Args:
@@ -143,14 +270,61 @@ def sentinel_harmonize(sentinel2_entry, target_dir, apply_bandpass=True):
         scene_id (str): Scene identifier
         reflectance_data (str): path to directory containing surface reflectance.
         target_dir (str): path to output result images.
+        aoi (tuple|dict): area of interest, bounding box (xmin, ymin, xmax, ymax) or GeoJSON-like geometry.
+            When given, only the intersecting part of the scene is harmonized.
+        aoi_crs (str): coordinate reference system of aoi. Default is EPSG:4326.
+        scheduler (Scheduler): memory-budgeted scheduler running the bands concurrently.
+        store (str|ZarrStore): Zarr store receiving all bands of the scene, appended on its time axis,
+            instead of GeoTIFF files in target_dir.
+        jp2_strategy (str): JPEG2000 (Sen2cor) decode strategy, 'open' or 'transcode'.
+        angles (AngleProvider): angle provider of the scene (e.g. cached by a worker).
+        rows_per_shard (int): split the bands into resumable row shards of about this number of rows,
+            so that a large scene uses all the scheduler workers.
+        output_dtype (str): output data type, 'int32' (default), 'int16' or 'uint16'.
+        mapped_nodata (int): output nodata value replacing the band nodata (0 for Sen2cor, -9999 for LaSRC).
+        cfactor_dir (str): directory where the band c-factors are saved, and reused by later runs.
+        overviews (list): factors of the internal overviews of the bands, e.g. [2, 4, 8, 16].
+        overview_resampling (str): overview resampling, 'average' (default) or 'nearest'.
+        statistics (bool): write the statistics and histogram of the bands (accumulated while harmonizing)
+            as GDAL band metadata and return them.
+        grid (TargetGrid|dict|str): target grid (or its dict, JSON or JSON file, see TargetGrid) the bands and
+            the quality band are warped into from memory, instead of the native grid of the scene.
+        tile (tuple): (horizontal, vertical) tile of grid, only the windows of the scene covering it are harmonized.
+        indices (list): spectral indices, e.g. ['NDVI', 'NBR'], derived from the bands in memory and written
+            as {scene_id}_NBAR_{index}.tif, see sensor_harm.indices. A Sen2cor index is derived at the first
+            resolution (10 m, 20 m) having all its bands.
+        skip_qa (list): quality classes (of the SCL or Fmask4), e.g. ['fill', 'cloud', 'shadow', 'cirrus'], of the
+            pixels written as nodata without computing their NBAR. The skipped pixels and windows of each band are
+            written as GDAL band metadata, see sensor_harm.qa.
+        gdal_options (dict): GDAL configuration options (e.g. GDAL_CACHEMAX, GDAL_NUM_THREADS, OPJ_NUM_THREADS) of
+            the reads and writes, overriding the GDAL profile of the environment, see sensor_harm.gdal_env.
+
+    Returns:
+        Path: path to folder containing result images. With statistics, (target_dir, output_files,
+            statistics) with the output file by band (dict) of each band and the statistics (dict) by band.
     """
-    sentinel2_entry = Path(sentinel2_entry)
+    sentinel2_entry = storage.input_dir(sentinel2_entry)
+    if store is not None and not isinstance(store, ZarrStore):
+        store = ZarrStore(store)
+    if grid is not None:
+        grid = TargetGrid.load(grid)
 
     if sentinel2_entry.name.endswith('.SAFE'):  # Check if was processed with Sen2cor
         target_dir = Path(target_dir) / sentinel2_entry.name.replace('.SAFE', '_NBAR')
-        sentinel_harmonize_SAFE(sentinel2_entry, target_dir, apply_bandpass)
+        result = sentinel_harmonize_SAFE(sentinel2_entry, target_dir, apply_bandpass, aoi=aoi, aoi_crs=aoi_crs,
+                                         scheduler=scheduler, store=store, jp2_strategy=jp2_strategy, angles=angles,
+                                         rows_per_shard=rows_per_shard, output_dtype=output_dtype,
+                                         mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir, overviews=overviews,
+                                         overview_resampling=overview_resampling, statistics=statistics,
+                                         grid=grid, tile=tile, indices=indices, skip_qa=skip_qa,
+                                         gdal_options=gdal_options)
     else:
         target_dir = Path(target_dir) / (sentinel2_entry.name + '_NBAR')
-        sentinel_harmonize_sr(sentinel2_entry, target_dir, apply_bandpass)
+        result = sentinel_harmonize_sr(sentinel2_entry, target_dir, apply_bandpass, aoi=aoi, aoi_crs=aoi_crs,
+                                       scheduler=scheduler, store=store, angles=angles, rows_per_shard=rows_per_shard,
+                                       output_dtype=output_dtype, mapped_nodata=mapped_nodata, cfactor_dir=cfactor_dir,
+                                       overviews=overviews, overview_resampling=overview_resampling,
+                                       statistics=statistics, grid=grid, tile=tile, indices=indices,
+                                       skip_qa=skip_qa, gdal_options=gdal_options)
 
-    return
+    return result
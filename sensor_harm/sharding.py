@@ -0,0 +1,351 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the intra-scene sharding of band harmonization into row bands.
+
+The band tasks of ``nbar_tasks`` are split into shards of block aligned rows.
+Each shard writes a GeoTIFF part, renamed into place only once complete, so
+an interrupted run is resumed by running the shards whose part is missing.
+The parts are named by a key of the band task (its inputs and options, see
+task_key), so a run with other options does not reuse them.
+The plan is saved in the parts directory (``shards.pickle``), so shards can
+be run by several processes (with a Scheduler) or several machines sharing
+the directory (``run_shards(parts_dir, index, count)``). The parts are then
+assembled into a VRT referencing them (metadata only), or into the final
+GeoTIFF, which copies the pixels of the parts once (and reads the band again
+for its overviews) without harmonizing them again.
+"""
+
+# Python Native
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+# 3rdparty
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+# sensor-harm
+from .gdal_env import io_env
+from .harmonization_model import aoi_window, harmonize_band
+from .qa import QualitySkip, read_skip
+from .statistics import BandStatistics, read_statistics, write_statistics
+
+PLAN_FILE = 'shards.pickle'
+
+
+def split_rows(height: int, rows_per_shard: int, block_height: int = 1) -> list:
+    """Split rows into (start, stop) shards aligned to the block height.
+
+    Args:
+        height (int): number of rows.
+        rows_per_shard (int): approximate number of rows per shard, rounded to a multiple of block_height.
+        block_height (int): block height of the input band.
+
+    Returns:
+        list: (start, stop) rows of each shard.
+    """
+    step = max(block_height, rows_per_shard // block_height * block_height)
+    return [(start, min(start + step, height)) for start in range(0, height, step)]
+
+
+def _fingerprint(value):
+    """Convert a task argument into plain values, objects by their type and public attributes."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Path):
+        return str(value)
+    if isinstance(value, dict):
+        return sorted((str(key), _fingerprint(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_fingerprint(item) for item in value]
+        return sorted(items, key=repr) if isinstance(value, (set, frozenset)) else items
+    if hasattr(value, '__dict__'):
+        attributes = {name: item for name, item in vars(value).items() if not name.startswith('_')}
+        return [type(value).__qualname__, _fingerprint(attributes)]
+    return [type(value).__qualname__, str(value)]
+
+
+def task_key(args, kwargs) -> str:
+    """Retrieve the key of a band task, a hash of its arguments and options changing the pixels of its output.
+
+    The GDAL options (I/O configuration only) are not part of the key.
+    """
+    options = {name: value for name, value in kwargs.items() if name != 'gdal_options'}
+    return hashlib.sha1(repr(_fingerprint([list(args), options])).encode()).hexdigest()[:12]
+
+
+def plan_shards(tasks, parts_dir, rows_per_shard: int) -> list:
+    """Split band harmonization tasks into row shards and save the plan in the parts directory.
+
+    Args:
+        tasks (list): band tasks (footprint, harmonize_band, args, kwargs), see nbar_tasks.
+        parts_dir (str): directory of the shard parts.
+        rows_per_shard (int): approximate number of rows per shard.
+
+    The parts of a previous plan which are not part of this one (e.g. written
+    with other options) are removed.
+
+    Returns:
+        list: shards (dict) with band, output_file, part_file, rows and the task.
+    """
+    parts_dir = Path(parts_dir)
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    shards = []
+    for footprint, fn, args, kwargs in tasks:
+        if fn is not harmonize_band:
+            raise RuntimeError('Sharded harmonization splits band tasks and does not support spectral indices')
+        if kwargs.get('store') is not None:
+            raise RuntimeError('Sharded harmonization writes GeoTIFF parts and does not support a store')
+        if kwargs.get('grid') is not None:
+            raise RuntimeError('Sharded harmonization writes the native grid and does not support a target grid')
+        img_path, output_file, band = args[0], args[1], args[2]
+        with rasterio.open(str(img_path)) as src:
+            window = aoi_window(src, kwargs['aoi'], kwargs['aoi_crs']) if kwargs.get('aoi') is not None \
+                else Window(0, 0, src.width, src.height)
+            block_height = src.block_shapes[0][0]
+        height = int(window.height)
+        key = task_key(args, kwargs)
+        # Shards stay aligned to the input blocks when the window starts on a block row
+        for start, stop in split_rows(height, rows_per_shard, block_height):
+            part_file = parts_dir / band / f'part_{start:06d}_{stop:06d}_{key}.tif'
+            shards.append(dict(
+                band=band, output_file=str(output_file), part_file=str(part_file), rows=(start, stop),
+                task=(int(footprint * (stop - start) / height), fn, args, dict(kwargs, rows=(start, stop)))
+            ))
+
+    planned = {shard['part_file'] for shard in shards}
+    for band in {shard['band'] for shard in shards}:
+        for part_file in (parts_dir / band).glob('part_*.tif'):
+            if str(part_file) not in planned:
+                logging.info(f'Removing the stale shard {part_file}')
+                part_file.unlink()
+
+    with open(parts_dir / PLAN_FILE, 'wb') as fd:
+        pickle.dump(shards, fd)
+    return shards
+
+
+def load_shards(parts_dir) -> list:
+    """Load the shards plan of a parts directory."""
+    plan_file = Path(parts_dir) / PLAN_FILE
+    if not plan_file.exists():
+        raise RuntimeError(f'Missing shards plan {plan_file}')
+    with open(plan_file, 'rb') as fd:
+        return pickle.load(fd)
+
+
+def harmonize_shard(part_file, fn, args, kwargs) -> str:
+    """Harmonize a shard into its part file, unless the part is already complete.
+
+    The part is written to a temporary file and renamed once complete, so an
+    existing part is always a complete one.
+
+    Returns:
+        str: path to the part file.
+    """
+    part_file = Path(part_file)
+    if part_file.exists():
+        logging.info(f'Shard {part_file} is complete, skipping')
+        return str(part_file)
+    part_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = part_file.with_name(f'.{part_file.stem}.{os.getpid()}.tif')
+    fn(args[0], tmp_file, *args[2:], **kwargs)
+    os.replace(tmp_file, part_file)
+    return str(part_file)
+
+
+def shard_tasks(shards, index: int = 0, count: int = 1) -> list:
+    """Build the Scheduler tasks of the incomplete shards assigned to a runner.
+
+    Args:
+        shards (list): shards plan.
+        index (int): runner index, from 0 to count - 1.
+        count (int): number of runners (processes or machines) sharing the plan.
+
+    Returns:
+        list: tasks (footprint, harmonize_shard, args, kwargs).
+    """
+    tasks = []
+    for shard in shards[index::count]:
+        if Path(shard['part_file']).exists():
+            continue
+        footprint, fn, args, kwargs = shard['task']
+        tasks.append((footprint, harmonize_shard, (shard['part_file'], fn, args, kwargs), {}))
+    return tasks
+
+
+def run_shards(parts_dir, scheduler=None, index: int = 0, count: int = 1) -> list:
+    """Run the incomplete shards of a plan assigned to this runner.
+
+    Args:
+        parts_dir (str): directory of the shard parts and plan.
+        scheduler (Scheduler): memory-budgeted scheduler running the shards concurrently,
+            with processes to use all cores. Default is serial.
+        index (int): runner index, from 0 to count - 1.
+        count (int): number of runners sharing the plan.
+
+    Returns:
+        list: the part files written by this run.
+    """
+    tasks = shard_tasks(load_shards(parts_dir), index, count)
+    logging.info(f'Running {len(tasks)} shards of {parts_dir}')
+    if scheduler is not None:
+        return scheduler.run(tasks)
+    return [fn(*args, **kwargs) for _, fn, args, kwargs in tasks]
+
+
+def build_vrt(part_files, vrt_file) -> Path:
+    """Write a VRT mosaic of row parts sharing the same columns, reading their metadata only.
+
+    Args:
+        part_files (list): part files, ordered by row.
+        vrt_file (str): path to VRT file.
+
+    Returns:
+        Path: path to VRT file.
+    """
+    vrt_file = Path(vrt_file)
+    sources, row = [], 0
+    for part_file in part_files:
+        with rasterio.open(str(part_file)) as part:
+            if row == 0:
+                first = part.profile
+            source = os.path.relpath(str(part_file), str(vrt_file.parent))
+            sources.append(
+                f'    <ComplexSource>\n'
+                f'      <SourceFilename relativeToVRT="1">{escape(source)}</SourceFilename>\n'
+                f'      <SourceBand>1</SourceBand>\n'
+                f'      <SrcRect xOff="0" yOff="0" xSize="{part.width}" ySize="{part.height}" />\n'
+                f'      <DstRect xOff="0" yOff="{row}" xSize="{part.width}" ySize="{part.height}" />\n'
+                f'      <NODATA>{part.nodata}</NODATA>\n'
+                f'    </ComplexSource>\n'
+            )
+            row += part.height
+
+    transform = first['transform']
+    geotransform = ', '.join(str(v) for v in (transform.c, transform.a, transform.b, transform.f, transform.d,
+                                              transform.e))
+    data_type = {'int32': 'Int32', 'int16': 'Int16', 'uint16': 'UInt16', 'float32': 'Float32',
+                 'float64': 'Float64', 'uint8': 'Byte'}[first['dtype']]
+    vrt_file.write_text(
+        f'<VRTDataset rasterXSize="{first["width"]}" rasterYSize="{row}">\n'
+        f'  <SRS>{escape(first["crs"].to_wkt())}</SRS>\n'
+        f'  <GeoTransform>{geotransform}</GeoTransform>\n'
+        f'  <VRTRasterBand dataType="{data_type}" band="1">\n'
+        f'    <NoDataValue>{first["nodata"]}</NoDataValue>\n'
+        + ''.join(sources) +
+        f'  </VRTRasterBand>\n'
+        f'</VRTDataset>\n'
+    )
+    return vrt_file
+
+
+def assemble(parts_dir, driver: str = 'GTiff', remove_parts: bool = False) -> list:
+    """Assemble the complete shard parts of each band into its output file.
+
+    Args:
+        parts_dir (str): directory of the shard parts and plan.
+        driver (str): 'GTiff' writes the planned output files, copying the pixels of the parts once
+            and reading the band again for its overviews, 'VRT' writes a VRT next to each planned output
+            referencing the parts, reading their metadata only.
+        remove_parts (bool): remove the parts directory once assembled (GTiff only).
+
+    Returns:
+        list: output file by band (dict) of each band.
+    """
+    shards = load_shards(parts_dir)
+    missing = [shard['part_file'] for shard in shards if not Path(shard['part_file']).exists()]
+    if missing:
+        raise RuntimeError(f'Cannot assemble {parts_dir}, {len(missing)} shards are incomplete')
+
+    bands = {}
+    for shard in shards:
+        bands.setdefault((shard['band'], shard['output_file']), []).append(shard)
+
+    outputs = []
+    for (band, output_file), band_shards in bands.items():
+        part_files = [shard['part_file'] for shard in sorted(band_shards, key=lambda shard: shard['rows'][0])]
+        output_file = Path(output_file)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        kwargs = band_shards[0]['task'][3]
+        # The band statistics are merged from the statistics of the parts
+        stats = None
+        if kwargs.get('statistics'):
+            stats = BandStatistics()
+            for part_file in part_files:
+                stats.merge(read_statistics(part_file))
+        # The quality skip counts are the sums of those of the parts
+        skipped = None
+        if kwargs.get('qa') is not None:
+            skipped = QualitySkip()
+            for part_file in part_files:
+                skipped.merge(read_skip(part_file))
+
+        if driver == 'VRT':
+            vrt_file = build_vrt(part_files, output_file.with_suffix('.vrt'))
+            if stats is not None:
+                write_statistics(vrt_file, stats)
+            if skipped is not None:
+                with rasterio.open(str(vrt_file), 'r+') as dst:
+                    dst.update_tags(1, **skipped.tags())
+            outputs.append({band: vrt_file})
+            continue
+
+        vrt_file = build_vrt(part_files, Path(parts_dir) / band / 'mosaic.vrt')
+        logging.info(f'Assembling {len(part_files)} shards into {output_file}')
+        with io_env(kwargs.get('gdal_options')):
+            rasterio.shutil.copy(str(vrt_file), str(output_file), driver='GTiff', compress='deflate')
+        # The parts have no overviews, they are built from the assembled band
+        if kwargs.get('overviews') or stats is not None or skipped is not None:
+            with rasterio.open(str(output_file), 'r+') as dst:
+                if kwargs.get('overviews'):
+                    dst.build_overviews(sorted(kwargs['overviews']),
+                                        Resampling[kwargs.get('overview_resampling', 'average')])
+                if stats is not None:
+                    dst.update_tags(1, **stats.tags())
+                if skipped is not None:
+                    dst.update_tags(1, **skipped.tags())
+        outputs.append({band: output_file})
+
+    if remove_parts and driver != 'VRT':
+        shutil.rmtree(str(parts_dir), ignore_errors=True)
+    return outputs
+
+
+def run_sharded(tasks, parts_dir, rows_per_shard: int, scheduler=None) -> list:
+    """Plan, run and assemble band tasks by row shards, resuming the shards of a previous run.
+
+    Args:
+        tasks (list): band tasks, see nbar_tasks.
+        parts_dir (str): directory of the shard parts.
+        rows_per_shard (int): approximate number of rows per shard.
+        scheduler (Scheduler): scheduler running the shards concurrently.
+
+    Returns:
+        list: output file by band (dict) of each band.
+    """
+    plan_shards(tasks, parts_dir, rows_per_shard)
+    run_shards(parts_dir, scheduler)
+    return assemble(parts_dir, remove_parts=True)
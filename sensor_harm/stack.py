@@ -0,0 +1,300 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the time-series stack harmonization of many dates of the same tile.
+
+The view geometry of a Landsat path/row or of a Sentinel-2 tile and relative
+orbit repeats from date to date, only the sun moves. The band tasks of the
+scenes (collected through the harmonizers, see StackCollector) are grouped by
+footprint, band and grid, and each group is harmonized window by window with
+the dates as the inner loop: the view zenith terms of the kernels (see
+``kernel_terms``) of a window are computed once and reused by the following
+dates while their view zenith stays within ``view_tolerance``, so only the
+sun dependent terms are evaluated per date.
+"""
+
+# Python Native
+import logging
+import re
+from contextlib import ExitStack
+from pathlib import Path
+
+# 3rdparty
+import numpy
+import rasterio
+from rasterio.windows import Window
+from rasterio.windows import intersect as windows_intersect
+
+# sensor-harm
+from . import storage
+from .angles import AngleFiles
+from .gdal_env import io_env
+from .harmonization_model import (DE2RA, NADIR_TERMS, WINDOW_TEMPORARIES,
+                                  aoi_mask, aoi_window, calc_brf_terms,
+                                  is_geometry, is_landsat, is_sentinel2,
+                                  kernel_terms, nbar_window, output_nodata,
+                                  quantize, scratch_arena)
+from .jp2 import open_reflectance
+from .registry import get_sensor
+from .statistics import BandStatistics
+
+# Maximum view zenith difference (degrees) of a window to reuse the view terms of a previous date
+VIEW_TOLERANCE = 0.001
+
+
+def footprint_key(scene_id: str) -> str:
+    """Retrieve the repeating footprint of a scene, the Landsat path/row or the Sentinel-2 relative orbit and tile.
+
+    Args:
+        scene_id (str): scene identifier.
+
+    Returns:
+        str: footprint key, the scene id itself when it is not recognized.
+    """
+    parts = scene_id.split('_')
+    if is_landsat(scene_id) and len(parts) > 2:
+        return f'{parts[0][:2]}_{parts[2]}'
+    if is_sentinel2(scene_id):
+        orbit_tile = [part for part in parts if re.fullmatch(r'R\d{3}|T\w{5}', part)]
+        if orbit_tile:
+            return '_'.join(['S2'] + orbit_tile)
+    return scene_id
+
+
+class StackCollector:
+    """Scheduler stand-in collecting the band tasks of the harmonizers instead of running them.
+
+    The harmonizers prepare the scene (angles, output directory, quality band)
+    and hand their band tasks to ``run``, which keeps them for the stack.
+    """
+
+    def __init__(self):
+        """Create an empty collector."""
+        self.scene_id = None
+        self.tasks = []
+
+    def run(self, tasks) -> list:
+        """Collect the band tasks (footprint, function, args, kwargs) of the current scene."""
+        self.tasks.extend((self.scene_id, task) for task in tasks)
+        return []
+
+
+def collect_tasks(entries, target_dir, apply_bandpass=True, **options) -> list:
+    """Prepare the scenes of a stack and collect their band tasks.
+
+    Args:
+        entries (list): Landsat product directories (named by scene id) and Sentinel-2 entries.
+        target_dir (str): output directory.
+        apply_bandpass (bool): apply the Sentinel-2 band pass.
+        options (dict): keywords of the harmonizers, e.g. aoi, aoi_crs, store, output_dtype.
+
+    Returns:
+        list: (scene_id, task) of all the bands of the scenes.
+    """
+    from .landsat import landsat_harmonize
+    from .sentinel2 import sentinel_harmonize
+
+    if options.get('indices'):
+        raise RuntimeError('The stack mode does not derive spectral indices')
+    if options.get('skip_qa'):
+        raise RuntimeError('The stack mode computes whole windows and does not skip quality classes')
+    collector = StackCollector()
+    for entry in entries:
+        entry = storage.input_dir(entry)
+        collector.scene_id = scene_id = entry.name
+        logging.info(f'Preparing scene {scene_id} ...')
+        if is_sentinel2(scene_id):
+            sentinel_harmonize(entry, target_dir, apply_bandpass, scheduler=collector, **options)
+        elif is_landsat(scene_id):
+            landsat_harmonize(scene_id, entry, target_dir, scheduler=collector, **options)
+        else:
+            raise RuntimeError(f'Scene {scene_id} is not a Sentinel-2 or Landsat scene')
+    return collector.tasks
+
+
+def stack_groups(tasks, dates_per_pass: int = 64) -> list:
+    """Group the band tasks of a stack by footprint, band and output grid.
+
+    Args:
+        tasks (list): (scene_id, task) of the bands, see collect_tasks.
+        dates_per_pass (int): maximum number of dates of a group, bounding the number of opened files.
+
+    Returns:
+        list: groups (footprint, tasks) harmonized together, with the memory footprint of a window iteration.
+    """
+    groups = {}
+    for scene_id, task in tasks:
+        _, _, args, kwargs = task
+        img_path, b = args[0], args[2]
+        with storage.object_env(img_path), rasterio.open(str(img_path)) as src:
+            window = aoi_window(src, kwargs['aoi'], kwargs['aoi_crs']) if kwargs.get('aoi') is not None \
+                else Window(0, 0, src.width, src.height)
+            grid = (src.shape, src.block_shapes[0], tuple(int(v) for v in window.flatten()))
+        groups.setdefault((footprint_key(scene_id), b, grid), []).append(task)
+
+    # The view terms are kept besides the temporaries of the current date
+    return [(grid[1][0] * grid[1][1] * 8 * (WINDOW_TEMPORARIES + 6), group[start: start + dates_per_pass])
+            for (_, _, grid), group in groups.items() for start in range(0, len(group), dates_per_pass)]
+
+
+def harmonize_dates(tasks, view_tolerance: float = VIEW_TOLERANCE) -> list:
+    """Harmonize a band of many dates sharing a footprint and a grid, window by window.
+
+    Args:
+        tasks (list): band tasks (footprint, harmonize_band, args, kwargs) of the dates, see stack_groups.
+        view_tolerance (float): maximum view zenith difference (degrees) of a window to reuse the view terms
+            computed for a previous date. 0 reuses them for identical view zeniths only.
+
+    Returns:
+        list: output file by band (dict) of each date.
+    """
+    tolerance = view_tolerance * DE2RA
+    reused = computed = 0
+    with ExitStack() as stack:
+        stack.enter_context(storage.object_env(tasks[0][2][0]))
+        stack.enter_context(io_env(tasks[0][3].get('gdal_options')))
+        dates = []
+        for _, _, args, kwargs in tasks:
+            img_path, output_file, b, satsen, sz_path, sa_path, vz_path, va_path = args
+            src = stack.enter_context(open_reflectance(img_path, kwargs.get('jp2_strategy', 'open')))
+            aoi, aoi_crs = kwargs.get('aoi'), kwargs.get('aoi_crs', 'EPSG:4326')
+            output_window = aoi_window(src, aoi, aoi_crs) if aoi is not None else Window(0, 0, src.width, src.height)
+            nodata = output_nodata(kwargs.get('output_dtype', 'int32'), kwargs.get('nodata', 0),
+                                   kwargs.get('mapped_nodata'))
+            profile = dict(driver='GTiff', height=int(output_window.height), width=int(output_window.width), count=1,
+                           dtype=kwargs.get('output_dtype', 'int32'), crs=src.crs, nodata=nodata,
+                           transform=src.window_transform(output_window), compress='deflate')
+            block_height, block_width = src.block_shapes[0]
+            if block_height % 16 == 0 and block_width % 16 == 0:
+                profile.update(tiled=True, blockxsize=block_width, blockysize=block_height)
+
+            store = kwargs.get('store')
+            if kwargs.get('grid') is not None:
+                raise RuntimeError('The stack mode writes the native grid and does not support a target grid')
+            if store is not None and kwargs.get('statistics'):
+                raise RuntimeError('Band statistics are written as GeoTIFF metadata, not into a store')
+            if store is not None:
+                store.create_band(b, profile['height'], profile['width'], profile['dtype'], nodata,
+                                  profile['transform'], profile['crs'], (block_height, block_width))
+                dst = None
+            else:
+                dst = stack.enter_context(rasterio.open(str(output_file), 'w', **profile))
+
+            dates.append(dict(
+                src=src, dst=dst, store=store, time_index=kwargs.get('time_index', 0), b=b, satsen=satsen,
+                output_file=output_file, output_window=output_window, nodata=nodata, profile=profile,
+                aoi=aoi if aoi is not None and is_geometry(aoi) else None, aoi_crs=aoi_crs,
+                rescale=kwargs.get('rescale', False), band_coef=get_sensor(satsen).brdf(b),
+                bandpass=kwargs.get('apply_bandpass', True) and get_sensor(satsen).has_bandpass,
+                angles=kwargs.get('angles') or AngleFiles(sz_path, sa_path, vz_path, va_path, satsen),
+                stats=BandStatistics() if kwargs.get('statistics') else None,
+            ))
+
+        first = dates[0]
+        logging.info(f'Harmonizing band {first["b"]} of {len(dates)} dates ...')
+        arena = scratch_arena()
+        for _, window in first['src'].block_windows():
+            if not windows_intersect(window, first['output_window']):
+                continue
+            window = window.intersection(first['output_window'])
+            output = Window(window.col_off - first['output_window'].col_off,
+                            window.row_off - first['output_window'].row_off, window.width, window.height)
+            view_zenith = view = None
+
+            for date in dates:
+                date_view_zenith, solar_zenith, relative_azimuth = date['angles'].read(date['b'], window)
+                shape = solar_zenith.shape
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    # The view terms stay in the arena until the view changes
+                    if view is None or not _same_view(view_zenith, date_view_zenith, tolerance):
+                        view_zenith, view = date_view_zenith, kernel_terms(date_view_zenith, arena, 'view')
+                        computed += 1
+                    else:
+                        reused += 1
+                    sun = kernel_terms(solar_zenith, arena, 'sun')
+                    cos_azimuth = numpy.cos(relative_azimuth, out=arena.buffer('cos_azimuth', shape))
+                    sin_azimuth = numpy.sin(relative_azimuth, out=arena.buffer('sin_azimuth', shape))
+                    brf_sensor = calc_brf_terms(view, sun, cos_azimuth, sin_azimuth, date['band_coef'], arena,
+                                                arena.buffer('brf_sensor', shape))
+                    c_factor = calc_brf_terms(NADIR_TERMS, sun, 1., 0., date['band_coef'], arena,
+                                              arena.buffer('cfactor', shape))
+                    numpy.divide(c_factor, brf_sensor, out=c_factor)
+
+                values, mask = nbar_window(date['src'], window, c_factor, date['b'], date['satsen'], date['rescale'],
+                                           date['bandpass'], arena)
+                if date['aoi'] is not None:
+                    numpy.logical_or(mask, aoi_mask(date['aoi'], date['aoi_crs'], date['profile']['crs'],
+                                                    date['src'].window_transform(window), values.shape), out=mask)
+                data = quantize(values, date['nodata'], arena.buffer('output', shape, date['profile']['dtype']), mask,
+                                arena)
+                if date['stats'] is not None:
+                    date['stats'].update(data, date['nodata'])
+
+                if date['dst'] is not None:
+                    date['dst'].write(data, 1, window=output)
+                else:
+                    date['store'].write(date['b'], date['time_index'], data, window=output)
+
+        for date in dates:
+            if date['stats'] is not None:
+                date['dst'].update_tags(1, **date['stats'].tags())
+
+    logging.info(f'Band {first["b"]}: view terms reused for {reused} of {reused + computed} date windows')
+    if first['store'] is not None:
+        return [{date['b']: Path(date['store'].path) / date['b']} for date in dates]
+    return [{date['b']: date['output_file']} for date in dates]
+
+
+def _same_view(view_zenith, other, tolerance) -> bool:
+    """Verify if two view zenith windows are within tolerance, with the same nodata pixels."""
+    if view_zenith.shape != other.shape:
+        return False
+    nodata = numpy.isnan(view_zenith)
+    if not numpy.array_equal(nodata, numpy.isnan(other)):
+        return False
+    difference = numpy.abs(view_zenith - other)[~nodata]
+    return difference.size == 0 or difference.max() <= tolerance
+
+
+def harmonize_stack(entries, target_dir, apply_bandpass=True, view_tolerance: float = VIEW_TOLERANCE,
+                    dates_per_pass: int = 64, scheduler=None, **options) -> list:
+    """Harmonize a time series of scenes, reusing the view geometry of the dates of the same footprint.
+
+    Args:
+        entries (list): Landsat product directories (named by scene id) and Sentinel-2 entries.
+        target_dir (str): output directory, one sub directory per scene as the harmonizers.
+        apply_bandpass (bool): apply the Sentinel-2 band pass.
+        view_tolerance (float): maximum view zenith difference (degrees) to reuse the view terms of a window.
+        dates_per_pass (int): maximum number of dates harmonized together.
+        scheduler (Scheduler): memory-budgeted scheduler running the groups (footprint and band) concurrently.
+        options (dict): keywords of the harmonizers: aoi, aoi_crs, store, output_dtype, mapped_nodata,
+            statistics and gdal_options.
+
+    Returns:
+        list: output file by band (dict) of each band and date.
+    """
+    tasks = collect_tasks(entries, target_dir, apply_bandpass, **options)
+    groups = stack_groups(tasks, dates_per_pass)
+    logging.info(f'Harmonizing {len(tasks)} bands of {len(entries)} scenes in {len(groups)} groups')
+
+    group_tasks = [(footprint, harmonize_dates, (group, view_tolerance), {}) for footprint, group in groups]
+    if scheduler is not None:
+        results = scheduler.run(group_tasks)
+    else:
+        results = [fn(*args, **kwargs) for _, fn, args, kwargs in group_tasks]
+    return [output for result in results for output in result]
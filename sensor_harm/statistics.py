@@ -0,0 +1,166 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the streaming statistics of the NBAR bands.
+
+The statistics are accumulated per window while a band is harmonized, and
+the accumulators of windows or shards are merged (count, mean and sum of
+squared deviations, Chan et al.), so no pass reads the output again. They are
+stored as GDAL band metadata (``STATISTICS_*``, as ``gdalinfo -stats``) with
+the valid pixel count and the histogram (``STATISTICS_HISTOGRAM``, JSON).
+"""
+
+# Python Native
+import json
+
+# 3rdparty
+import numpy
+import rasterio
+
+# Histogram of the NBAR DN, the values out of the range are counted in the first and last bins
+HISTOGRAM_RANGE = (0, 10000)
+HISTOGRAM_BINS = 100
+
+
+class BandStatistics:
+    """Mergeable accumulator of the statistics and histogram of the valid pixels of a band."""
+
+    def __init__(self, bins: int = HISTOGRAM_BINS, range: tuple = HISTOGRAM_RANGE):
+        """Create an empty accumulator.
+
+        Args:
+            bins (int): number of histogram bins.
+            range (tuple): (min, max) of the histogram.
+        """
+        self.bins = bins
+        self.range = tuple(range)
+        self.total = 0
+        self.count = 0
+        self.minimum = numpy.inf
+        self.maximum = -numpy.inf
+        self.mean = 0.
+        self.m2 = 0.
+        self.histogram = numpy.zeros(bins, dtype='int64')
+
+    def update(self, data, nodata=None):
+        """Accumulate the pixels of a window.
+
+        Args:
+            data (numpy.array): window values.
+            nodata (int): nodata value, ignored.
+        """
+        values = data[data != nodata] if nodata is not None else data.ravel()
+        window = BandStatistics(self.bins, self.range)
+        window.total = data.size
+        window.count = values.size
+        if values.size:
+            values = values.astype('float64')
+            window.minimum = values.min()
+            window.maximum = values.max()
+            window.mean = values.mean()
+            window.m2 = ((values - window.mean) ** 2).sum()
+            edges = numpy.linspace(self.range[0], self.range[1], self.bins + 1)
+            index = numpy.clip(numpy.searchsorted(edges, values, side='right') - 1, 0, self.bins - 1)
+            window.histogram = numpy.bincount(index, minlength=self.bins)
+        return self.merge(window)
+
+    def merge(self, other: 'BandStatistics'):
+        """Merge the statistics of other windows or shards into this accumulator."""
+        if (other.bins, other.range) != (self.bins, self.range):
+            raise RuntimeError('Cannot merge band statistics of different histograms')
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+            self.histogram = self.histogram + other.histogram
+        self.count = count
+        self.total += other.total
+        return self
+
+    @property
+    def stddev(self) -> float:
+        """Retrieve the (population) standard deviation, as GDAL."""
+        return float(numpy.sqrt(self.m2 / self.count)) if self.count else 0.
+
+    def to_dict(self) -> dict:
+        """Retrieve the statistics as a dict."""
+        return dict(
+            count=int(self.count), total=int(self.total),
+            minimum=float(self.minimum) if self.count else None, maximum=float(self.maximum) if self.count else None,
+            mean=float(self.mean) if self.count else None, stddev=self.stddev if self.count else None,
+            valid_percent=100. * self.count / self.total if self.total else 0.,
+            histogram=dict(min=self.range[0], max=self.range[1], counts=self.histogram.tolist()),
+        )
+
+    def tags(self) -> dict:
+        """Retrieve the GDAL band metadata of the statistics."""
+        stats = self.to_dict()
+        tags = dict(
+            STATISTICS_VALID_PERCENT=stats['valid_percent'],
+            STATISTICS_VALID_COUNT=stats['count'],
+            STATISTICS_TOTAL_COUNT=stats['total'],
+            STATISTICS_HISTOGRAM=json.dumps(stats['histogram']),
+        )
+        if self.count:
+            tags.update(STATISTICS_MINIMUM=stats['minimum'], STATISTICS_MAXIMUM=stats['maximum'],
+                        STATISTICS_MEAN=stats['mean'], STATISTICS_STDDEV=stats['stddev'])
+        return tags
+
+    @classmethod
+    def from_tags(cls, tags: dict) -> 'BandStatistics':
+        """Create an accumulator from the GDAL band metadata written by ``tags``."""
+        if 'STATISTICS_HISTOGRAM' not in tags:
+            raise RuntimeError('Missing band statistics')
+        histogram = json.loads(tags['STATISTICS_HISTOGRAM'])
+        stats = cls(len(histogram['counts']), (histogram['min'], histogram['max']))
+        stats.histogram = numpy.array(histogram['counts'], dtype='int64')
+        stats.total = int(tags['STATISTICS_TOTAL_COUNT'])
+        stats.count = int(tags['STATISTICS_VALID_COUNT'])
+        if stats.count:
+            stats.minimum = float(tags['STATISTICS_MINIMUM'])
+            stats.maximum = float(tags['STATISTICS_MAXIMUM'])
+            stats.mean = float(tags['STATISTICS_MEAN'])
+            stats.m2 = float(tags['STATISTICS_STDDEV']) ** 2 * stats.count
+        return stats
+
+
+def read_statistics(path) -> BandStatistics:
+    """Read the statistics of a band file (its metadata only)."""
+    with rasterio.open(str(path)) as dataset:
+        return BandStatistics.from_tags(dataset.tags(1))
+
+
+def write_statistics(path, stats: BandStatistics):
+    """Write the statistics into the metadata of a band file."""
+    with rasterio.open(str(path), 'r+') as dataset:
+        dataset.update_tags(1, **stats.tags())
+
+
+def band_statistics(output_files) -> dict:
+    """Read the statistics of harmonized bands.
+
+    Args:
+        output_files (list): output file by band (dict) of each band, as returned by process_NBAR.
+
+    Returns:
+        dict: statistics (dict, see BandStatistics.to_dict) by band.
+    """
+    return {band: read_statistics(path).to_dict() for outputs in output_files for band, path in outputs.items()}
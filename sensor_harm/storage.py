@@ -0,0 +1,214 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the access to local and object storage inputs.
+
+Product directories may be local paths, ``s3://bucket/prefix`` or
+``/vsis3/bucket/prefix`` (any S3-compatible store, see the GDAL ``AWS_*``
+configuration such as ``AWS_S3_ENDPOINT``, ``AWS_HTTPS`` and
+``AWS_VIRTUAL_HOSTING``). The S3 directories are listed with prefix listings,
+which requires the optional dependency ``boto3`` (``pip install sensor-harm[s3]``).
+Single files (e.g. angle metadata) may also be ``http(s)://`` or ``/vsicurl/``
+URLs, which cannot be listed.
+
+The rasters are read by GDAL with range requests, see OBJECT_STORAGE_CONFIG.
+"""
+
+# Python Native
+import fnmatch
+import os
+import shutil
+import urllib.request
+from contextlib import nullcontext
+from functools import lru_cache
+from pathlib import Path
+
+# 3rdparty
+import rasterio
+
+# GDAL settings of the range-request block cache
+OBJECT_STORAGE_CONFIG = dict(
+    # Do not list the "directory" of each opened file looking for sidecar files
+    GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif,.TIF,.tiff,.jp2,.vrt,.xml,.txt',
+    # Read the GeoTIFF header and tile index in the first request
+    GDAL_INGESTED_BYTES_AT_OPEN=65536,
+    # Merge adjacent block ranges and keep the downloaded chunks in a process-wide LRU.
+    # The chunk size stays the default (16 KB): larger chunks over-fetch around the blocks of an AOI.
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES',
+    CPL_VSIL_CURL_CACHE_SIZE=512 * 1024 ** 2,
+    VSI_CACHE='TRUE',
+    VSI_CACHE_SIZE=64 * 1024 ** 2,
+    GDAL_HTTP_MAX_RETRY=3,
+    GDAL_HTTP_RETRY_DELAY=1,
+)
+
+_SCHEMES = {'s3://': '/vsis3/', 'gs://': '/vsigs/', 'http://': '/vsicurl/http://', 'https://': '/vsicurl/https://'}
+
+
+def is_remote(path) -> bool:
+    """Verify if a path is an object storage or HTTP path."""
+    return str(path).startswith(('/vsi', *_SCHEMES))
+
+
+def gdal_path(path) -> str:
+    """Convert an s3://, gs:// or http(s):// URI into a GDAL virtual file system path."""
+    path = str(path)
+    for scheme, prefix in _SCHEMES.items():
+        if path.startswith(scheme):
+            return prefix + path[len(scheme):]
+    return path
+
+
+def input_dir(path) -> Path:
+    """Retrieve the Path of a local or S3 product directory, converting URIs to GDAL paths."""
+    path = gdal_path(path)
+    if path.startswith('/vsicurl/'):
+        raise RuntimeError(f'HTTP directories cannot be listed, use an S3 prefix instead of {path}')
+    return Path(path)
+
+
+def object_env(path=None, **options):
+    """Create the GDAL environment of object storage reads, or a null context for a local path.
+
+    Args:
+        path (str): input path. When given and local, no environment is created.
+        options (dict): GDAL options overriding OBJECT_STORAGE_CONFIG.
+    """
+    if path is not None and not is_remote(path):
+        return nullcontext()
+    return rasterio.Env(**dict(OBJECT_STORAGE_CONFIG, **options))
+
+
+def _import_boto3():
+    """Import the optional boto3 dependency."""
+    try:
+        import boto3
+    except ImportError:
+        raise RuntimeError('Listing S3 prefixes requires the boto3 package: pip install sensor-harm[s3]')
+    return boto3
+
+
+@lru_cache(maxsize=None)
+def _s3_client():
+    """Create an S3 client using the GDAL endpoint configuration (AWS_S3_ENDPOINT, AWS_HTTPS)."""
+    boto3 = _import_boto3()
+    endpoint = os.environ.get('AWS_S3_ENDPOINT')
+    if endpoint and '://' not in endpoint:
+        scheme = 'http' if os.environ.get('AWS_HTTPS', 'YES').upper() in ('NO', 'FALSE', 'OFF') else 'https'
+        endpoint = f'{scheme}://{endpoint}'
+    region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+    return boto3.client('s3', endpoint_url=endpoint, region_name=region)
+
+
+def _s3_location(path):
+    """Split a /vsis3/ path into bucket and key."""
+    bucket, _, key = gdal_path(path)[len('/vsis3/'):].partition('/')
+    return bucket, key
+
+
+def _check_s3(path):
+    """Verify that a remote path can be listed."""
+    if not str(path).startswith('/vsis3/'):
+        raise RuntimeError(f'Listing is only supported for local and S3 paths, not {path}')
+
+
+def _list_s3(directory, delimiter=None):
+    """List the objects (key, size) and the common prefixes below an S3 directory."""
+    bucket, prefix = _s3_location(directory)
+    prefix = prefix.rstrip('/') + '/' if prefix else ''
+    options = dict(Bucket=bucket, Prefix=prefix)
+    if delimiter:
+        options['Delimiter'] = delimiter
+    objects, prefixes = [], []
+    for page in _s3_client().get_paginator('list_objects_v2').paginate(**options):
+        objects.extend((item['Key'], item['Size']) for item in page.get('Contents', []))
+        prefixes.extend(item['Prefix'] for item in page.get('CommonPrefixes', []))
+    return bucket, prefix, objects, prefixes
+
+
+def glob(directory, pattern: str) -> list:
+    """Find the files below a directory (recursively) whose name matches a pattern.
+
+    S3 directories are listed with a single prefix listing.
+
+    Returns:
+        list: sorted Paths of the matching files.
+    """
+    if not is_remote(directory):
+        return sorted(Path(directory).glob(f'**/{pattern}'))
+    directory = gdal_path(directory)
+    _check_s3(directory)
+    bucket, _, objects, _ = _list_s3(directory)
+    return sorted(Path(f'/vsis3/{bucket}/{key}') for key, _ in objects
+                  if fnmatch.fnmatchcase(key.rsplit('/', 1)[-1], pattern))
+
+
+def listdir(directory) -> list:
+    """List the names of the files and directories of a directory."""
+    if not is_remote(directory):
+        return os.listdir(directory)
+    directory = gdal_path(directory)
+    _check_s3(directory)
+    _, prefix, objects, prefixes = _list_s3(directory, delimiter='/')
+    return [key[len(prefix):] for key, _ in objects] + [item[len(prefix):].rstrip('/') for item in prefixes]
+
+
+def size(path) -> int:
+    """Retrieve the size in bytes of a file, or of all the files below a directory."""
+    if not is_remote(path):
+        path = Path(path)
+        if path.is_dir():
+            return sum(item.stat().st_size for item in path.rglob('*') if item.is_file())
+        return path.stat().st_size
+    path = gdal_path(path)
+    _check_s3(path)
+    bucket, key = _s3_location(path)
+    objects = _list_s3(path)[2]
+    if not objects:
+        return _s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+    return sum(object_size for _, object_size in objects)
+
+
+def read_bytes(path) -> bytes:
+    """Read a whole (small) file, e.g. ANG.txt or MTD_TL.xml."""
+    path = gdal_path(path)
+    if path.startswith('/vsis3/'):
+        bucket, key = _s3_location(path)
+        return _s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+    if path.startswith('/vsicurl/'):
+        with urllib.request.urlopen(path[len('/vsicurl/'):]) as response:
+            return response.read()
+    if is_remote(path):
+        raise RuntimeError(f'Reading {path} is not supported')
+    return Path(path).read_bytes()
+
+
+def read_text(path) -> str:
+    """Read a whole (small) text file."""
+    return read_bytes(path).decode('utf-8')
+
+
+def copy_file(path, target_dir) -> Path:
+    """Copy a local or remote file into a local directory."""
+    target = Path(target_dir) / Path(gdal_path(path)).name
+    if not is_remote(path):
+        shutil.copy(path, target)
+    else:
+        target.write_bytes(read_bytes(path))
+    return target
@@ -0,0 +1,480 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define the on-demand NBAR tile server.
+
+A TileServer harmonizes the tiles of the scenes of a directory on request,
+without harmonizing whole scenes: the scene is prepared once (its band tasks
+are collected through the harmonizers, see StackCollector), then each tile
+reads the window of the reflectance and angles it covers, decimated to the
+tile resolution, and is returned as PNG or GeoTIFF bytes built in memory.
+The rendered tiles and the c-factor planes of the band windows are kept in
+LRU caches bounded in bytes, so repeated requests and the other renderings of
+a window (bands, scale, format) do not compute the kernels again.
+
+The HTTP service (``sensor-harm serve``) answers::
+
+    /scenes                                  scene identifiers (JSON)
+    /scenes/{scene}                          bands, CRS and bounds of a scene (JSON)
+    /tiles/{scene}/{z}/{x}/{y}.{png|tif}     web mercator XYZ tile
+    /bbox/{scene}.{png|tif}?bbox=xmin,ymin,xmax,ymax&crs=EPSG:4326&width=512
+    /cache                                   cache statistics (JSON)
+
+The tiles accept ``bands`` (band or common names, e.g. ``red,green,blue``,
+the default of PNG) and the PNG ``scale`` of the NBAR DN, e.g. ``0,3000``.
+"""
+
+# Python Native
+import json
+import logging
+import math
+import re
+import tempfile
+import threading
+import warnings
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+# 3rdparty
+import numpy
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine, array_bounds
+from rasterio.transform import from_bounds as transform_from_bounds
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window
+from rasterio.windows import from_bounds as window_from_bounds
+
+# sensor-harm
+from . import storage
+from .gdal_env import io_env
+from .harmonization_model import (apply_cfactor, bandpassHLS_1_4, calc_cfactor,
+                                  consult_band, harmonize_band, is_landsat,
+                                  is_sentinel2, output_nodata, prepare_angles,
+                                  quantize, read_window, scratch_arena)
+from .jp2 import open_reflectance
+from .registry import get_sensor
+from .scheduler import parse_memory
+from .stack import StackCollector
+from .storage import object_env
+
+TILE_SIZE = 256
+TILE_FORMATS = {'png': 'image/png', 'tif': 'image/tiff'}
+WEB_MERCATOR = 'EPSG:3857'
+WEB_MERCATOR_EXTENT = 20037508.342789244
+# NBAR DN range of the PNG gray levels
+PNG_SCALE = (0, 3000)
+PNG_BANDS = ('red', 'green', 'blue')
+
+
+class LRUCache:
+    """Thread-safe cache of the most recently used values, bounded by their size in bytes."""
+
+    def __init__(self, max_bytes='512M'):
+        """Create an empty cache.
+
+        Args:
+            max_bytes (int|str): size of the cache, e.g. '512M'. 0 disables the cache.
+        """
+        self.max_bytes = parse_memory(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Retrieve the value of a key, or None when it is not cached."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, nbytes: int):
+        """Cache the value of a key, evicting the least recently used values beyond the size of the cache."""
+        if nbytes > self.max_bytes:
+            return value
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = value, nbytes
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._items.popitem(last=False)
+                self.nbytes -= size
+        return value
+
+    def stats(self) -> dict:
+        """Retrieve the entries, size and hits of the cache."""
+        with self._lock:
+            return dict(entries=len(self._items), nbytes=self.nbytes, max_bytes=self.max_bytes, hits=self.hits,
+                        misses=self.misses)
+
+
+def xyz_bounds(z: int, x: int, y: int) -> tuple:
+    """Retrieve the web mercator bounds (xmin, ymin, xmax, ymax) of an XYZ tile."""
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise RuntimeError(f'Invalid tile {z}/{x}/{y}')
+    size = 2 * WEB_MERCATOR_EXTENT / 2 ** z
+    xmin, ymax = -WEB_MERCATOR_EXTENT + x * size, WEB_MERCATOR_EXTENT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def scene_tasks(entry, work_dir, apply_bandpass=True, gdal_options=None) -> dict:
+    """Prepare a scene and collect the harmonize_band tasks of its bands.
+
+    Args:
+        entry (str): Landsat product directory (named by scene id) or Sentinel-2 entry.
+        work_dir (str): output directory of the harmonizers, receiving the prepared angle or quality bands.
+        apply_bandpass (bool): apply the Sentinel-2 band pass.
+        gdal_options (dict): GDAL options of the reads, see sensor_harm.gdal_env.
+
+    Returns:
+        dict: task (args, kwargs) of harmonize_band by band.
+    """
+    from .angles import Sentinel2MetadataAngles
+    from .landsat import landsat_harmonize
+    from .sentinel2 import sentinel_harmonize
+
+    entry = storage.input_dir(entry)
+    scene_id = entry.name
+    collector = StackCollector()
+    collector.scene_id = scene_id
+    logging.info(f'Preparing scene {scene_id} ...')
+    if is_sentinel2(scene_id):
+        mtd_files = storage.glob(entry, 'MTD_TL.xml')
+        angles = Sentinel2MetadataAngles(mtd_files[0]) if mtd_files else None
+        sentinel_harmonize(entry, work_dir, apply_bandpass, angles=angles, scheduler=collector,
+                           gdal_options=gdal_options)
+    elif is_landsat(scene_id):
+        landsat_harmonize(scene_id, entry, work_dir, cp_quality_band=False, scheduler=collector,
+                          gdal_options=gdal_options)
+    else:
+        raise RuntimeError(f'Scene {scene_id} is not a Sentinel-2 or Landsat scene')
+    return {args[2]: (args, kwargs) for _, (_, fn, args, kwargs) in collector.tasks if fn is harmonize_band}
+
+
+def source_window(src, bounds):
+    """Retrieve the window of a dataset covering bounds (of its CRS), with whole pixels, or None outside of it."""
+    window = window_from_bounds(*bounds, transform=src.transform)
+    col_start, row_start = max(0, math.floor(window.col_off)), max(0, math.floor(window.row_off))
+    col_stop = min(src.width, math.ceil(window.col_off + window.width))
+    row_stop = min(src.height, math.ceil(window.row_off + window.height))
+    if col_stop <= col_start or row_stop <= row_start:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def render_band(task, crs, transform, shape, planes: LRUCache = None) -> numpy.ndarray:
+    """Harmonize a band into the grid of a tile, reading only the window covering it.
+
+    The window is read decimated by the integer factor closest to the tile
+    resolution (the overviews of the band are used when they exist) and its
+    c-factor is computed on the decimated angles. The NBAR is then reprojected
+    (nearest) into the tile, so a tile of the native grid has the values of the
+    harmonized band.
+
+    Args:
+        task (tuple): args and kwargs of the harmonize_band task of the band, see scene_tasks.
+        crs (str|CRS): CRS of the tile.
+        transform (Affine): transform of the tile.
+        shape (tuple): rows and columns of the tile.
+        planes (LRUCache): cache of the c-factor planes of the band windows.
+
+    Returns:
+        numpy.array: NBAR of the tile in the output data type of the task, nodata outside of the scene.
+    """
+    args, kwargs = task
+    img_path, _, b, satsen, sz_path, sa_path, vz_path, va_path = args
+    dtype = kwargs.get('output_dtype', 'int32')
+    nodata = output_nodata(dtype, kwargs.get('nodata', 0), kwargs.get('mapped_nodata'))
+    tile = numpy.full(shape, nodata, dtype=dtype)
+
+    with object_env(img_path), io_env(kwargs.get('gdal_options')), \
+            open_reflectance(img_path, kwargs.get('jp2_strategy', 'open')) as src:
+        bounds = array_bounds(shape[0], shape[1], transform)
+        if src.crs != crs:
+            bounds = transform_bounds(crs, src.crs, *bounds, densify_pts=21)
+        window = source_window(src, bounds)
+        if window is None:
+            return tile
+        step = max(1, int((bounds[2] - bounds[0]) / shape[1] / src.res[0]))
+        window_shape = (math.ceil(window.height / step), math.ceil(window.width / step))
+
+        key = (str(img_path), tuple(int(v) for v in window.flatten()), step)
+        c_factor = planes.get(key) if planes is not None else None
+        if c_factor is None:
+            angles = prepare_angles(sz_path, sa_path, vz_path, va_path, satsen, b, window,
+                                    angles=kwargs.get('angles'))
+            view_zenith, solar_zenith, relative_azimuth = (angle[::step, ::step] for angle in angles)
+            # The plane leaves the arena of the worker, it is reused by the following requests
+            c_factor = calc_cfactor(view_zenith, solar_zenith, relative_azimuth, get_sensor(satsen).brdf(b),
+                                    scratch_arena()).copy()
+            if planes is not None:
+                planes.put(key, c_factor, c_factor.nbytes)
+
+        reflectance, mask = read_window(src, window, out_shape=window_shape, resampling=Resampling.nearest)
+        values = apply_cfactor(reflectance, mask, c_factor, kwargs.get('rescale', False))
+        if kwargs.get('apply_bandpass', True) and get_sensor(satsen).has_bandpass:
+            values = bandpassHLS_1_4(values, b, satsen).astype(src.dtypes[0])
+        nbar = quantize(values, nodata, numpy.empty(window_shape, dtype=dtype), mask)
+
+        window_transform = src.window_transform(window) * Affine.scale(window.width / window_shape[1],
+                                                                       window.height / window_shape[0])
+        reproject(nbar, tile, src_transform=window_transform, src_crs=src.crs, src_nodata=nodata,
+                  dst_transform=transform, dst_crs=crs, dst_nodata=nodata, resampling=Resampling.nearest)
+    return tile
+
+
+def encode_tile(data, fmt: str, crs, transform, nodata, scale=PNG_SCALE) -> bytes:
+    """Encode the bands of a tile as PNG or GeoTIFF bytes, in memory.
+
+    Args:
+        data (numpy.array): bands of the tile (bands, rows, columns).
+        fmt (str): 'png' (gray or RGB with an alpha band, 1 or 3 bands) or 'tif' (NBAR DN, georeferenced).
+        crs (str|CRS): CRS of the tile.
+        transform (Affine): transform of the tile.
+        nodata (int): nodata value of data.
+        scale (tuple): NBAR DN of the darkest and brightest PNG levels.
+
+    Returns:
+        bytes: encoded tile.
+    """
+    count, height, width = data.shape
+    if fmt == 'tif':
+        profile = dict(driver='GTiff', count=count, height=height, width=width, dtype=data.dtype, crs=crs,
+                       transform=transform, nodata=nodata, compress='deflate')
+    elif fmt == 'png':
+        if count not in (1, 3):
+            raise RuntimeError(f'A PNG tile has 1 or 3 bands, not {count}')
+        low, high = scale
+        levels = numpy.clip((data - low) * (254. / (high - low)) + 1, 1, 255).astype('uint8')
+        alpha = numpy.where((data == nodata).any(axis=0), 0, 255).astype('uint8')
+        data = numpy.concatenate([levels, alpha[numpy.newaxis]])
+        profile = dict(driver='PNG', count=count + 1, height=height, width=width, dtype='uint8')
+    else:
+        raise RuntimeError(f'Tile format {fmt} is not one of {list(TILE_FORMATS)}')
+
+    # The PNG is not georeferenced, without an auxiliary file
+    with rasterio.Env(GDAL_PAM_ENABLED='NO'), MemoryFile() as memfile, warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with memfile.open(**profile) as dst:
+            dst.write(data)
+        return memfile.read()
+
+
+class TileServer:
+    """Harmonize the tiles of the scenes of a directory on request, with LRU caches of tiles and c-factor planes."""
+
+    def __init__(self, root, work_dir=None, cache_size='256M', plane_cache_size='1G', apply_bandpass=True,
+                 gdal_options=None):
+        """Create a tile server.
+
+        Args:
+            root (str): directory of the scenes, Landsat product directories and Sentinel-2 entries.
+            work_dir (str): directory of the prepared scenes. Default is a temporary directory.
+            cache_size (int|str): size of the cache of the rendered tiles, e.g. '256M'.
+            plane_cache_size (int|str): size of the cache of the c-factor planes, e.g. '1G'.
+            apply_bandpass (bool): apply the Sentinel-2 band pass.
+            gdal_options (dict): GDAL options of the reads, see sensor_harm.gdal_env.
+        """
+        self.root = storage.input_dir(root)
+        self.work_dir = Path(work_dir or tempfile.mkdtemp(prefix='sensor-harm-tiles-'))
+        self.apply_bandpass = apply_bandpass
+        self.gdal_options = gdal_options
+        self.tiles = LRUCache(cache_size)
+        self.planes = LRUCache(plane_cache_size)
+        self._scenes = {}
+        # The server lock guards the scene locks only, a scene is prepared under its own lock
+        self._lock = threading.Lock()
+        self._scene_locks = {}
+
+    def scenes(self) -> list:
+        """Retrieve the identifiers of the scenes of the directory."""
+        return sorted(name for name in storage.listdir(self.root) if is_landsat(name) or is_sentinel2(name))
+
+    def scene(self, scene_id: str) -> dict:
+        """Retrieve the band tasks of a scene, prepared on its first request, see scene_tasks.
+
+        The requests of the other scenes are not blocked while a scene is prepared.
+        """
+        tasks = self._scenes.get(scene_id)
+        if tasks is not None:
+            return tasks
+        with self._lock:
+            scene_lock = self._scene_locks.setdefault(scene_id, threading.Lock())
+        with scene_lock:
+            if scene_id not in self._scenes:
+                if scene_id not in self.scenes():
+                    raise LookupError(f'Scene {scene_id} not found in {self.root}')
+                self._scenes[scene_id] = scene_tasks(self.root / scene_id, self.work_dir, self.apply_bandpass,
+                                                     self.gdal_options)
+            return self._scenes[scene_id]
+
+    def describe(self, scene_id: str) -> dict:
+        """Retrieve the bands (with their common names), CRS and bounds (EPSG:4326) of a scene."""
+        tasks = self.scene(scene_id)
+        args, kwargs = next(iter(tasks.values()))
+        with object_env(args[0]), rasterio.open(str(args[0])) as src:
+            bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds, densify_pts=21)
+            crs = src.crs.to_string()
+        return dict(scene_id=scene_id, bands={b: consult_band(b, task[0][3]) for b, task in tasks.items()},
+                    crs=crs, bounds=bounds)
+
+    def resolve_bands(self, scene_id: str, bands=None, fmt: str = 'png') -> list:
+        """Retrieve the bands of a scene from band or common names, by default red, green and blue for PNG."""
+        tasks = self.scene(scene_id)
+        if not bands:
+            bands = PNG_BANDS if fmt == 'png' else list(tasks)
+        common_names = {consult_band(b, task[0][3]): b for b, task in reversed(list(tasks.items()))}
+        resolved = [name if name in tasks else common_names.get(name) for name in bands]
+        missing = [name for name, b in zip(bands, resolved) if b is None]
+        if missing:
+            raise LookupError(f'Bands {missing} not found in {scene_id}, expected some of {list(tasks)}')
+        return resolved
+
+    def render(self, scene_id: str, crs, transform, shape, bands=None, fmt: str = 'png',
+               scale=PNG_SCALE) -> bytes:
+        """Render the bands of a scene into a tile grid.
+
+        Args:
+            scene_id (str): scene identifier.
+            crs (str): CRS of the tile.
+            transform (Affine): transform of the tile.
+            shape (tuple): rows and columns of the tile.
+            bands (list): band or common names. Default is red, green, blue for PNG and all the bands for GeoTIFF.
+            fmt (str): 'png' or 'tif', see encode_tile.
+            scale (tuple): NBAR DN of the darkest and brightest PNG levels.
+
+        Returns:
+            bytes: encoded tile, from the cache when it was already rendered.
+        """
+        if fmt not in TILE_FORMATS:
+            raise RuntimeError(f'Tile format {fmt} is not one of {list(TILE_FORMATS)}')
+        # The cache is keyed on the requested bands, so a cached tile does not need its scene
+        key = (scene_id, tuple(bands) if bands else None, str(crs), tuple(transform)[:6], tuple(shape), fmt,
+               tuple(scale) if fmt == 'png' else None)
+        content = self.tiles.get(key)
+        if content is not None:
+            return content
+
+        bands = self.resolve_bands(scene_id, bands, fmt)
+        tasks = self.scene(scene_id)
+        data = numpy.stack([render_band(tasks[b], crs, transform, shape, self.planes) for b in bands])
+        _, kwargs = tasks[bands[0]]
+        nodata = output_nodata(kwargs.get('output_dtype', 'int32'), kwargs.get('nodata', 0),
+                               kwargs.get('mapped_nodata'))
+        content = encode_tile(data, fmt, crs, transform, nodata, scale)
+        return self.tiles.put(key, content, len(content))
+
+    def xyz(self, scene_id: str, z: int, x: int, y: int, bands=None, fmt: str = 'png', scale=PNG_SCALE) -> bytes:
+        """Render a web mercator XYZ tile of a scene, see render."""
+        transform = transform_from_bounds(*xyz_bounds(z, x, y), TILE_SIZE, TILE_SIZE)
+        return self.render(scene_id, WEB_MERCATOR, transform, (TILE_SIZE, TILE_SIZE), bands, fmt, scale)
+
+    def bbox(self, scene_id: str, bbox, crs: str = 'EPSG:4326', width: int = TILE_SIZE, height: int = None,
+             bands=None, fmt: str = 'png', scale=PNG_SCALE) -> bytes:
+        """Render the bounding box (xmin, ymin, xmax, ymax) of a scene, see render.
+
+        The height defaults to the aspect ratio of the bounding box.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        if xmax <= xmin or ymax <= ymin:
+            raise RuntimeError(f'Invalid bounding box {bbox}')
+        height = height or max(1, round(width * (ymax - ymin) / (xmax - xmin)))
+        transform = transform_from_bounds(xmin, ymin, xmax, ymax, width, height)
+        return self.render(scene_id, crs, transform, (height, width), bands, fmt, scale)
+
+    def cache_stats(self) -> dict:
+        """Retrieve the statistics of the tile and c-factor plane caches."""
+        return dict(tiles=self.tiles.stats(), planes=self.planes.stats(), scenes=len(self._scenes))
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8000) -> ThreadingHTTPServer:
+        """Create the HTTP service of the tiles, see the module documentation and ThreadingHTTPServer.serve_forever."""
+        server = ThreadingHTTPServer((host, port), TileRequestHandler)
+        server.tile_server = self
+        return server
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Answer the HTTP requests of a TileServer."""
+
+    TILE_PATH = re.compile(r'^/tiles/(?P<scene>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<fmt>\w+)$')
+    BBOX_PATH = re.compile(r'^/bbox/(?P<scene>[^/]+)\.(?P<fmt>\w+)$')
+    SCENE_PATH = re.compile(r'^/scenes/(?P<scene>[^/]+)$')
+
+    def do_GET(self):
+        """Answer a GET request."""
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        tiles = self.server.tile_server
+        try:
+            bands = [name.strip() for name in query['bands'].split(',')] if query.get('bands') else None
+            scale = tuple(float(value) for value in query.get('scale', '').split(',')) if query.get('scale') \
+                else PNG_SCALE
+            if url.path == '/scenes':
+                return self._json(tiles.scenes())
+            if url.path == '/cache':
+                return self._json(tiles.cache_stats())
+            match = self.SCENE_PATH.match(url.path)
+            if match:
+                return self._json(tiles.describe(match['scene']))
+            match = self.TILE_PATH.match(url.path)
+            if match:
+                content = tiles.xyz(match['scene'], int(match['z']), int(match['x']), int(match['y']), bands,
+                                    match['fmt'], scale)
+                return self._send(200, TILE_FORMATS[match['fmt']], content)
+            match = self.BBOX_PATH.match(url.path)
+            if match:
+                if 'bbox' not in query:
+                    raise RuntimeError('Missing bbox=xmin,ymin,xmax,ymax')
+                bbox = tuple(float(value) for value in query['bbox'].split(','))
+                content = tiles.bbox(match['scene'], bbox, query.get('crs', 'EPSG:4326'),
+                                     int(query.get('width', TILE_SIZE)),
+                                     int(query['height']) if 'height' in query else None, bands, match['fmt'], scale)
+                return self._send(200, TILE_FORMATS[match['fmt']], content)
+            self._send(404, 'text/plain', b'Not found')
+        except LookupError as e:
+            self._send(404, 'text/plain', str(e).encode())
+        except (RuntimeError, ValueError) as e:
+            self._send(400, 'text/plain', str(e).encode())
+        except Exception as e:
+            logging.exception(f'Request {self.path} failed')
+            self._send(500, 'text/plain', f'{type(e).__name__}: {e}'.encode())
+
+    def _json(self, value):
+        self._send(200, 'application/json', json.dumps(value).encode())
+
+    def _send(self, status: int, content_type: str, content: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        """Log the requests with the logging module."""
+        logging.info(f'{self.address_string()} {format % args}')
@@ -0,0 +1,303 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define a long-running harmonization worker.
+
+The worker stays resident and consumes jobs, so the imports, the GDAL driver
+registration, the sensor registry and the angle providers are set up once for
+many scenes. The datasets are opened by each job.
+
+A job is a JSON object::
+
+    {"id": "job-1", "scene_id": "LC08_L2SP_...", "input": "/data/LC08_L2SP_...",
+     "output": "/data/nbar", "angle_dir": null, "aoi": null, "aoi_crs": "EPSG:4326",
+     "store": null, "apply_bandpass": true, "jp2_strategy": "open", "output_dtype": "int32",
+     "nodata": null, "cfactor_dir": null, "overviews": null, "overview_resampling": "average",
+     "statistics": false, "grid": null, "tile": null, "indices": null, "skip_qa": null,
+     "gdal_options": null}
+
+Only ``input`` and ``output`` are required, ``scene_id`` defaults to the input
+directory name. With ``statistics``, the band statistics are part of the result.
+A ``grid`` is a dict (see TargetGrid), a ``tile`` a [h, v] list and ``indices``
+a list of spectral indices, e.g. ["NDVI", "NBR"]. With ``skip_qa``, a list of quality classes
+(e.g. ["fill", "cloud", "shadow"]), the skipped pixels of each band are part of the result. The
+``gdal_options`` of a job (e.g. {"GDAL_NUM_THREADS": "ALL_CPUS"}) override the GDAL profile of the
+worker, see sensor_harm.gdal_env. Jobs are read from a JSON-lines stream (one job per line, one
+result per line) or from a spool directory::
+
+    spool/incoming/*.json   jobs waiting, claimed by an atomic rename to
+    spool/running/          the job being processed (named after its worker host and pid), then moved to
+    spool/done/             jobs and their results, or
+    spool/failed/           failed jobs and their errors.
+
+A worker starting on a spool directory moves the running jobs of the dead workers
+of its host back to incoming/, so the jobs of a crashed worker are processed again.
+
+The worker is run by the command line (``sensor-harm batch``).
+
+A worker drains (finishes the current job and stops) on SIGTERM, SIGINT or
+when the file ``spool/DRAIN`` exists. A job read from the stream after the
+drain is not processed, its result has the status 'rejected'.
+"""
+
+# Python Native
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+# 3rdparty
+import rasterio
+
+# sensor-harm
+from . import storage
+from .angles import LandsatANGAngles, Sentinel2MetadataAngles
+from .landsat import landsat_ang_file, landsat_harmonize
+from .qa import skip_report
+from .sentinel2 import sentinel_harmonize
+
+SPOOL_DIRS = ('incoming', 'running', 'done', 'failed')
+
+
+class Worker:
+    """Resident worker harmonizing Landsat and Sentinel-2 scenes from a job queue."""
+
+    def __init__(self, cache_size: int = 16, gdal_cache_mb: int = 512, scheduler=None, poll_interval: float = 1.0):
+        """Create a worker.
+
+        Args:
+            cache_size (int): maximum number of cached angle providers.
+            gdal_cache_mb (int): GDAL block cache size (MB) of the jobs.
+            scheduler (Scheduler): memory-budgeted scheduler shared by all jobs.
+            poll_interval (float): seconds between spool directory scans when it is empty.
+        """
+        self.cache_size = cache_size
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.draining = False
+        self.processed = 0
+        self._angles = OrderedDict()
+        self._env = rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb, GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR')
+
+    def drain(self, *args):
+        """Stop consuming jobs after the current one."""
+        if not self.draining:
+            logging.info('Draining worker ...')
+        self.draining = True
+
+    def _cached(self, key, factory):
+        """Retrieve an angle provider from the LRU cache, creating it when missing."""
+        if key in self._angles:
+            self._angles.move_to_end(key)
+            return self._angles[key]
+        provider = factory()
+        self._angles[key] = provider
+        while len(self._angles) > self.cache_size:
+            self._angles.popitem(last=False)
+        return provider
+
+    def angles(self, scene_id: str, entry: Path):
+        """Retrieve the cached angle provider of a scene, or None when its angles come from angle bands."""
+        if scene_id.startswith('S2'):
+            mtd_files = storage.glob(entry, 'MTD_TL.xml')
+            if not mtd_files:
+                return None
+            return self._cached(str(mtd_files[0]), lambda: Sentinel2MetadataAngles(mtd_files[0]))
+
+        ang_file = landsat_ang_file(entry, scene_id)
+        if ang_file is None:
+            return None
+        return self._cached(str(ang_file), lambda: LandsatANGAngles(ang_file))
+
+    def process(self, job: dict) -> dict:
+        """Harmonize the scene of a job.
+
+        Args:
+            job (dict): job description, see the module documentation.
+
+        Returns:
+            dict: job result with status ('done' or 'failed'), seconds, output and error.
+        """
+        start = time.perf_counter()
+        result = dict(id=job.get('id'), scene_id=job.get('scene_id'), status='done', output=None, error=None)
+        try:
+            entry = storage.input_dir(job['input'])
+            scene_id = job.get('scene_id') or entry.name
+            result['scene_id'] = scene_id
+            options = dict(aoi=job.get('aoi'), aoi_crs=job.get('aoi_crs', 'EPSG:4326'), scheduler=self.scheduler,
+                           store=job.get('store'), output_dtype=job.get('output_dtype', 'int32'),
+                           mapped_nodata=job.get('nodata'), cfactor_dir=job.get('cfactor_dir'),
+                           overviews=job.get('overviews'),
+                           overview_resampling=job.get('overview_resampling', 'average'),
+                           statistics=job.get('statistics', False), grid=job.get('grid'),
+                           tile=tuple(job['tile']) if job.get('tile') else None, indices=job.get('indices'),
+                           skip_qa=job.get('skip_qa'), gdal_options=job.get('gdal_options'))
+
+            with self._env:
+                if scene_id.startswith('S2'):
+                    angles = self.angles(scene_id, entry)
+                    output = sentinel_harmonize(entry, job['output'], job.get('apply_bandpass', True),
+                                                angles=angles, jp2_strategy=job.get('jp2_strategy', 'open'),
+                                                **options)
+                elif scene_id.startswith(('LT04', 'LT05', 'LE07', 'LC08')):
+                    angle_dir = job.get('angle_dir')
+                    angles = self.angles(scene_id, entry) if angle_dir is None else None
+                    output = landsat_harmonize(scene_id, entry, job['output'], angle_dir=angle_dir,
+                                               angles=angles, **options)
+                else:
+                    raise RuntimeError(f'Scene {scene_id} is not a Sentinel-2 or Landsat scene')
+            if options['statistics']:
+                result['statistics'] = output[2]
+            result['output'] = str(output[0] if isinstance(output, tuple) else output)
+            if options['skip_qa']:
+                result['skip'] = skip_report(sorted(Path(result['output']).glob('*.tif')))
+        except Exception as e:
+            logging.error(f'Job {job.get("id")} failed: {e}')
+            logging.debug(traceback.format_exc())
+            result.update(status='failed', error=f'{type(e).__name__}: {e}')
+
+        result['seconds'] = time.perf_counter() - start
+        self.processed += 1
+        logging.info(f'Job {result["id"]} {result["status"]} in {result["seconds"]:.1f}s')
+        return result
+
+    def serve_stream(self, stream=None, output=None):
+        """Consume JSON-lines jobs from a stream (stdin) and write one JSON result per line.
+
+        Stops at the end of the stream or when draining, the job read after the drain is rejected.
+        """
+        stream = stream or sys.stdin
+        output = output or sys.stdout
+        for line in stream:
+            line = line.strip()
+            if not line:
+                if self.draining:
+                    break
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                result = dict(id=None, status='failed', error=f'Invalid job: {e}')
+            else:
+                if self.draining:
+                    result = dict(id=job.get('id'), scene_id=job.get('scene_id'), status='rejected', output=None,
+                                  error='Worker draining')
+                else:
+                    result = self.process(job)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            if self.draining:
+                break
+
+    def claim(self, spool_dir: Path):
+        """Claim the first job (by name) of a spool directory by moving it to running/, or None when there is none.
+
+        The running job is named {job}@{host}@{pid}.json after the worker, see recover.
+        """
+        owner = f'{socket.gethostname()}@{os.getpid()}'
+        for job_file in sorted((spool_dir / 'incoming').glob('*.json')):
+            running = spool_dir / 'running' / f'{job_file.stem}@{owner}.json'
+            try:
+                os.rename(job_file, running)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            return running
+        return None
+
+    def recover(self, spool_dir: Path) -> list:
+        """Move the running jobs of the dead workers of this host (or without a worker) back to incoming/.
+
+        Returns:
+            list: paths of the recovered jobs.
+        """
+        host = socket.gethostname()
+        recovered = []
+        for running in sorted((spool_dir / 'running').glob('*.json')):
+            parts = running.stem.rsplit('@', 2)
+            owned = len(parts) == 3 and parts[2].isdigit()
+            if owned and (parts[1] != host or _alive(int(parts[2]))):
+                continue
+            incoming = spool_dir / 'incoming' / f'{parts[0] if owned else running.stem}.json'
+            try:
+                os.rename(running, incoming)
+            except FileNotFoundError:
+                # Recovered by another worker
+                continue
+            logging.warning(f'Recovered the job {incoming.name} of a dead worker')
+            recovered.append(incoming)
+        return recovered
+
+    def serve_spool(self, spool_dir, exit_when_empty: bool = False):
+        """Consume the jobs of a spool directory until drained.
+
+        Args:
+            spool_dir (str): spool directory, its subdirectories are created when missing.
+            exit_when_empty (bool): stop when there are no more jobs instead of waiting for new ones.
+        """
+        spool_dir = Path(spool_dir)
+        for name in SPOOL_DIRS:
+            (spool_dir / name).mkdir(parents=True, exist_ok=True)
+        self.recover(spool_dir)
+
+        while not self.draining:
+            if (spool_dir / 'DRAIN').exists():
+                self.drain()
+                break
+
+            running = self.claim(spool_dir)
+            if running is None:
+                if exit_when_empty:
+                    break
+                time.sleep(self.poll_interval)
+                continue
+
+            name = running.stem.rsplit('@', 2)[0]
+            try:
+                job = json.loads(running.read_text())
+            except ValueError as e:
+                job, result = {}, dict(id=name, status='failed', error=f'Invalid job: {e}')
+            else:
+                job.setdefault('id', name)
+                result = self.process(job)
+
+            target = spool_dir / result['status'] / f'{name}.json'
+            target.write_text(json.dumps(dict(job=job, result=result), indent=2))
+            running.unlink()
+
+    def install_signal_handlers(self):
+        """Drain on SIGTERM and SIGINT."""
+        signal.signal(signal.SIGTERM, self.drain)
+        signal.signal(signal.SIGINT, self.drain)
+
+
+def _alive(pid: int) -> bool:
+    """Check if a process of this host is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,204 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Define a chunked, time-indexed Zarr store for the harmonized bands.
+
+Each band (and the quality band) is an array of shape (time, y, x) chunked by
+(1, block height, block width), with the CRS, affine transform and nodata in
+its attributes. The group attribute ``scenes`` lists the scene of each time
+index, so new scenes of the same tile are appended to an existing store.
+
+Workers may write distinct chunks concurrently. The time axis and the scene
+list are updated under a store lock (a lock file in the store and a thread lock),
+so that writers of several processes only grow the time axis and assign distinct
+time indexes. Unaligned windows from several processes need a ``synchronizer_path``.
+
+Requires the optional dependency ``zarr`` (``pip install sensor-harm[zarr]``).
+"""
+
+# Python Native
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# 3rdparty
+import numpy
+import rasterio
+from rasterio.windows import Window
+
+# sensor-harm
+from .harmonization_model import aoi_window
+
+
+def _import_zarr():
+    """Import the optional zarr dependency."""
+    try:
+        import zarr
+    except ImportError:
+        raise RuntimeError('Zarr output requires the zarr package: pip install sensor-harm[zarr]')
+    return zarr
+
+
+# Thread locks of the store lock files, a lock file does not exclude the threads of its process
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+class ZarrStore:
+    """Chunked multi-band and time-indexed store of harmonized scenes."""
+
+    def __init__(self, path, synchronizer_path=None):
+        """Create or open a Zarr store.
+
+        Args:
+            path (str): path to the Zarr store directory.
+            synchronizer_path (str): path to the process synchronizer lock files, required when
+                parallel processes write windows which are not aligned to the chunks.
+        """
+        self.path = str(path)
+        self.synchronizer_path = str(synchronizer_path) if synchronizer_path else None
+        self._group = None
+
+    def __getstate__(self):
+        """Pickle the store location only, the group is opened again on each worker."""
+        return dict(path=self.path, synchronizer_path=self.synchronizer_path, _group=None)
+
+    @property
+    def group(self):
+        """Retrieve the (lazily opened) Zarr group."""
+        if self._group is None:
+            zarr = _import_zarr()
+            synchronizer = zarr.ProcessSynchronizer(self.synchronizer_path) if self.synchronizer_path else None
+            self._group = zarr.open_group(self.path, mode='a', synchronizer=synchronizer)
+        return self._group
+
+    @contextmanager
+    def lock(self):
+        """Lock the store metadata (time axis and scenes) against the other threads and processes."""
+        import fasteners
+
+        lock_file = str(Path(self.synchronizer_path or self.group.store.path) / '.sensor_harm.lock')
+        with _thread_locks_guard:
+            thread_lock = _thread_locks.setdefault(lock_file, threading.Lock())
+        with thread_lock, fasteners.InterProcessLock(lock_file):
+            yield
+
+    @property
+    def scenes(self) -> list:
+        """Retrieve the scene identifiers by time index."""
+        return list(self.group.attrs.get('scenes', []))
+
+    def scene_index(self, scene_id: str) -> int:
+        """Retrieve the time index of a scene, appending it to the store when it is new.
+
+        The scenes are read and appended under the store lock, so concurrent writers assign distinct indexes.
+        """
+        with self.lock():
+            self.group.attrs.refresh()
+            scenes = self.scenes
+            if scene_id not in scenes:
+                scenes.append(scene_id)
+                self.group.attrs['scenes'] = scenes
+            return scenes.index(scene_id)
+
+    def create_band(self, name, height, width, dtype, nodata, transform, crs, chunks):
+        """Create the array of a band if it does not exist and check its grid.
+
+        Args:
+            name (str): band name.
+            height (int): number of rows.
+            width (int): number of columns.
+            dtype (str): data type.
+            nodata (int): nodata value.
+            transform (Affine): affine transform.
+            crs (CRS): coordinate reference system.
+            chunks (tuple): chunk shape (rows, cols).
+
+        Returns:
+            Array: the band array.
+        """
+        with self.lock():
+            if name in self.group:
+                array = self.group[name]
+                if tuple(array.shape[1:]) != (height, width) or \
+                        tuple(array.attrs['transform']) != tuple(transform)[:6]:
+                    raise RuntimeError(f'Band {name} grid does not match the existing grid of {self.path}')
+                return array
+
+            array = self.group.create_dataset(name, shape=(0, height, width), chunks=(1,) + tuple(chunks),
+                                              dtype=dtype, fill_value=nodata, overwrite=False)
+            array.attrs.update(crs=crs.to_wkt() if crs else None, transform=list(tuple(transform)[:6]),
+                               nodata=nodata)
+            return array
+
+    def write(self, name, time_index, data, window=None):
+        """Write a band window of a scene.
+
+        Args:
+            name (str): band name.
+            time_index (int): scene time index.
+            data (numpy.array): 2D array.
+            window (Window): window of the band grid. Defaults to the whole band.
+        """
+        with self.lock():
+            # The array metadata is read again under the lock, so the time axis only grows
+            array = self.group[name]
+            if array.shape[0] <= time_index:
+                array.resize((time_index + 1,) + tuple(array.shape[1:]))
+        if window is None:
+            window = Window(0, 0, array.shape[2], array.shape[1])
+        row, col = int(window.row_off), int(window.col_off)
+        array[time_index, row: row + data.shape[0], col: col + data.shape[1]] = data
+
+    def write_raster(self, name, time_index, img_path, aoi=None, aoi_crs='EPSG:4326', grid=None, tile=None):
+        """Write a raster file (e.g. the quality band) into the store.
+
+        Args:
+            name (str): band name.
+            time_index (int): scene time index.
+            img_path (str): path to raster file.
+            aoi (tuple|dict): area of interest.
+            aoi_crs (str): coordinate reference system of aoi.
+            grid (TargetGrid): target grid the raster is warped into (nearest neighbour).
+            tile (tuple): target tile of grid.
+
+        Returns:
+            Path: path to the band array.
+        """
+        with rasterio.open(str(img_path)) as src:
+            window = aoi_window(src, aoi, aoi_crs) if aoi is not None else Window(0, 0, src.width, src.height)
+            data = src.read(1, window=window)
+            nodata = src.nodata if src.nodata is not None else 0
+            transform, crs = src.window_transform(window), src.crs
+            if grid is not None:
+                data, transform = grid.warp(data, transform, crs, nodata, tile, 'nearest')
+                crs = grid.crs
+            self.create_band(name, data.shape[0], data.shape[1], src.dtypes[0], nodata, transform, crs,
+                             src.block_shapes[0])
+        logging.info(f'Writing {img_path} into {self.path}/{name}')
+        self.write(name, time_index, data)
+        return Path(self.path) / name
+
+    def read(self, name, time_index, window=None) -> numpy.ndarray:
+        """Read a band window of a scene."""
+        array = self.group[name]
+        if window is None:
+            return array[time_index]
+        row, col = int(window.row_off), int(window.col_off)
+        return array[time_index, row: row + int(window.height), col: col + int(window.width)]
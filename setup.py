@@ -41,15 +41,27 @@ tests_require = [
     'pydocstyle>=4.0',
     'isort>4.3',
     'check-manifest>=0.40',
+    'boto3>=1.20',
+    'moto[server]>=4.0',
 ]
 
 examples_require = [
 ]
 
+zarr_require = [
+    'zarr>=2.11,<3',
+]
+
+s3_require = [
+    'boto3>=1.20',
+]
+
 extras_require = {
     'docs': docs_require,
     'examples': examples_require,
     'tests': tests_require,
+    'zarr': zarr_require,
+    's3': s3_require,
 }
 
 extras_require['all'] = [req for _, reqs in extras_require.items() for req in reqs]
@@ -90,6 +102,9 @@ setup(
     include_package_data=True,
     platforms='any',
     entry_points={
+        'console_scripts': [
+            'sensor-harm = sensor_harm.cli:cli',
+        ],
     },
     extras_require=extras_require,
     install_requires=install_requires,
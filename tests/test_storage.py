@@ -0,0 +1,107 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Unit-test for the object storage inputs, against a local S3-compatible server (moto)."""
+
+# Python Native
+import socket
+
+# 3rdparty
+import numpy
+import pytest
+import rasterio
+
+# sensor-harm
+from sensor_harm import storage
+from sensor_harm.accuracy import SYNTHETIC_SCENE, synthetic_landsat_scene
+from sensor_harm.landsat import landsat_harmonize
+
+moto_server = pytest.importorskip('moto.server')
+boto3 = pytest.importorskip('boto3')
+
+BUCKET = 'sensor-harm'
+PREFIX = 'landsat'
+MTL = 'GROUP = LANDSAT_METADATA_FILE\n  GROUP = PRODUCT_CONTENTS\n  END_GROUP = PRODUCT_CONTENTS\nEND_GROUP\nEND\n'
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def s3_endpoint():
+    """Run a local S3 server for the module, returning its endpoint."""
+    port = _free_port()
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    yield f'127.0.0.1:{port}'
+    server.stop()
+
+
+@pytest.fixture
+def s3_scene(s3_endpoint, tmp_path, monkeypatch):
+    """Upload a synthetic Landsat scene (and its MTL) to the local S3 server, returning the local scene directory."""
+    for name, value in dict(AWS_S3_ENDPOINT=s3_endpoint, AWS_HTTPS='NO', AWS_VIRTUAL_HOSTING='FALSE',
+                            AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                            AWS_REGION='us-east-1').items():
+        monkeypatch.setenv(name, value)
+    storage._s3_client.cache_clear()
+
+    scene_dir = synthetic_landsat_scene(tmp_path / 'input', size=256, block=128)
+    (scene_dir / f'{SYNTHETIC_SCENE}_MTL.txt').write_text(MTL)
+
+    client = storage._s3_client()
+    if BUCKET not in [bucket['Name'] for bucket in client.list_buckets()['Buckets']]:
+        client.create_bucket(Bucket=BUCKET)
+    for path in scene_dir.iterdir():
+        client.upload_file(str(path), BUCKET, f'{PREFIX}/{SYNTHETIC_SCENE}/{path.name}')
+    yield scene_dir
+    storage._s3_client.cache_clear()
+
+
+def test_list_prefix(s3_scene):
+    assert storage.listdir(f's3://{BUCKET}/{PREFIX}') == [SYNTHETIC_SCENE]
+
+    scene = storage.input_dir(f's3://{BUCKET}/{PREFIX}/{SYNTHETIC_SCENE}')
+    bands = storage.glob(scene, '*_SR_B*.TIF')
+    assert [path.name for path in bands] == sorted(path.name for path in s3_scene.glob('*_SR_B*.TIF'))
+    assert str(bands[0]).startswith(f'/vsis3/{BUCKET}/{PREFIX}/{SYNTHETIC_SCENE}/')
+    assert storage.size(bands[0]) == (s3_scene / bands[0].name).stat().st_size
+
+
+def test_read_metadata(s3_scene):
+    scene = storage.input_dir(f's3://{BUCKET}/{PREFIX}/{SYNTHETIC_SCENE}')
+    mtl_file, = storage.glob(scene, '*_MTL.txt')
+
+    assert storage.read_bytes(mtl_file) == MTL.encode()
+    assert storage.read_text(mtl_file) == MTL
+
+
+def test_landsat_harmonize_s3(s3_scene, tmp_path):
+    local_dir, _ = landsat_harmonize(SYNTHETIC_SCENE, s3_scene, tmp_path / 'local', cp_quality_band=False)
+    s3_dir, _ = landsat_harmonize(SYNTHETIC_SCENE, f's3://{BUCKET}/{PREFIX}/{SYNTHETIC_SCENE}', tmp_path / 's3',
+                                  cp_quality_band=False)
+
+    local_files = sorted(local_dir.glob('*_NBAR_*.tif'))
+    assert [path.name for path in local_files] == sorted(path.name for path in s3_dir.glob('*_NBAR_*.tif'))
+    assert local_files
+    for local_file in local_files:
+        with rasterio.open(str(local_file)) as local, rasterio.open(str(s3_dir / local_file.name)) as remote:
+            assert numpy.array_equal(local.read(1), remote.read(1))
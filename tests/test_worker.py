@@ -0,0 +1,159 @@
+#
+# This file is part of Brazil Data Cube sensor-harm.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Unit-test for the long-running worker, with the filesystem only."""
+
+# Python Native
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+
+# 3rdparty
+import pytest
+
+# sensor-harm
+from sensor_harm.accuracy import SYNTHETIC_SCENE, synthetic_landsat_scene
+from sensor_harm.worker import SPOOL_DIRS, Worker
+
+
+@pytest.fixture
+def spool(tmp_path):
+    """Create an empty spool directory."""
+    spool_dir = tmp_path / 'spool'
+    for name in SPOOL_DIRS:
+        (spool_dir / name).mkdir(parents=True)
+    return spool_dir
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def _submit(spool_dir, name, job):
+    (spool_dir / 'incoming' / f'{name}.json').write_text(job if isinstance(job, str) else json.dumps(job))
+
+
+def test_claim(spool):
+    _submit(spool, 'job-1', dict(input='/nowhere', output='/nowhere'))
+    _submit(spool, 'job-2', dict(input='/nowhere', output='/nowhere'))
+    worker = Worker()
+
+    running = worker.claim(spool)
+
+    assert running == spool / 'running' / f'job-1@{socket.gethostname()}@{os.getpid()}.json'
+    assert running.exists()
+    assert [path.name for path in (spool / 'incoming').iterdir()] == ['job-2.json']
+
+
+def test_claim_empty(spool):
+    assert Worker().claim(spool) is None
+
+
+def test_recover(spool):
+    host = socket.gethostname()
+    (spool / 'running' / f'dead@{host}@{_dead_pid()}.json').write_text('{}')
+    (spool / 'running' / f'alive@{host}@{os.getpid()}.json').write_text('{}')
+    (spool / 'running' / 'remote@another-host@1.json').write_text('{}')
+
+    recovered = Worker().recover(spool)
+
+    assert recovered == [spool / 'incoming' / 'dead.json']
+    assert recovered[0].read_text() == '{}'
+    assert sorted(path.name for path in (spool / 'running').iterdir()) == \
+        sorted([f'alive@{host}@{os.getpid()}.json', 'remote@another-host@1.json'])
+
+
+def test_invalid_job(spool):
+    _submit(spool, 'invalid', '{"input": ')
+
+    Worker().serve_spool(spool, exit_when_empty=True)
+
+    assert not list((spool / 'running').iterdir())
+    content = json.loads((spool / 'failed' / 'invalid.json').read_text())
+    assert content['job'] == {}
+    assert content['result']['id'] == 'invalid'
+    assert content['result']['status'] == 'failed'
+    assert content['result']['error'].startswith('Invalid job')
+
+
+def test_failed_job(spool, tmp_path):
+    _submit(spool, 'unknown', dict(input=str(tmp_path / 'XX00_unknown'), output=str(tmp_path / 'output')))
+
+    Worker().serve_spool(spool, exit_when_empty=True)
+
+    result = json.loads((spool / 'failed' / 'unknown.json').read_text())['result']
+    assert result['status'] == 'failed'
+    assert 'not a Sentinel-2 or Landsat scene' in result['error']
+
+
+def test_done_job(spool, tmp_path):
+    scene_dir = synthetic_landsat_scene(tmp_path / 'input', size=256, block=128)
+    _submit(spool, 'scene', dict(input=str(scene_dir), output=str(tmp_path / 'output')))
+
+    Worker().serve_spool(spool, exit_when_empty=True)
+
+    result = json.loads((spool / 'done' / 'scene.json').read_text())['result']
+    assert result['id'] == 'scene'
+    assert result['scene_id'] == SYNTHETIC_SCENE
+    assert sorted(path.name for path in (tmp_path / 'output' / f'{SYNTHETIC_SCENE}_NBAR').glob('*_NBAR_B*.tif')) == \
+        [f'{SYNTHETIC_SCENE}_NBAR_B{band}.tif' for band in range(2, 8)]
+
+
+def test_spool_drain_file(spool):
+    _submit(spool, 'job-1', dict(input='/nowhere', output='/nowhere'))
+    (spool / 'DRAIN').touch()
+    worker = Worker()
+
+    worker.serve_spool(spool)
+
+    assert worker.draining
+    assert worker.processed == 0
+    assert [path.name for path in (spool / 'incoming').iterdir()] == ['job-1.json']
+
+
+def test_stream_drain_rejects_job():
+    worker = Worker()
+    worker.drain()
+    output = io.StringIO()
+
+    worker.serve_stream(io.StringIO('{"id": "job-1", "scene_id": "LC08_X"}\n{"id": "job-2"}\n'), output)
+
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert worker.processed == 0
+    assert results == [dict(id='job-1', scene_id='LC08_X', status='rejected', output=None, error='Worker draining')]
+
+
+def test_stream_drain_after_job(monkeypatch):
+    worker = Worker()
+
+    def process(job):
+        # SIGTERM received while the job runs
+        worker.drain()
+        return dict(id=job['id'], status='done')
+
+    monkeypatch.setattr(worker, 'process', process)
+    output = io.StringIO()
+
+    worker.serve_stream(io.StringIO('{"id": "job-1"}\n{"id": "job-2"}\n'), output)
+
+    assert [json.loads(line)['id'] for line in output.getvalue().splitlines()] == ['job-1']